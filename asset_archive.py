@@ -0,0 +1,175 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+from google.appengine.ext import blobstore
+from google.appengine.ext import deferred
+import json
+import mimetypes
+import model
+import os
+import uuid
+import zipfile
+
+UPLOADS_IN_FLIGHT = 10
+UPLOAD_DEADLINE = 60
+READ_BUFFER_SIZE = 1024 * 1024
+# Each member is read whole and posted in one URL Fetch request, which
+# can't be larger than 10 MB. The bytes in flight are bounded as well.
+MAX_MEMBER_SIZE = 9 * 1024 * 1024
+MAX_BYTES_IN_FLIGHT = 32 * 1024 * 1024
+
+
+def member_path(project_id):
+  return '/api/projects/%d/asset_archive/member' % project_id
+
+
+def archive_members(archive):
+  for info in archive.infolist():
+    filename = os.path.basename(info.filename)
+    if (not filename or filename.startswith('.') or
+        info.filename.startswith('__MACOSX/')):
+      continue
+    yield info, filename
+
+
+def quoted_filename(filename):
+  # Zip members flagged as UTF-8 have unicode names, the body is bytes.
+  if isinstance(filename, unicode):
+    filename = filename.encode('utf-8')
+  filename = filename.replace('\r', '').replace('\n', '')
+  return '"%s"' % filename.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def multipart_body(filename, content_type, data):
+  boundary = uuid.uuid4().hex
+  body = '\r\n'.join([
+      '--' + boundary,
+      'Content-Disposition: form-data; name="file"; filename=' +
+      quoted_filename(filename),
+      'Content-Type: ' + content_type,
+      '',
+      data,
+      '--' + boundary + '--',
+      '',
+  ])
+  return body, 'multipart/form-data; boundary=' + boundary
+
+
+def start_upload(project_id, archive, info, filename):
+  content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+  body, body_type = multipart_body(filename, content_type, archive.read(info))
+
+  rpc = urlfetch.create_rpc(deadline=UPLOAD_DEADLINE)
+  urlfetch.make_fetch_call(
+      rpc,
+      blobstore.create_upload_url(member_path(project_id)),
+      payload=body,
+      method=urlfetch.POST,
+      headers={'Content-Type': body_type},
+      follow_redirects=False)
+  return rpc
+
+
+def finish_upload(rpc, filename):
+  response = rpc.get_result()
+  if response.status_code != 200:
+    raise Exception('Uploading "%s" from the archive failed with status %d!' %
+                    (filename, response.status_code))
+  return blobstore.BlobKey(json.loads(response.content)['key'])
+
+
+def add_upload(assets, orphaned, rpc, filename):
+  blob_key = finish_upload(rpc, filename)
+  if filename.lower() in assets:
+    orphaned.append(assets[filename.lower()])
+  assets[filename.lower()] = blob_key
+
+
+def upload_members(project_id, archive_key, assets, orphaned):
+  # Members are read one at a time from the archive blob and posted to
+  # Blobstore, keeping a bounded number of uploads in flight at once. If one
+  # fails, the others in flight are still waited for, so every uploaded
+  # blob ends up in assets or orphaned.
+  archive = zipfile.ZipFile(
+      blobstore.BlobReader(archive_key, buffer_size=READ_BUFFER_SIZE))
+
+  in_flight = deque()
+  bytes_in_flight = 0
+  try:
+    # Checked before anything is uploaded, so the archive fails at once.
+    too_large = [
+        filename for info, filename in archive_members(archive)
+        if info.file_size > MAX_MEMBER_SIZE
+    ]
+    if too_large:
+      raise ValueError(
+          '%s larger than %d MB, upload them on their own!' %
+          (', '.join(quoted_filename(f) for f in too_large),
+           MAX_MEMBER_SIZE / (1024 * 1024)))
+
+    for info, filename in archive_members(archive):
+      while in_flight and (
+          len(in_flight) >= UPLOADS_IN_FLIGHT or
+          bytes_in_flight + info.file_size > MAX_BYTES_IN_FLIGHT):
+        rpc, done_filename, size = in_flight.popleft()
+        bytes_in_flight -= size
+        add_upload(assets, orphaned, rpc, done_filename)
+
+      in_flight.append((start_upload(project_id, archive, info, filename),
+                        filename, info.file_size))
+      bytes_in_flight += info.file_size
+
+    while in_flight:
+      rpc, done_filename, _ = in_flight.popleft()
+      add_upload(assets, orphaned, rpc, done_filename)
+  finally:
+    while in_flight:
+      rpc, done_filename, _ = in_flight.popleft()
+      try:
+        add_upload(assets, orphaned, rpc, done_filename)
+      except Exception:
+        pass
+    archive.close()
+
+
+def expand(project_id, archive_key):
+  assets = {}
+  orphaned = []
+  try:
+    upload_members(project_id, archive_key, assets, orphaned)
+  except Exception, e:
+    # Retrying would upload every member again, so a failed archive is
+    # given up on and what it uploaded deleted.
+    deferred.defer(model.delete_unreferenced_blobs,
+                   assets.values() + orphaned + [archive_key])
+    model.log_project_activity(
+        ndb.Key(model.Project, project_id),
+        'Expanding archive failed: %s' % e, model.ProjectLoggerSeverity.ERROR)
+    raise deferred.PermanentTaskFailure(str(e))
+
+  project, replaced = model.add_project_assets(project_id, assets.values())
+
+  blobs_to_delete = replaced + orphaned + [archive_key]
+  deferred.defer(model.delete_unreferenced_blobs, blobs_to_delete)
+
+  model.log_project_activity(
+      project.key, 'Archive expanded: %d asset(s) added, %d replaced.' %
+      (len(assets) - len(replaced), len(replaced)))
+
+
+def expand_later(project_id, archive_key):
+  deferred.defer(expand, project_id, archive_key)
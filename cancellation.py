@@ -0,0 +1,75 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.appengine.api import memcache
+import time
+
+CHECK_INTERVAL = 2
+CACHE_TIME = 60
+SLEEP_SLICE = 1
+
+
+class RunCancelled(Exception):
+  pass
+
+
+def cache_key(run_key):
+  return 'run-cancelled-%s' % run_key.urlsafe()
+
+
+def request_cancellation(run_key):
+  memcache.set(cache_key(run_key), 1, time=CACHE_TIME)
+
+
+class CancellationToken(object):
+  # Answers "has this run been cancelled?" from memcache, at most once every
+  # few seconds, falling back to the run entity when memcache is cold.
+
+  def __init__(self, run_key=None):
+    self.run_key = run_key
+    self.cancelled = False
+    self.checked_at = 0
+
+  def is_cancelled(self):
+    if self.cancelled or self.run_key is None:
+      return self.cancelled
+
+    now = time.time()
+    if now - self.checked_at < CHECK_INTERVAL:
+      return False
+    self.checked_at = now
+
+    flag = memcache.get(cache_key(self.run_key))
+    if flag is None:
+      run = self.run_key.get()
+      flag = 1 if run and run.cancel_requested else 0
+      # Added rather than set, a cancellation requested since the run was
+      # read must not be overwritten with what it said.
+      memcache.add(cache_key(self.run_key), flag, time=CACHE_TIME)
+
+    self.cancelled = bool(flag)
+    return self.cancelled
+
+  def check(self):
+    if self.is_cancelled():
+      raise RunCancelled('Cancelled.')
+
+  def sleep(self, seconds):
+    deadline = time.time() + seconds
+    while True:
+      self.check()
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return
+      time.sleep(min(SLEEP_SLICE, remaining))
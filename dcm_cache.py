@@ -0,0 +1,143 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from google.appengine.ext import ndb
+
+
+class Record(object):
+  __slots__ = ()
+
+  def to_dict(self):
+    return dict((s, getattr(self, s)) for s in self.__slots__)
+
+  @classmethod
+  def from_dict(cls, data):
+    record = cls.__new__(cls)
+    for s in cls.__slots__:
+      setattr(record, s, data.get(s))
+    return record
+
+
+class Campaign(Record):
+  __slots__ = ('id', 'name', 'advertiser_id', 'start_date', 'end_date')
+  FIELDS = 'id,name,advertiserId,startDate,endDate'
+
+  def __init__(self, resource):
+    self.id = resource['id']
+    self.name = resource.get('name')
+    self.advertiser_id = resource.get('advertiserId')
+    self.start_date = resource.get('startDate')
+    self.end_date = resource.get('endDate')
+
+
+class Placement(Record):
+  __slots__ = ('id', 'name')
+  FIELDS = 'id,name'
+
+  def __init__(self, resource):
+    self.id = resource['id']
+    self.name = resource.get('name')
+
+
+class Ad(Record):
+  __slots__ = ('id', 'name', 'creative_assignments')
+  FIELDS = 'id,name,creativeRotation/creativeAssignments'
+
+  def __init__(self, resource):
+    self.id = resource['id']
+    self.name = resource.get('name')
+    self.creative_assignments = resource.get('creativeRotation', {}).get(
+        'creativeAssignments', [])
+
+
+class Creative(Record):
+  __slots__ = ('id', 'name')
+  FIELDS = 'id,name'
+
+  def __init__(self, resource):
+    self.id = resource['id']
+    self.name = resource.get('name')
+
+
+class DCMCacheEntry(ndb.Model):
+  data = ndb.JsonProperty(compressed=True)
+
+
+class EntityCache(object):
+  # An LRU map of name to record. When bounded and given a parent key,
+  # evicted records are written to Datastore and read back on demand.
+
+  def __init__(self, record_class, max_size=None, spill_parent=None):
+    self.record_class = record_class
+    self.max_size = max_size
+    self.spill_parent = spill_parent
+    self.entries = OrderedDict()
+    self.spilled = set()
+    self.written = set()
+
+  def __contains__(self, name):
+    return name in self.entries or name in self.spilled
+
+  def __len__(self):
+    return len(self.entries) + len(self.spilled)
+
+  def __getitem__(self, name):
+    record = self.get(name)
+    if record is None:
+      raise KeyError(name)
+    return record
+
+  def __setitem__(self, name, record):
+    self.entries.pop(name, None)
+    self.entries[name] = record
+    self.spilled.discard(name)
+
+    while self.max_size and len(self.entries) > self.max_size:
+      evicted_name, evicted_record = self.entries.popitem(last=False)
+      if self.spill_parent:
+        DCMCacheEntry(key=self.spill_key(evicted_name),
+                      data=evicted_record.to_dict()).put()
+        self.spilled.add(evicted_name)
+        self.written.add(evicted_name)
+
+  def get(self, name, default=None):
+    if name in self.entries:
+      record = self.entries.pop(name)
+      self.entries[name] = record
+      return record
+
+    if name in self.spilled:
+      entry = self.spill_key(name).get()
+      if entry:
+        record = self.record_class.from_dict(entry.data)
+        self[name] = record
+        return record
+
+    return default
+
+  def values(self):
+    for name in list(self.entries) + list(self.spilled):
+      yield self.get(name)
+
+  def spill_key(self, name):
+    return ndb.Key(DCMCacheEntry, '%s:%s' % (self.record_class.__name__, name),
+                   parent=self.spill_parent)
+
+  def clear(self):
+    if self.written:
+      ndb.delete_multi([self.spill_key(name) for name in self.written])
+    self.entries.clear()
+    self.spilled.clear()
+    self.written.clear()
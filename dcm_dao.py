@@ -13,35 +13,169 @@
 # limitations under the License.
 
 from apiclient import http
-from datetime import datetime
-from dateutil import tz
+from cancellation import CancellationToken
+from dcm_cache import Ad
+from dcm_cache import Campaign
+from dcm_cache import Creative
+from dcm_cache import EntityCache
+from dcm_cache import Placement
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
-from google.appengine.ext import blobstore
-from googleapiclient.discovery import build
+from googleapiclient.discovery import DISCOVERY_URI
+from googleapiclient.discovery import build_from_document
 from oauth2client.client import Credentials
-import httplib2
+from progress import RunProgress
+from schedule import Schedules
+from storage import CHUNK_SIZE
+from tokens import TokenStore
+from transport import Resolved
+from transport import Then
+import calendar
 import time
+import transport
+import uuid
+import zlib
 
 urlfetch.set_default_fetch_deadline(300)
 
+API_NAME = 'dfareporting'
+API_VERSION = 'v3.3'
+DISCOVERY_CACHE_TIME = 24 * 60 * 60
+
+_discovery_document = None
+
+
+def discovery_document():
+  # Kept per instance and in memcache, so building a service neither fetches
+  # the discovery document again nor waits on the discovery service. The
+  # document is compressed to stay under the memcache value size limit.
+  global _discovery_document
+  if _discovery_document is None:
+    cache_key = 'discovery-%s-%s' % (API_NAME, API_VERSION)
+    compressed = memcache.get(cache_key)
+    if compressed is not None:
+      document = zlib.decompress(compressed)
+    else:
+      response = urlfetch.fetch(
+          DISCOVERY_URI.format(api=API_NAME, apiVersion=API_VERSION),
+          headers=transport.COMPRESSED_HEADERS)
+      if response.status_code != 200:
+        raise Exception(
+            'Fetching the %s %s discovery document failed with status %d!' %
+            (API_NAME, API_VERSION, response.status_code))
+      document = transport.decoded_content(response)
+      memcache.set(
+          cache_key, zlib.compress(document), time=DISCOVERY_CACHE_TIME)
+    _discovery_document = document
+  return _discovery_document
+
+
+def build_service(http):
+  return build_from_document(discovery_document(), http=http)
+
+
+def warm_up():
+  http = transport.POOL.acquire()
+  build_service(http)
+  transport.POOL.release(http)
+
 
 class DCMDAO(object):
 
   MAX_RETRIES = 5
   MAX_TIMEOUT = 1800
-  API_NAME = 'dfareporting'
-  API_VERSION = 'v3.3'
-
-  def __init__(self, project):
+  # Records kept in memory per collection, the least recently used ones
+  # beyond that are spilled to Datastore under the run.
+  CACHE_SIZE = 5000
+  RETRY_BACKOFF = 1
+  # Fields that carry the run tag, per collection.
+  TAG_FIELDS = {
+      'campaigns': 'comment',
+      'placements': 'comment',
+      'ads': 'comments'
+  }
+  # Allowed drift between our clock and the API's when matching creatives
+  # modified since an insert was first attempted.
+  CLOCK_SKEW_MS = 60 * 1000
+  IDS_PER_LIST = 500
+  ASSOCIATIONS_PER_LIST = 1000
+  REQUESTS_IN_FLIGHT = 20
+
+  def __init__(self,
+               project,
+               run_key=None,
+               cache_size=CACHE_SIZE,
+               cancellation=None,
+               progress=None,
+               tag_run_key=None):
     credentials = Credentials.new_from_json(project.credentials)
-    authed_http = credentials.authorize(httplib2.Http())
+    authed_http = transport.AuthorizedHttp(
+        credentials, tokens=TokenStore(project.key, credentials))
 
-    self.service = build(self.API_NAME, self.API_VERSION, http=authed_http)
+    # Every API call is counted towards the profile's daily quota.
+    self.request_count = 0
+    authed_request = authed_http.request
+
+    def counted_request(*args, **kwargs):
+      self.request_count += 1
+      return authed_request(*args, **kwargs)
+
+    authed_http.request = counted_request
+
+    self.http = authed_http
+    self.service = build_service(authed_http)
     self.profile_id = project.profile_id
-    self.creatives = {}
-    self.placements = {}
-    self.campaigns = {}
-    self.ads = {}
+    self.schedules = Schedules(project.timezone, project.advertiser_timezones)
+    self.creatives = EntityCache(Creative, cache_size, run_key)
+    self.placements = EntityCache(Placement, cache_size, run_key)
+    self.campaigns = EntityCache(Campaign, cache_size, run_key)
+    self.ads = EntityCache(Ad, cache_size, run_key)
+    self.active_creatives = set()
+    # The IDs of the creatives associated with each campaign, listed the
+    # first time a campaign needs them and kept up to date after that.
+    self.associations = {}
+    self.sizes = {}
+    self.pending_placements = {}
+    self.cancellation = cancellation or CancellationToken()
+    self.progress = progress or RunProgress()
+    self.created = {}
+    # A run that retries the failed rows of another one tags what it creates
+    # like that run did, and looks for what that run already created before
+    # inserting campaigns and placements.
+    self.resuming = tag_run_key is not None
+    self.tag_run_key = tag_run_key
+    run_key = tag_run_key or run_key
+    if run_key:
+      self.run_tag = 'Bulk Uploader run %s/%s' % (run_key.parent().id(),
+                                                  run_key.id())
+    else:
+      self.run_tag = 'Bulk Uploader run %s' % uuid.uuid4().hex
+
+  def should_retry(self, error, retry_count):
+    if error.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
+      self.cancellation.sleep(self.RETRY_BACKOFF * 2**retry_count)
+      return True
+    return False
+
+  def start(self, request, retry, transform=None):
+    # Sends request without waiting for it. A failed attempt is handed over
+    # to retry, the method's synchronous path with its usual retries.
+    self.request_count += 1
+
+    def fallback(error):
+      if error.resp.status == 401 or self.should_retry(error, 0):
+        return retry()
+      raise error
+
+    return transport.start(request, self.http.authorization_headers(),
+                           transform, fallback)
+
+  def record_created(self, kind, entity_id):
+    self.created.setdefault(kind, []).append(entity_id)
+
+  def clear_caches(self):
+    for cache in [self.creatives, self.placements, self.campaigns, self.ads]:
+      cache.clear()
 
   def get_campaign_from_name(self, campaign_name, retry_count=0):
     if campaign_name in self.campaigns:
@@ -57,322 +191,588 @@ class DCMDAO(object):
   def get_campaign(self, campaign_name, retry_count=0):
     try:
       response = self.service.campaigns().list(
-          profileId=self.profile_id, searchString=campaign_name).execute()
+          profileId=self.profile_id,
+          searchString=campaign_name,
+          fields='campaigns(%s)' % Campaign.FIELDS).execute()
 
       if 'campaigns' in response:
         for campaign in response['campaigns']:
           if campaign['name'] == campaign_name:
-            return campaign
+            return Campaign(campaign)
 
       return None
     except http.HttpError, e:
-      if e.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
+      if self.should_retry(e, retry_count):
         return self.get_campaign(campaign_name, retry_count + 1)
       else:
         raise
 
-  def create_campaign(self,
-                      advertiser_id,
-                      campaign_name,
-                      start_date,
-                      end_date,
-                      default_landing_page_name,
-                      default_landing_page_url,
-                      retry_count=0):
+  def find_tagged(self,
+                  collection,
+                  record_class,
+                  name,
+                  retry_count=0,
+                  **filters):
+    tag_field = self.TAG_FIELDS[collection]
     try:
-      campaign = self.get_campaign(campaign_name)
+      response = getattr(self.service, collection)().list(
+          profileId=self.profile_id,
+          searchString=name,
+          fields='%s(%s,%s)' % (collection, record_class.FIELDS, tag_field),
+          **filters).execute()
 
-      if campaign is not None:
-        raise Exception(
-            'A campaign called "%s" already exists!' % campaign_name)
+      for entity in response.get(collection, []):
+        if entity['name'] == name and entity.get(tag_field) == self.run_tag:
+          return record_class(entity)
+
+      return None
+    except http.HttpError, e:
+      if self.should_retry(e, retry_count):
+        return self.find_tagged(collection, record_class, name,
+                                retry_count + 1, **filters)
       else:
-        campaign = {
-            'name': campaign_name,
-            'advertiserId': advertiser_id,
-            'archived': False,
-            'startDate': start_date,
-            'endDate': end_date
-        }
+        raise
 
-        advertiser_landing_page = {
-            'advertiserId': advertiser_id,
-            'name': default_landing_page_name,
-            'url': default_landing_page_url
-        }
+  def insert_tagged(self,
+                    collection,
+                    record_class,
+                    body,
+                    retry_count=0,
+                    **filters):
+    # Entities are tagged with the run, so a retry can find an insert that
+    # committed even though its request failed instead of inserting it twice.
+    body[self.TAG_FIELDS[collection]] = self.run_tag
+    try:
+      if retry_count:
+        existing = self.find_tagged(collection, record_class, body['name'],
+                                    **filters)
+        if existing is not None:
+          return existing
+
+      return record_class(
+          getattr(self.service, collection)().insert(
+              profileId=self.profile_id,
+              body=body,
+              fields=record_class.FIELDS).execute())
+    except http.HttpError, e:
+      if self.should_retry(e, retry_count):
+        return self.insert_tagged(collection, record_class, body,
+                                  retry_count + 1, **filters)
+      else:
+        raise
+
+  def start_tagged(self, collection, record_class, body, **filters):
+    body[self.TAG_FIELDS[collection]] = self.run_tag
+    request = getattr(self.service, collection)().insert(
+        profileId=self.profile_id, body=body, fields=record_class.FIELDS)
+
+    def retry():
+      return self.insert_tagged(collection, record_class, body, 1, **filters)
+
+    return self.start(request, retry, record_class)
+
+  def patch_request(self, collection, entity_id, body):
+    return getattr(self.service, collection)().patch(
+        profileId=self.profile_id, id=entity_id, body=body, fields='id')
+
+  def patch(self, collection, entity_id, body, retry_count=0):
+    try:
+      return self.patch_request(collection, entity_id, body).execute()
+    except http.HttpError, e:
+      if self.should_retry(e, retry_count):
+        return self.patch(collection, entity_id, body, retry_count + 1)
+      else:
+        raise
+
+  def start_patch(self, collection, entity_id, body):
+    return self.start(
+        self.patch_request(collection, entity_id, body),
+        lambda: self.patch(collection, entity_id, body, 1))
 
-        default_landing_page = self.service.advertiserLandingPages().insert(
-            profileId=self.profile_id, body=advertiser_landing_page).execute()
+  def find_landing_page(self, advertiser_id, name, url, retry_count=0):
+    try:
+      response = self.service.advertiserLandingPages().list(
+          profileId=self.profile_id,
+          advertiserIds=[advertiser_id],
+          searchString=name,
+          fields='landingPages(id,name,url)').execute()
 
-        campaign['defaultLandingPageId'] = default_landing_page['id']
+      for landing_page in response.get('landingPages', []):
+        if landing_page['name'] == name and landing_page['url'] == url:
+          return landing_page
 
-        self.campaigns[campaign_name] = self.service.campaigns().insert(
-            profileId=self.profile_id, body=campaign).execute()
-        return self.campaigns[campaign_name]
+      return None
     except http.HttpError, e:
-      if e.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
-        return self.create_campaign(advertiser_id, campaign_name, start_date,
-                                    end_date, default_landing_page_name,
-                                    default_landing_page_url, retry_count + 1)
+      if self.should_retry(e, retry_count):
+        return self.find_landing_page(advertiser_id, name, url,
+                                      retry_count + 1)
       else:
         raise
 
+  def create_landing_page(self, advertiser_id, name, url, retry_count=0):
+    # Landing pages have no field to tag, an identical one is reused on
+    # retries instead.
+    try:
+      landing_page = None
+      if retry_count:
+        landing_page = self.find_landing_page(advertiser_id, name, url)
+
+      if landing_page is None:
+        landing_page = self.service.advertiserLandingPages().insert(
+            profileId=self.profile_id,
+            body={
+                'advertiserId': advertiser_id,
+                'name': name,
+                'url': url
+            },
+            fields='id').execute()
+        self.record_created('landingPages', landing_page['id'])
+
+      return landing_page['id']
+    except http.HttpError, e:
+      if self.should_retry(e, retry_count):
+        return self.create_landing_page(advertiser_id, name, url,
+                                        retry_count + 1)
+      else:
+        raise
+
+  def create_campaign(self, advertiser_id, campaign_name, start_date, end_date,
+                      default_landing_page_name, default_landing_page_url):
+    if self.resuming:
+      campaign = self.find_tagged(
+          'campaigns', Campaign, campaign_name, advertiserIds=[advertiser_id])
+      if campaign is not None:
+        self.campaigns[campaign_name] = campaign
+        return campaign
+
+    campaign = self.get_campaign(campaign_name)
+
+    if campaign is not None:
+      raise Exception('A campaign called "%s" already exists!' % campaign_name)
+
+    schedule = self.schedules.for_advertiser(advertiser_id)
+    campaign = {
+        'name': campaign_name,
+        'advertiserId': advertiser_id,
+        'archived': False,
+        'startDate': schedule.date(start_date),
+        'endDate': schedule.date(end_date),
+        'defaultLandingPageId': self.create_landing_page(
+            advertiser_id, default_landing_page_name,
+            default_landing_page_url)
+    }
+
+    self.campaigns[campaign_name] = self.insert_tagged(
+        'campaigns', Campaign, campaign, advertiserIds=[advertiser_id])
+    self.record_created('campaigns', self.campaigns[campaign_name].id)
+    # A campaign this run inserted has nothing associated yet.
+    self.associations[self.campaigns[campaign_name].id] = set()
+    return self.campaigns[campaign_name]
+
+  def list_ids_request(self, collection, ids, page_token=None):
+    return getattr(self.service, collection)().list(
+        profileId=self.profile_id,
+        ids=ids,
+        pageToken=page_token,
+        fields='nextPageToken,%s(id)' % collection)
+
+  def ids_in_response(self, collection, ids, response):
+    found = set(str(e['id']) for e in response.get(collection, []))
+    if response.get('nextPageToken'):
+      found.update(
+          self.list_ids(collection, ids, response['nextPageToken']))
+    return found
+
+  def list_ids(self, collection, ids, page_token=None, retry_count=0):
+    try:
+      response = self.list_ids_request(collection, ids, page_token).execute()
+      return self.ids_in_response(collection, ids, response)
+    except http.HttpError, e:
+      if self.should_retry(e, retry_count):
+        return self.list_ids(collection, ids, page_token, retry_count + 1)
+      else:
+        raise
+
+  def start_list_ids(self, collection, ids):
+    return self.start(
+        self.list_ids_request(collection, ids),
+        lambda: self.list_ids(collection, ids, retry_count=1),
+        lambda response: self.ids_in_response(collection, ids, response))
+
+  def existing_ids(self, collection, ids):
+    # Checks many IDs with a few list calls rather than one get per ID, the
+    # calls for all batches in flight together.
+    ids = sorted(set(str(i) for i in ids))
+    batches = [
+        ids[start:start + self.IDS_PER_LIST]
+        for start in xrange(0, len(ids), self.IDS_PER_LIST)
+    ]
+    found = set()
+    for _, batch_found in transport.in_flight(
+        batches, lambda batch: self.start_list_ids(collection, batch),
+        self.REQUESTS_IN_FLIGHT):
+      found.update(batch_found)
+    return found
+
+  def sizes_request(self, width, height):
+    return self.service.sizes().list(
+        profileId=self.profile_id,
+        height=height,
+        width=width,
+        fields='sizes/id')
+
+  def cache_sizes(self, width, height, response):
+    self.sizes[(width, height)] = response.get('sizes', [])
+    return self.sizes[(width, height)]
+
   def get_sizes(self, width, height, retry_count=0):
+    if (width, height) in self.sizes:
+      return self.sizes[(width, height)]
+
     try:
-      sizes = self.service.sizes().list(
-          profileId=self.profile_id, height=height, width=width).execute()
-      return sizes
+      return self.cache_sizes(width, height,
+                              self.sizes_request(width, height).execute())
     except http.HttpError, e:
-      if e.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
+      if self.should_retry(e, retry_count):
         return self.get_sizes(width, height, retry_count + 1)
       else:
         raise
 
+  def start_sizes(self, width, height):
+    if (width, height) in self.sizes:
+      return Resolved(self.sizes[(width, height)])
+
+    return self.start(
+        self.sizes_request(width, height),
+        lambda: self.get_sizes(width, height, 1),
+        lambda response: self.cache_sizes(width, height, response))
+
+  def load_sizes(self, sizes):
+    for _ in transport.in_flight(sizes, lambda size: self.start_sizes(*size),
+                                 self.REQUESTS_IN_FLIGHT):
+      pass
+
+  def creative_request(self, creative_id):
+    return self.service.creatives().get(
+        profileId=self.profile_id, id=creative_id, fields='id,active')
+
+  def start_creative(self, creative_id):
+    return self.start(
+        self.creative_request(creative_id),
+        lambda: self.get_creative(creative_id, 1))
+
   def get_creative(self, creative_id, retry_count=0):
     try:
-      return self.service.creatives().get(
-          profileId=self.profile_id, id=creative_id)
+      return self.creative_request(creative_id).execute()
     except http.HttpError, e:
-      if e.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
+      if self.should_retry(e, retry_count):
         return self.get_creative(creative_id, retry_count + 1)
       else:
         raise
 
-  def create_ad(self,
-                campaign,
-                creative_id,
-                creative_name,
-                ad_name,
-                ad_start_date,
-                ad_end_date,
-                priority,
-                hard_cutoff,
-                ad_type,
-                click_through_url,
-                landing_page_url_suffix,
-                creative_landing_page_url,
-                creative_rotation_type,
-                placement_name,
-                retry_count=0,
-                max_timeout=MAX_TIMEOUT):
+  def get_ad(self, campaign_id, ad_name, retry_count=0):
     try:
-      creative_assignment = {'active': True}
+      response = self.service.ads().list(
+          profileId=self.profile_id,
+          campaignIds=[campaign_id],
+          searchString=ad_name,
+          fields='ads(%s)' % Ad.FIELDS).execute()
 
-      if 'tracker' not in ad_type:
-        if creative_id:
-          cached_creative = self.creatives[creative_id]
-        else:
-          cached_creative = self.creatives[creative_name]
+      if 'ads' in response:
+        for ad in response['ads']:
+          if ad['name'] == ad_name:
+            return Ad(ad)
 
-        creative = self.get_creative(cached_creative['id']).execute()
-        timeout = 0
+      return None
+    except http.HttpError, e:
+      if self.should_retry(e, retry_count):
+        return self.get_ad(campaign_id, ad_name, retry_count + 1)
+      else:
+        raise
 
-        while not creative['active'] and timeout < max_timeout:
-          timeout += 30
-          time.sleep(timeout)
-          creative = self.get_creative(creative['id']).execute()
+  def wait_for_active_creatives(self, creative_ids, max_timeout=MAX_TIMEOUT):
+    pending = [c for c in creative_ids if c not in self.active_creatives]
+    timeout = 0
 
-        if not creative['active']:
-          raise Exception(
-              'A creative with ID "%s" was not found after %d seconds!',
-              creative['id'], timeout)
+    while pending:
+      still_pending = []
+      for creative_id, creative in transport.in_flight(
+          pending, self.start_creative, self.REQUESTS_IN_FLIGHT):
+        if creative.get('active'):
+          self.active_creatives.add(creative_id)
+        else:
+          still_pending.append(creative_id)
+      pending = still_pending
 
-        creative_assignment['creativeId'] = creative['id']
+      if not pending:
+        break
 
-      if creative_landing_page_url:
-        creative_assignment['clickThroughUrl'] = {
-            'defaultLandingPage': False,
-            'customClickThroughUrl': creative_landing_page_url
-        }
-      else:
-        creative_assignment['clickThroughUrl'] = {'defaultLandingPage': True}
+      if timeout >= max_timeout:
+        raise Exception(
+            'Creatives with IDs "%s" were not active after %d seconds!' %
+            (', '.join(str(c) for c in pending), timeout))
 
-      if ad_name in self.ads:
-        creative_assignments = self.ads[ad_name]['creativeRotation'][
-            'creativeAssignments']
-        creative_assignments.append(creative_assignment)
+      timeout += 30
+      self.cancellation.sleep(timeout)
 
-        creative_update = {
-            'creativeRotation': {
-                'creativeAssignments': creative_assignments
-            }
-        }
+  def creative_assignment(self, creative_id, creative_name, ad_type,
+                          creative_landing_page_url):
+    creative_assignment = {'active': True}
 
-        existing_ad_id = self.ads[ad_name]['id']
-        response = self.service.ads().patch(
-            profileId=self.profile_id, id=existing_ad_id,
-            body=creative_update).execute()
-        self.ads[ad_name] = response
-        return response
-
-      creative_rotation = {'creativeAssignments': [creative_assignment]}
-
-      if creative_rotation_type == 'sequential':
-        creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_SEQUENTIAL'
-      elif creative_rotation_type == 'even':
-        creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
-        creative_rotation['weightCalculationStrategy'] = 'WEIGHT_STRATEGY_EQUAL'
-      elif creative_rotation_type == 'click-through rate':
-        creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
-        creative_rotation[
-            'weightCalculationStrategy'] = 'WEIGHT_STRATEGY_HIGHEST_CTR'
-      elif creative_rotation_type == 'optimized':
-        creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
-        creative_rotation[
-            'weightCalculationStrategy'] = 'WEIGHT_STRATEGY_OPTIMIZED'
-      elif creative_rotation_type == 'custom':
-        creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
-        creative_rotation[
-            'weightCalculationStrategy'] = 'WEIGHT_STRATEGY_CUSTOM'
+    if 'tracker' not in ad_type:
+      if creative_id:
+        cached_creative = self.creatives[creative_id]
       else:
-        creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
-        creative_rotation[
-            'weightCalculationStrategy'] = 'WEIGHT_STRATEGY_OPTIMIZED'
-
-      ad_priority_formatted = '01'
-      if priority:
-        ad_priority_formatted = priority.zfill(2)
-
-      hard_cutoff_boolean = False
-      if hard_cutoff == 'yes' or hard_cutoff == 'true':
-        hard_cutoff_boolean = True
-
-      delivery_schedule = {
-          'impressionRatio': '1',
-          'priority': ('AD_PRIORITY_%s' % ad_priority_formatted),
-          'hardCutoff': hard_cutoff_boolean
-      }
+        cached_creative = self.creatives[creative_name]
 
-      placement_assignments = [{
-          'active': True,
-          'placementId': self.placements[placement_name]['id'],
-      }]
+      creative_assignment['creativeId'] = cached_creative.id
 
-      ad = {
-          'active': True,
-          'campaignId': campaign['id'],
-          'creativeRotation': creative_rotation,
-          'deliverySchedule': delivery_schedule,
-          'name': ad_name,
-          'placementAssignments': placement_assignments,
-          'type': 'AD_SERVING_STANDARD_AD'
+    if creative_landing_page_url:
+      creative_assignment['clickThroughUrl'] = {
+          'defaultLandingPage': False,
+          'customClickThroughUrl': creative_landing_page_url
       }
+    else:
+      creative_assignment['clickThroughUrl'] = {'defaultLandingPage': True}
 
-      if 'tracking' in ad_type:
-        ad['type'] = 'AD_SERVING_TRACKING'
-
-      if 'tracker' in ad_type:
-        ad['type'] = 'AD_SERVING_CLICK_TRACKER'
+    return creative_assignment
 
-        if 'static' in ad_type:
-          ad['active'] = False
+  def add_creative_assignments(self, ad, creative_assignments, retry_count=0):
+    try:
+      existing_assignments = ad.creative_assignments
+      existing_creative_ids = set(
+          str(a.get('creativeId')) for a in existing_assignments)
+      new_assignments = [
+          a for a in creative_assignments
+          if str(a.get('creativeId')) not in existing_creative_ids
+      ]
 
-        ad['dynamicClickTracker'] = 'dynamic' in ad_type
+      if not new_assignments:
+        return ad
 
-        if click_through_url:
-          ad['clickThroughUrl'] = {
-              'defaultLandingPage': False,
-              'customClickThroughUrl': click_through_url
+      creative_update = {
+          'creativeRotation': {
+              'creativeAssignments': existing_assignments + new_assignments
           }
-        else:
-          ad['clickThroughUrl'] = {'defaultLandingPage': True}
+      }
 
-      if ad_start_date:
-        unconverted_start_time = datetime.strptime(
-            '%s 23:59:59' % ad_start_date, '%Y-%m-%d %H:%M:%S')
+      return Ad(
+          self.service.ads().patch(
+              profileId=self.profile_id,
+              id=ad.id,
+              body=creative_update,
+              fields=Ad.FIELDS).execute())
+    except http.HttpError, e:
+      if self.should_retry(e, retry_count):
+        return self.add_creative_assignments(ad, creative_assignments,
+                                             retry_count + 1)
       else:
-        unconverted_start_time = datetime.strptime(
-            '%s 23:59:59' % campaign['startDate'], '%Y-%m-%d %H:%M:%S')
+        raise
 
-      unconverted_start_time = unconverted_start_time.replace(
-          tzinfo=tz.gettz('America/New_York'))
-      converted_start_time = unconverted_start_time.astimezone(tz.gettz('UTC'))
+  def create_ad(self,
+                campaign,
+                ad_name,
+                creative_assignments,
+                ad_start_date,
+                ad_end_date,
+                priority,
+                hard_cutoff,
+                ad_type,
+                click_through_url,
+                landing_page_url_suffix,
+                creative_rotation_type,
+                placement_name,
+                max_timeout=MAX_TIMEOUT):
+    self.wait_for_active_creatives(
+        [a['creativeId'] for a in creative_assignments if 'creativeId' in a],
+        max_timeout)
+
+    if ad_name not in self.ads:
+      existing_ad = self.get_ad(campaign.id, ad_name)
+      if existing_ad is not None:
+        self.ads[ad_name] = existing_ad
+
+    if ad_name in self.ads:
+      self.ads[ad_name] = self.add_creative_assignments(
+          self.ads[ad_name], creative_assignments)
+      return self.ads[ad_name]
 
-      ad['startTime'] = converted_start_time.isoformat()
+    creative_rotation = {'creativeAssignments': creative_assignments}
+
+    if creative_rotation_type == 'sequential':
+      creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_SEQUENTIAL'
+    elif creative_rotation_type == 'even':
+      creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
+      creative_rotation['weightCalculationStrategy'] = 'WEIGHT_STRATEGY_EQUAL'
+    elif creative_rotation_type == 'click-through rate':
+      creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
+      creative_rotation[
+          'weightCalculationStrategy'] = 'WEIGHT_STRATEGY_HIGHEST_CTR'
+    elif creative_rotation_type == 'optimized':
+      creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
+      creative_rotation[
+          'weightCalculationStrategy'] = 'WEIGHT_STRATEGY_OPTIMIZED'
+    elif creative_rotation_type == 'custom':
+      creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
+      creative_rotation[
+          'weightCalculationStrategy'] = 'WEIGHT_STRATEGY_CUSTOM'
+    else:
+      creative_rotation['type'] = 'CREATIVE_ROTATION_TYPE_RANDOM'
+      creative_rotation[
+          'weightCalculationStrategy'] = 'WEIGHT_STRATEGY_OPTIMIZED'
+
+    ad_priority_formatted = '01'
+    if priority:
+      ad_priority_formatted = priority.zfill(2)
+
+    hard_cutoff_boolean = False
+    if hard_cutoff == 'yes' or hard_cutoff == 'true':
+      hard_cutoff_boolean = True
+
+    delivery_schedule = {
+        'impressionRatio': '1',
+        'priority': ('AD_PRIORITY_%s' % ad_priority_formatted),
+        'hardCutoff': hard_cutoff_boolean
+    }
 
-      if ad_end_date:
-        unconverted_end_time = datetime.strptime('%s 00:00:00' % ad_end_date,
-                                                 '%Y-%m-%d %H:%M:%S')
-      else:
-        unconverted_end_time = datetime.strptime(
-            '%s 00:00:00' % campaign['endDate'], '%Y-%m-%d %H:%M:%S')
+    placement_assignments = [{
+        'active': True,
+        'placementId': self.placements[placement_name].id,
+    }]
+
+    ad = {
+        'active': True,
+        'campaignId': campaign.id,
+        'creativeRotation': creative_rotation,
+        'deliverySchedule': delivery_schedule,
+        'name': ad_name,
+        'placementAssignments': placement_assignments,
+        'type': 'AD_SERVING_STANDARD_AD'
+    }
 
-      unconverted_end_time = unconverted_end_time.replace(
-          tzinfo=tz.gettz('America/New_York'))
-      converted_end_time = unconverted_end_time.astimezone(tz.gettz('UTC'))
+    if 'tracking' in ad_type:
+      ad['type'] = 'AD_SERVING_TRACKING'
 
-      ad['endTime'] = converted_end_time.isoformat()
+    if 'tracker' in ad_type:
+      ad['type'] = 'AD_SERVING_CLICK_TRACKER'
 
-      if landing_page_url_suffix:
-        ad['clickThroughUrlSuffixProperties'] = {
-            'clickThroughUrlSuffix': landing_page_url_suffix,
-            'overrideInheritedSuffix': True
-        }
+      if 'static' in ad_type:
+        ad['active'] = False
 
-      self.ads[ad_name] = self.service.ads().insert(
-          profileId=self.profile_id, body=ad).execute()
-      return self.ads[ad_name]
-    except http.HttpError, e:
-      if e.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
-        return self.create_ad(
-            campaign, creative_id, creative_name, ad_name, ad_start_date,
-            ad_end_date, priority, hard_cutoff, ad_type, click_through_url,
-            landing_page_url_suffix, creative_landing_page_url,
-            creative_rotation_type, retry_count + 1)
+      ad['dynamicClickTracker'] = 'dynamic' in ad_type
+
+      if click_through_url:
+        ad['clickThroughUrl'] = {
+            'defaultLandingPage': False,
+            'customClickThroughUrl': click_through_url
+        }
       else:
-        raise
+        ad['clickThroughUrl'] = {'defaultLandingPage': True}
+
+    schedule = self.schedules.for_advertiser(campaign.advertiser_id)
+    ad['startTime'] = schedule.start_time(ad_start_date or
+                                          campaign.start_date)
+    ad['endTime'] = schedule.end_time(ad_end_date or campaign.end_date)
+
+    if landing_page_url_suffix:
+      ad['clickThroughUrlSuffixProperties'] = {
+          'clickThroughUrlSuffix': landing_page_url_suffix,
+          'overrideInheritedSuffix': True
+      }
+
+    self.ads[ad_name] = self.insert_tagged(
+        'ads', Ad, ad, campaignIds=[campaign.id])
+    self.record_created('ads', self.ads[ad_name].id)
+    return self.ads[ad_name]
 
   def create_placement(self,
                        placement_name,
                        asset_size,
                        campaign,
                        site_id,
-                       retry_count=0):
-    try:
-      if placement_name in self.placements:
-        return self.placements[placement_name]
-
-      placement = {
-          'name': placement_name,
-          'campaignId': campaign['id'],
-          'siteId': site_id,
-          'paymentSource': 'PLACEMENT_AGENCY_PAID',
-          'pricingSchedule': {
-              'startDate': campaign['startDate'],
-              'endDate': campaign['endDate'],
-              'pricingType': 'PRICING_TYPE_CPM'
-          }
-      }
-
-      placement['compatibility'] = 'DISPLAY'
-
-      width, height = asset_size.split('x')
-      sizes = self.get_sizes(int(width), int(height))['sizes']
-      if sizes:
-        placement['size'] = {'id': sizes[0]['id']}
-      else:
-        placement['size'] = {'width': int(width), 'height': int(height)}
+                       start_date=None,
+                       end_date=None):
+    return self.start_placement(placement_name, asset_size, campaign, site_id,
+                                start_date, end_date).get_result()
+
+  def start_placement(self,
+                      placement_name,
+                      asset_size,
+                      campaign,
+                      site_id,
+                      start_date=None,
+                      end_date=None):
+    if placement_name in self.placements:
+      return Resolved(self.placements[placement_name])
+    if placement_name in self.pending_placements:
+      return self.pending_placements[placement_name]
+
+    if self.resuming:
+      placement = self.find_tagged(
+          'placements', Placement, placement_name, campaignIds=[campaign.id])
+      if placement is not None:
+        self.placements[placement_name] = placement
+        return Resolved(placement)
+
+    # The feed's placement dates only replace the campaign's as a pair, one
+    # of them on its own could end the placement before it starts.
+    if not (start_date and end_date):
+      start_date, end_date = campaign.start_date, campaign.end_date
+
+    schedule = self.schedules.for_advertiser(campaign.advertiser_id)
+    placement = {
+        'name': placement_name,
+        'campaignId': campaign.id,
+        'siteId': site_id,
+        'paymentSource': 'PLACEMENT_AGENCY_PAID',
+        'pricingSchedule': {
+            'startDate': schedule.date(start_date),
+            'endDate': schedule.date(end_date),
+            'pricingType': 'PRICING_TYPE_CPM'
+        }
+    }
 
-      placement['tagFormats'] = [
-          'PLACEMENT_TAG_STANDARD', 'PLACEMENT_TAG_JAVASCRIPT',
-          'PLACEMENT_TAG_IFRAME_JAVASCRIPT', 'PLACEMENT_TAG_IFRAME_ILAYER',
-          'PLACEMENT_TAG_INTERNAL_REDIRECT', 'PLACEMENT_TAG_TRACKING',
-          'PLACEMENT_TAG_TRACKING_IFRAME', 'PLACEMENT_TAG_TRACKING_JAVASCRIPT'
-      ]
+    placement['compatibility'] = 'DISPLAY'
 
-      self.placements[placement_name] = self.service.placements().insert(
-          profileId=self.profile_id, body=placement).execute()
-      return self.placements[placement_name]
-    except http.HttpError, e:
-      if e.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
-        return self.create_placement(placement_name, asset_size, campaign,
-                                     site_id, retry_count + 1)
-      else:
-        raise
+    width, height = asset_size.split('x')
+    sizes = self.get_sizes(int(width), int(height))
+    if sizes:
+      placement['size'] = {'id': sizes[0]['id']}
+    else:
+      placement['size'] = {'width': int(width), 'height': int(height)}
+
+    placement['tagFormats'] = [
+        'PLACEMENT_TAG_STANDARD', 'PLACEMENT_TAG_JAVASCRIPT',
+        'PLACEMENT_TAG_IFRAME_JAVASCRIPT', 'PLACEMENT_TAG_IFRAME_ILAYER',
+        'PLACEMENT_TAG_INTERNAL_REDIRECT', 'PLACEMENT_TAG_TRACKING',
+        'PLACEMENT_TAG_TRACKING_IFRAME', 'PLACEMENT_TAG_TRACKING_JAVASCRIPT'
+    ]
+
+    self.pending_placements[placement_name] = Then(
+        self.start_tagged(
+            'placements', Placement, placement, campaignIds=[campaign.id]),
+        lambda result: self.add_placement(placement_name, result))
+    return self.pending_placements[placement_name]
+
+  def settle_placements(self):
+    # Waits for the placement inserts already sent, so the placements they
+    # created are recorded even if the run stops before it gets to them.
+    for future in list(self.pending_placements.values()):
+      try:
+        future.get_result()
+      except Exception:
+        pass
+
+  def add_placement(self, placement_name, placement):
+    del self.pending_placements[placement_name]
+    self.placements[placement_name] = placement
+    self.record_created('placements', placement.id)
+    return placement
 
   def upload_creative_asset(self,
                             asset_type,
                             filename,
-                            asset_key,
+                            asset,
                             advertiser_id,
                             retry_count=0):
     try:
@@ -383,55 +783,175 @@ class DCMDAO(object):
           }
       }
 
-      asset_file = blobstore.BlobReader(asset_key)
-      mimetype = blobstore.BlobInfo(asset_key).content_type
-      media = http.MediaIoBaseUpload(
-          asset_file, mimetype=mimetype, resumable=False)
+      # Assets are streamed in fixed-size chunks instead of being read into
+      # memory whole.
+      stream = asset.open()
+      try:
+        media = http.MediaIoBaseUpload(
+            stream,
+            mimetype=asset.content_type,
+            chunksize=CHUNK_SIZE,
+            resumable=True)
+
+        result = self.service.creativeAssets().insert(
+            advertiserId=advertiser_id,
+            profileId=self.profile_id,
+            media_body=media,
+            body=creative_asset,
+            fields='assetIdentifier').execute()
+      finally:
+        stream.close()
+      self.progress.uploaded(asset.size)
+      return result
+    except http.HttpError, e:
+      if self.should_retry(e, retry_count):
+        return self.upload_creative_asset(asset_type, filename, asset,
+                                          advertiser_id, retry_count + 1)
+      else:
+        raise
 
-      return self.service.creativeAssets().insert(
-          advertiserId=advertiser_id,
+  def find_recent_creative(self, creative, since, retry_count=0):
+    try:
+      response = self.service.creatives().list(
           profileId=self.profile_id,
-          media_body=media,
-          body=creative_asset).execute()
+          advertiserId=creative['advertiserId'],
+          searchString=creative['name'],
+          fields='creatives(%s,lastModifiedInfo/time)' %
+          Creative.FIELDS).execute()
+
+      for existing in response.get('creatives', []):
+        modified_at = int(existing.get('lastModifiedInfo', {}).get('time', 0))
+        if (existing['name'] == creative['name'] and
+            modified_at >= since - self.CLOCK_SKEW_MS):
+          return Creative(existing)
+
+      return None
     except http.HttpError, e:
-      if e.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
-        return self.upload_creative_asset(asset_type, filename, asset_key,
-                                          advertiser_id, retry_count + 1)
+      if self.should_retry(e, retry_count):
+        return self.find_recent_creative(creative, since, retry_count + 1)
       else:
         raise
 
-  def insert_creative(self, creative, retry_count=0):
+  def find_uploaded_creative(self, advertiser_id, creative_name):
+    # A creative the run being resumed, or a retry of it, already uploaded.
+    # Creatives have no field to tag, it is the latest one of that name
+    # modified since the run started.
+    tag_run = self.tag_run_key.get()
+    since = calendar.timegm(tag_run.created_at.utctimetuple()) * 1000
+    creative = self.find_recent_creative(
+        {'advertiserId': advertiser_id, 'name': creative_name}, since)
+    if creative is not None:
+      self.creatives[creative_name] = creative
+    return creative
+
+  def insert_creative(self, creative, retry_count=0, attempted_at=None):
+    # Creatives have no field to tag, a retry looks for a creative of the
+    # same name modified since the first attempt instead.
+    attempted_at = attempted_at or int(time.time() * 1000)
     try:
-      return self.service.creatives().insert(
-          profileId=self.profile_id, body=creative).execute()
+      result = None
+      if retry_count:
+        result = self.find_recent_creative(creative, attempted_at)
+
+      if result is None:
+        result = Creative(
+            self.service.creatives().insert(
+                profileId=self.profile_id,
+                body=creative,
+                fields=Creative.FIELDS).execute())
+      self.record_created('creatives', result.id)
+      return result
     except http.HttpError, e:
-      if e.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
-        return self.insert_creative(creative, retry_count + 1)
+      if self.should_retry(e, retry_count):
+        return self.insert_creative(creative, retry_count + 1, attempted_at)
       else:
         raise
 
+  def associations_request(self, campaign_id, page_token=None):
+    return self.service.campaignCreativeAssociations().list(
+        profileId=self.profile_id,
+        campaignId=campaign_id,
+        maxResults=self.ASSOCIATIONS_PER_LIST,
+        pageToken=page_token,
+        fields='nextPageToken,campaignCreativeAssociations/creativeId')
+
+  def list_associated_ids(self, campaign_id, page_token=None, retry_count=0):
+    try:
+      response = self.associations_request(campaign_id, page_token).execute()
+    except http.HttpError, e:
+      if self.should_retry(e, retry_count):
+        return self.list_associated_ids(campaign_id, page_token,
+                                        retry_count + 1)
+      else:
+        raise
+
+    found = set(
+        str(a['creativeId'])
+        for a in response.get('campaignCreativeAssociations', []))
+    if response.get('nextPageToken'):
+      found.update(
+          self.list_associated_ids(campaign_id, response['nextPageToken']))
+    return found
+
+  def associated_ids(self, campaign_id):
+    if campaign_id not in self.associations:
+      self.associations[campaign_id] = self.list_associated_ids(campaign_id)
+    return self.associations[campaign_id]
+
+  def record_association(self, campaign_id, creative_id):
+    self.record_created('creativeAssociations', [campaign_id, creative_id])
+    if campaign_id in self.associations:
+      self.associations[campaign_id].add(str(creative_id))
+
+  def association_request(self, campaign_id, association):
+    return self.service.campaignCreativeAssociations().insert(
+        profileId=self.profile_id,
+        campaignId=campaign_id,
+        body=association,
+        fields='creativeId')
+
   def insert_creative_associations(self,
                                    campaign_id,
                                    association,
                                    retry_count=0):
     try:
-      self.service.campaignCreativeAssociations().insert(
-          profileId=self.profile_id, campaignId=campaign_id,
-          body=association).execute()
+      self.association_request(campaign_id, association).execute()
+      self.record_association(campaign_id, association['creativeId'])
     except http.HttpError, e:
-      if e.resp.status in [403, 500, 503] and retry_count < self.MAX_RETRIES:
+      if self.should_retry(e, retry_count):
         return self.insert_creative_associations(campaign_id, association,
                                                  retry_count + 1)
       else:
         raise
 
-  def associate_creative_id(self, campaign_id, creative_id):
-    self.creatives[creative_id] = {'id': creative_id}
-
+  def start_association(self, campaign_id, creative_id):
     association = {'creativeId': creative_id}
-
-    self.insert_creative_associations(campaign_id, association)
-    return self.creatives[creative_id]
+    return self.start(
+        self.association_request(campaign_id, association),
+        lambda: self.insert_creative_associations(campaign_id, association,
+                                                  1),
+        lambda response: self.record_association(campaign_id, creative_id))
+
+  def associate_creative_ids(self, campaign_id, creative_ids):
+    # Yields (creative ID, error) for each of creative_ids, error being None
+    # unless associating it failed. Only the creatives the campaign doesn't
+    # have yet are associated, a few requests at a time.
+    associated = self.associated_ids(campaign_id)
+    missing = []
+    for creative_id in creative_ids:
+      self.creatives[creative_id] = Creative({'id': creative_id})
+      if str(creative_id) in associated:
+        yield creative_id, None
+      elif creative_id not in missing:
+        missing.append(creative_id)
+
+    def start(creative_id):
+      return transport.Outcome(
+          lambda: self.start_association(campaign_id, creative_id))
+
+    for creative_id, result in transport.in_flight(missing, start,
+                                                   self.REQUESTS_IN_FLIGHT):
+      yield creative_id, result
 
   def upload_asset(self,
                    asset_type,
@@ -455,7 +975,7 @@ class DCMDAO(object):
     else:
       creative['type'] = 'DISPLAY'
 
-      filename = blobstore.BlobInfo(asset_file).filename
+      filename = asset_file.filename
 
       response = self.upload_creative_asset(asset_type, filename, asset_file,
                                             advertiser_id)
@@ -492,7 +1012,7 @@ class DCMDAO(object):
         }]
 
       width, height = asset_size.strip().lower().split('x')
-      sizes = self.get_sizes(int(width), int(height))['sizes']
+      sizes = self.get_sizes(int(width), int(height))
       if sizes:
         creative['size'] = {'id': sizes[0]['id']}
       else:
@@ -501,7 +1021,8 @@ class DCMDAO(object):
     result = self.insert_creative(creative)
     self.creatives[asset_name] = result
 
-    association = {'creativeId': result['id']}
-
-    self.insert_creative_associations(campaign_id, association)
+    # A retry may have found a creative that was already associated.
+    if str(result.id) not in self.associated_ids(campaign_id):
+      association = {'creativeId': result.id}
+      self.insert_creative_associations(campaign_id, association)
     return self.creatives[asset_name]
@@ -12,247 +12,502 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from csv import DictReader
-from google.appengine.ext import blobstore
-import model
+from collections import OrderedDict
+from cancellation import RunCancelled
+from feeds import Feed
+from profiling import RunProfiler
+from storage import AssetResolver
+from transport import Outcome
+from transport import in_flight
+import re
+
+SIZE_PATTERN = re.compile(r'^\s*\d+\s*x\s*\d+\s*$', re.IGNORECASE)
+MAX_REPORTED_PROBLEMS = 50
+PLACEMENTS_IN_FLIGHT = 10
+# The phases a row fails in after its creative was created.
+DONE_WITH_CREATIVES = ('placements', 'ads')
+# The fields of its rows create_ad reads.
+AD_FIELDS = ('ad_type', 'creative_rotation_type', 'ad_landing_page_url_suffix',
+             'ad_priority', 'ad_hard_cutoff', 'ad_start_date', 'ad_end_date',
+             'ad_click_through_url', 'placement_name', 'campaign_name',
+             'creative_id', 'creative_name', 'creative_landing_page_url')
 
 
 class DCMJob(object):
 
-  def __init__(self, project, dcm_dao):
+  def __init__(self,
+               project,
+               dcm_dao,
+               logger,
+               cancellation=None,
+               progress=None,
+               profiler=None,
+               failures=None,
+               only_rows=None):
     if not project.feed:
       raise ValueError('A feed is required!')
 
-    self.csv = blobstore.BlobReader(
-        project.feed).read().decode('utf-8-sig').encode('utf-8').splitlines()
-    self.mappings = {
-        'ad_end_date':
-            'Ad End Date',
-        'ad_hard_cutoff':
-            'Ad Hard Cutoff',
-        'ad_landing_page_url_suffix':
-            'Ad Landing Page URL Suffix',
-        'ad_name':
-            'Ad Name',
-        'ad_priority':
-            'Ad Priority',
-        'ad_start_date':
-            'Ad Start Date',
-        'ad_type':
-            'Ad Type',
-        'ad_click_through_url':
-            'Ad Click-Through URL',
-        'advertiser_id':
-            'Advertiser ID',
-        'campaign_default_landing_page_name':
-            'Campaign Default Landing Page Name',
-        'campaign_default_landing_page_url':
-            'Campaign Default Landing Page URL',
-        'campaign_end_date':
-            'Campaign End Date',
-        'campaign_name':
-            'Campaign Name',
-        'campaign_start_date':
-            'Campaign Start Date',
-        'creative_backup_image_click_through_url':
-            'Creative Backup Image Click-Through URL',
-        'creative_backup_image_filename':
-            'Creative Backup Image Filename',
-        'creative_filename':
-            'Creative Filename',
-        'creative_id':
-            'Creative ID',
-        'creative_landing_page_url':
-            'Creative Landing Page URL',
-        'creative_name':
-            'Creative Name',
-        'creative_rotation_type':
-            'Creative Rotation Type',
-        'creative_size':
-            'Creative Size',
-        'placement_end_date':
-            'Placement End Date',
-        'placement_name':
-            'Placement Name',
-        'placement_start_date':
-            'Placement Start Date',
-        'site_id':
-            'Site ID'
-    }
+    self.feed = Feed(project.feed, project.column_mappings)
     self.project = project
+    self.assets = AssetResolver(project)
     self.dcm_dao = dcm_dao
+    self.logger = logger
+    self.cancellation = cancellation or dcm_dao.cancellation
+    self.progress = progress or dcm_dao.progress
+    self.profiler = profiler or RunProfiler()
+    self.phase = None
+    # Given a dead-letter store, a row that fails is recorded there with the
+    # rows that depend on it and the run goes on with the others. Without
+    # one the first failure ends the run. only_rows maps the rows a retry
+    # reads to the phase they failed in last time.
+    self.failures = failures
+    self.only_rows = only_rows
+    self.failed_campaigns = {}
+    self.failed_placements = {}
 
   def start(self):
-    self.create_campaigns()
-    self.create_creatives()
-    self.create_placements()
-    self.create_ads()
-
-  def create_campaigns(self):
-    csv_dict = DictReader(self.csv)
-    for row in csv_dict:
-      advertiser_id = row[self.mappings['advertiser_id']].strip()
-      campaign_name = row[self.mappings['campaign_name']].strip()
-      campaign_start_date = row[self.mappings['campaign_start_date']].strip()
-      campaign_end_date = row[self.mappings['campaign_end_date']].strip()
-      campaign_default_landing_page_name = row[self.mappings[
-          'campaign_default_landing_page_name']].strip()
-      campaign_default_landing_page_url = row[self.mappings[
-          'campaign_default_landing_page_url']].strip()
-
-      if campaign_name not in self.dcm_dao.campaigns:
-        logger = model.ProjectLogger(
-            message=('Creating campaign "%s"' % campaign_name),
-            project=self.project.key,
-            severity=model.ProjectLoggerSeverity.INFO)
-        logger.put()
+    with self.profiler.phase('preflight'):
+      self.preflight()
+    try:
+      with self.profiler.phase('campaigns'):
+        self.create_campaigns()
+      with self.profiler.phase('creatives'):
+        self.create_creatives()
+      with self.profiler.phase('placements'):
+        self.create_placements()
+      with self.profiler.phase('ads'):
+        self.create_ads()
+    except RunCancelled:
+      raise
+    except Exception:
+      if self.phase:
+        self.progress.failed(self.phase)
+      raise
+    finally:
+      self.progress.flush()
+      if self.failures is not None:
+        self.failures.flush()
+
+  def preflight(self):
+    # Reads the whole feed once before any write: counts the work for the
+    # progress totals and checks every referenced ID, size and asset, so a
+    # bad feed fails in seconds with all of its problems at once.
+    campaigns = set()
+    creatives = 0
+    placements = 0
+    ads = set()
+
+    problems = []
+    advertiser_ids = {}
+    site_ids = {}
+    creative_ids = {}
+    sizes = set()
+    asset_filenames = {}
+
+    def check_id(value, name, ids, row_number):
+      if not value.isdigit():
+        problems.append((row_number, '%s "%s" is not a number.' %
+                         (name, value)))
+      else:
+        ids.setdefault(value, []).append(row_number)
 
-        self.dcm_dao.create_campaign(advertiser_id, campaign_name,
-                                     campaign_start_date, campaign_end_date,
-                                     campaign_default_landing_page_name,
-                                     campaign_default_landing_page_url)
+    def check_asset(filename, row_number):
+      asset_filenames.setdefault(filename, []).append(row_number)
 
-  def create_creatives(self):
-    default_creatives = []
-    nondefault_creatives = []
-
-    csv_dict = DictReader(self.csv)
-    for row in csv_dict:
-      ad_type = row[self.mappings['ad_type']].strip().lower()
-      if ad_type == 'default':
-        default_creatives.append(row)
-      else:
-        nondefault_creatives.append(row)
+    for row_number, row in self.rows():
+      ad_type = row['ad_type'].strip().lower()
+      creative_id = row['creative_id'].strip()
+      creative_filename = row['creative_filename'].strip()
 
-    all_creatives = default_creatives + nondefault_creatives
+      campaigns.add(row['campaign_name'].strip())
+      if 'tracker' not in ad_type or creative_id:
+        creatives += 1
+      if ad_type != 'default':
+        placements += 1
+        ads.add(row['ad_name'].strip())
 
-    for row in all_creatives:
-      campaign_name = row[self.mappings['campaign_name']].strip()
-      campaign = self.dcm_dao.get_campaign_from_name(campaign_name)
-      campaign_id = campaign['id']
-      creative_name = row[self.mappings['creative_name']].strip()
-      ad_type = row[self.mappings['ad_type']].strip().lower()
-      advertiser_id = row[self.mappings['advertiser_id']].strip()
-      creative_size = row[self.mappings['creative_size']].strip()
-      creative_filename = row[self.mappings['creative_filename']].strip()
-      creative_id = row[self.mappings['creative_id']].strip()
+      check_id(row['advertiser_id'].strip(), 'Advertiser ID', advertiser_ids,
+               row_number)
+      if ad_type != 'default':
+        check_id(row['site_id'].strip(), 'Site ID', site_ids, row_number)
 
       if creative_id:
-        logger = model.ProjectLogger(
-            message=('Associating creative ID "%s"' % creative_id),
-            project=self.project.key,
-            severity=model.ProjectLoggerSeverity.INFO)
-        logger.put()
-        self.dcm_dao.associate_creative_id(campaign_id, creative_id)
-        continue
+        check_id(creative_id, 'Creative ID', creative_ids, row_number)
+      elif 'track' not in ad_type:
+        check_asset(creative_filename, row_number)
+        if creative_filename[-4:] == '.zip':
+          check_asset(row['creative_backup_image_filename'].strip(),
+                      row_number)
+
+      if ad_type != 'default' or not (creative_id or 'track' in ad_type):
+        size = row['creative_size'].strip().lower()
+        if SIZE_PATTERN.match(size):
+          sizes.add(size)
+        else:
+          problems.append((row_number, 'size "%s" is not WIDTHxHEIGHT.' %
+                           size))
+
+    self.assets.prefetch(asset_filenames.keys())
+    for filename in sorted(asset_filenames, key=asset_filenames.get):
+      if not self.assets.find(filename):
+        for row_number in asset_filenames[filename]:
+          problems.append((row_number, 'asset "%s" has not been uploaded.' %
+                           filename))
+
+    for collection, name, ids in [('advertisers', 'Advertiser ID',
+                                   advertiser_ids),
+                                  ('sites', 'Site ID', site_ids),
+                                  ('creatives', 'Creative ID', creative_ids)]:
+      found = self.dcm_dao.existing_ids(collection, ids.keys())
+      for missing in sorted(set(ids) - found, key=ids.get):
+        for row_number in ids[missing]:
+          problems.append((row_number, '%s "%s" does not exist.' %
+                           (name, missing)))
+
+    if problems and self.failures is not None:
+      for row_number, problem in problems:
+        self.failures.add(row_number, 'preflight', problem)
+      self.logger.log('%d row(s) failed validation and will be skipped.' %
+                      len(self.failures))
+    elif problems:
+      messages = [
+          'Row %d: %s' % problem for problem in problems[:MAX_REPORTED_PROBLEMS]
+      ]
+      if len(problems) > MAX_REPORTED_PROBLEMS:
+        messages.append('and %d more.' %
+                        (len(problems) - MAX_REPORTED_PROBLEMS))
+      raise ValueError('The feed failed validation:\n' + '\n'.join(messages))
+
+    # Sizes are looked up once here and then served from the cache.
+    self.dcm_dao.load_sizes(
+        [tuple(int(n) for n in dimensions.split('x')) for dimensions in sizes])
+
+    self.progress.total('campaigns', len(campaigns))
+    self.progress.total('creatives', creatives)
+    self.progress.total('placements', placements)
+    self.progress.total('ads', len(ads))
+    self.progress.flush()
+
+  def rows(self):
+    # Numbered from 1 like the feed's data rows, only the rows being retried
+    # when there are some.
+    for row_number, row in enumerate(self.feed.rows(), 1):
+      if self.only_rows is None or row_number in self.only_rows:
+        yield row_number, row
+
+  def failed_dependency(self, row_number, row):
+    # The number of the failed row this one can't be created without, which
+    # may be the row itself.
+    if self.failures is None:
+      return None
+    if row_number in self.failures:
+      return row_number
+
+    campaign_row = self.failed_campaigns.get(row['campaign_name'].strip())
+    if campaign_row is not None:
+      return campaign_row
+    if row['ad_type'].strip().lower() != 'default':
+      return self.failed_placements.get(row['placement_name'].strip())
+    return None
+
+  def skip(self, phase, row_number, row):
+    cause = self.failed_dependency(row_number, row)
+    if cause is None:
+      return False
+
+    self.failures.add(row_number, phase, 'Row %d failed.' % cause, cause)
+    return True
+
+  def fail(self, phase, row_numbers, error):
+    # The error is recorded against the first row, the others depend on it.
+    self.progress.failed(phase)
+    self.logger.log('Row %d failed: %s' % (row_numbers[0], error))
+    self.failures.add(row_numbers[0], phase, str(error))
+    for row_number in row_numbers[1:]:
+      self.failures.add(row_number, phase, 'Row %d failed.' % row_numbers[0],
+                        row_numbers[0])
+
+  def attempt(self, phase, row_numbers, work):
+    # Returns what work returns, or None when it failed and the failure was
+    # recorded for the given rows.
+    if self.failures is None:
+      return work()
+
+    try:
+      return work()
+    except RunCancelled:
+      raise
+    except Exception, e:
+      self.fail(phase, row_numbers, e)
+      return None
+
+  def checkpoint(self, phase):
+    self.phase = phase
+    self.progress.maybe_flush()
+    self.profiler.sample()
+    self.cancellation.check()
 
-      if 'tracker' in ad_type:
+  def create_campaigns(self):
+    for row_number, row in self.rows():
+      self.checkpoint('campaigns')
+      if self.skip('campaigns', row_number, row):
         continue
 
-      creative_file = None
-      if 'track' not in ad_type:
-        creative_file = self.asset_to_upload(creative_filename)
-
-      creative_backup_image_filename = None
-      creative_backup_image_file = None
-      creative_backup_image_click_through_url = None
-
-      asset_type = 'HTML_IMAGE'
-
-      if creative_filename[-4:] == '.zip':
-        asset_type = 'HTML'
-        creative_backup_image_filename = row[self.mappings[
-            'creative_backup_image_filename']].strip()
-        creative_backup_image_file = self.asset_to_upload(
-            creative_backup_image_filename)
-        creative_backup_image_click_through_url = row[self.mappings[
-            'creative_backup_image_click_through_url']].strip()
-
-      logger = model.ProjectLogger(
-          message=('Creating creative "%s"' % creative_name),
-          project=self.project.key,
-          severity=model.ProjectLoggerSeverity.INFO)
-      logger.put()
-
-      self.dcm_dao.upload_asset(asset_type, creative_name, creative_file,
-                                creative_size, advertiser_id, campaign_id,
-                                ad_type, creative_backup_image_file,
-                                creative_backup_image_filename,
-                                creative_backup_image_click_through_url)
-
-  def create_placements(self):
-    csv_dict = DictReader(self.csv)
-    for row in csv_dict:
-      ad_type = row[self.mappings['ad_type']].strip().lower()
-      if ad_type == 'default':
-        continue
+      advertiser_id = row['advertiser_id'].strip()
+      campaign_name = row['campaign_name'].strip()
+      campaign_start_date = row['campaign_start_date'].strip()
+      campaign_end_date = row['campaign_end_date'].strip()
+      campaign_default_landing_page_name = row[
+          'campaign_default_landing_page_name'].strip()
+      campaign_default_landing_page_url = row[
+          'campaign_default_landing_page_url'].strip()
 
-      campaign_name = row[self.mappings['campaign_name']].strip()
-      campaign = self.dcm_dao.get_campaign_from_name(campaign_name)
+      if campaign_name not in self.dcm_dao.campaigns:
+        self.logger.log('Creating campaign "%s"' % campaign_name)
+
+        def create():
+          return self.dcm_dao.create_campaign(
+              advertiser_id, campaign_name, campaign_start_date,
+              campaign_end_date, campaign_default_landing_page_name,
+              campaign_default_landing_page_url)
+
+        if self.attempt('campaigns', [row_number], create):
+          self.progress.completed('campaigns')
+        else:
+          self.failed_campaigns[campaign_name] = row_number
+
+  def creative_rows(self):
+    # The rows of default ads first, then the others, reading the feed
+    # once for each rather than holding it in memory.
+    for defaults in (True, False):
+      for row_number, row in self.rows():
+        if (row['ad_type'].strip().lower() == 'default') == defaults:
+          yield row_number, row
 
-      if campaign is None:
-        raise Exception('Campaign not found.')
+  def create_creatives(self):
+    # Rows naming an existing creative are gathered by campaign and
+    # associated together at the end, each creative once.
+    associations = OrderedDict()
 
-      site_id = row[self.mappings['site_id']]
-      creative_size = row[self.mappings['creative_size']].strip().lower()
-      placement_name = row[self.mappings['placement_name']].strip()
+    for row_number, row in self.creative_rows():
+      self.checkpoint('creatives')
+      if self.skip('creatives', row_number, row):
+        continue
 
-      logger = model.ProjectLogger(
-          message=('Creating placement "%s"' % placement_name),
-          project=self.project.key,
-          severity=model.ProjectLoggerSeverity.INFO)
-      logger.put()
+      creative_id = row['creative_id'].strip()
+      if creative_id:
+        campaign_id = self.attempt('creatives', [row_number],
+                                   lambda: self.campaign_id(row))
+        if campaign_id is not None:
+          associations.setdefault(campaign_id, OrderedDict()).setdefault(
+              creative_id, []).append(row_number)
+      elif self.attempt('creatives', [row_number],
+                        lambda: self.create_creative(row_number, row)):
+        self.progress.completed('creatives')
+
+    for campaign_id, creative_rows in associations.iteritems():
+      self.associate_creatives(campaign_id, creative_rows)
+
+  def campaign_id(self, row):
+    campaign_name = row['campaign_name'].strip()
+    return self.dcm_dao.get_campaign_from_name(campaign_name).id
+
+  def associate_creatives(self, campaign_id, creative_rows):
+    # creative_rows maps each creative ID to the rows naming it.
+    self.logger.log('Associating %d creative ID(s) with campaign %s' %
+                    (len(creative_rows), campaign_id))
+
+    # The campaign's existing associations are listed up front, a failure
+    # there fails all of its rows.
+    row_numbers = [n for rows in creative_rows.values() for n in rows]
+    if self.attempt('creatives', row_numbers,
+                    lambda: self.dcm_dao.associated_ids(campaign_id)) is None:
+      return
+
+    for creative_id, error in self.dcm_dao.associate_creative_ids(
+        campaign_id, creative_rows.keys()):
+      self.checkpoint('creatives')
+      rows = creative_rows[creative_id]
+      if error is None:
+        self.progress.completed('creatives', len(rows))
+      elif self.failures is None:
+        raise error
+      else:
+        self.fail('creatives', rows, error)
+
+  def creative_done(self, row_number):
+    # Whether a retried row got past the creative phase in its last run,
+    # in which case its creative was uploaded and associated then.
+    return (self.only_rows is not None and
+            self.only_rows.get(row_number) in DONE_WITH_CREATIVES)
+
+  def create_creative(self, row_number, row):
+    # Returns whether the row added a creative to its campaign, trackers
+    # without a creative ID don't.
+    campaign_name = row['campaign_name'].strip()
+    campaign = self.dcm_dao.get_campaign_from_name(campaign_name)
+    campaign_id = campaign.id
+    creative_name = row['creative_name'].strip()
+    ad_type = row['ad_type'].strip().lower()
+    advertiser_id = row['advertiser_id'].strip()
+    creative_size = row['creative_size'].strip()
+    creative_filename = row['creative_filename'].strip()
+
+    if 'tracker' in ad_type:
+      return False
+
+    if (self.creative_done(row_number) and
+        self.dcm_dao.find_uploaded_creative(advertiser_id, creative_name)):
+      self.logger.log('Reusing creative "%s"' % creative_name)
+      return True
+
+    creative_file = None
+    if 'track' not in ad_type:
+      creative_file = self.asset_to_upload(creative_filename)
+
+    creative_backup_image_filename = None
+    creative_backup_image_file = None
+    creative_backup_image_click_through_url = None
+
+    asset_type = 'HTML_IMAGE'
+
+    if creative_filename[-4:] == '.zip':
+      asset_type = 'HTML'
+      creative_backup_image_filename = row[
+          'creative_backup_image_filename'].strip()
+      creative_backup_image_file = self.asset_to_upload(
+          creative_backup_image_filename)
+      creative_backup_image_click_through_url = row[
+          'creative_backup_image_click_through_url'].strip()
+
+    self.logger.log('Creating creative "%s"' % creative_name)
+
+    self.dcm_dao.upload_asset(asset_type, creative_name, creative_file,
+                              creative_size, advertiser_id, campaign_id,
+                              ad_type, creative_backup_image_file,
+                              creative_backup_image_filename,
+                              creative_backup_image_click_through_url)
+    return True
 
-      self.dcm_dao.create_placement(placement_name, creative_size, campaign,
-                                    site_id)
+  def create_placements(self):
+    # Placements only depend on their campaign, so their inserts overlap.
+    start = self.start_placement
+    if self.failures is not None:
+      start = lambda item: Outcome(lambda: self.start_placement(item))
+
+    try:
+      for (row_number, row), result in in_flight(
+          self.placement_rows(), start, PLACEMENTS_IN_FLIGHT):
+        if isinstance(result, Exception):
+          self.failed_placements.setdefault(row['placement_name'].strip(),
+                                            row_number)
+          self.fail('placements', [row_number], result)
+        else:
+          self.progress.completed('placements')
+    finally:
+      # A cancellation or failing row leaves inserts in flight.
+      self.dcm_dao.settle_placements()
+
+  def placement_rows(self):
+    for row_number, row in self.rows():
+      self.checkpoint('placements')
+      ad_type = row['ad_type'].strip().lower()
+      if ad_type != 'default' and not self.skip('placements', row_number,
+                                                row):
+        yield row_number, row
+
+  def start_placement(self, item):
+    _, row = item
+    campaign_name = row['campaign_name'].strip()
+    campaign = self.dcm_dao.get_campaign_from_name(campaign_name)
+
+    if campaign is None:
+      raise Exception('Campaign not found.')
+
+    site_id = row['site_id']
+    creative_size = row['creative_size'].strip().lower()
+    placement_name = row['placement_name'].strip()
+    placement_start_date = row['placement_start_date'].strip()
+    placement_end_date = row['placement_end_date'].strip()
+
+    self.logger.log('Creating placement "%s"' % placement_name)
+
+    return self.dcm_dao.start_placement(placement_name, creative_size,
+                                        campaign, site_id,
+                                        placement_start_date,
+                                        placement_end_date)
 
   def create_ads(self):
-    csv_dict = DictReader(self.csv)
-    for row in csv_dict:
-      ad_type = row[self.mappings['ad_type']].strip().lower()
-      if ad_type == 'default':
+    # A first read of the feed notes the last row of each ad, the second
+    # creates each ad once it gets there, keeping only the rows of the ads
+    # it's still reading.
+    last_rows = {}
+    for row_number, row in self.rows():
+      if row['ad_type'].strip().lower() != 'default':
+        last_rows[row['ad_name'].strip()] = row_number
+
+    ads = {}
+    for row_number, row in self.rows():
+      if row['ad_type'].strip().lower() == 'default':
         continue
 
-      creative_name = row[self.mappings['creative_name']].strip()
-      creative_id = row[self.mappings['creative_id']].strip()
-      ad_name = row[self.mappings['ad_name']].strip()
-      creative_rotation_type = row[self.mappings[
-          'creative_rotation_type']].strip().lower()
-      creative_landing_page_url = row[self.mappings[
-          'creative_landing_page_url']].strip()
-      ad_landing_page_url_suffix = row[self.mappings[
-          'ad_landing_page_url_suffix']].strip()
-      ad_priority = row[self.mappings['ad_priority']].strip()
-      ad_hard_cutoff = row[self.mappings['ad_hard_cutoff']].strip().lower()
-      ad_start_date = row[self.mappings['ad_start_date']].strip()
-      ad_end_date = row[self.mappings['ad_end_date']].strip()
-      ad_click_through_url = row[self.mappings['ad_click_through_url']].strip()
-      placement_name = row[self.mappings['placement_name']].strip()
-      campaign_name = row[self.mappings['campaign_name']].strip()
-      campaign = self.dcm_dao.get_campaign_from_name(campaign_name)
-
-      logger = model.ProjectLogger(
-          message=('Creating ad "%s"' % ad_name),
-          project=self.project.key,
-          severity=model.ProjectLoggerSeverity.INFO)
-      logger.put()
-
-      self.dcm_dao.create_ad(
-          campaign, creative_id, creative_name, ad_name, ad_start_date,
-          ad_end_date, ad_priority, ad_hard_cutoff, ad_type,
-          ad_click_through_url, ad_landing_page_url_suffix,
-          creative_landing_page_url, creative_rotation_type, placement_name)
+      self.checkpoint('ads')
+      ad_name = row['ad_name'].strip()
+      row_numbers, rows = ads.setdefault(ad_name, ([], []))
+      # Rows whose creative or placement failed are left out of the ad, a
+      # retry adds them to its rotation.
+      if not self.skip('ads', row_number, row):
+        row_numbers.append(row_number)
+        rows.append(dict((f, row[f]) for f in AD_FIELDS))
+
+      if row_number != last_rows[ad_name]:
+        continue
+      del ads[ad_name]
+      if rows and self.attempt('ads', row_numbers,
+                               lambda: self.create_ad(ad_name, rows)):
+        self.progress.completed('ads')
+
+  def create_ad(self, ad_name, rows):
+    # The first row of an ad defines its settings, every row adds a
+    # creative to its rotation.
+    row = rows[0]
+    ad_type = row['ad_type'].strip().lower()
+    creative_rotation_type = row['creative_rotation_type'].strip().lower()
+    ad_landing_page_url_suffix = row['ad_landing_page_url_suffix'].strip()
+    ad_priority = row['ad_priority'].strip()
+    ad_hard_cutoff = row['ad_hard_cutoff'].strip().lower()
+    ad_start_date = row['ad_start_date'].strip()
+    ad_end_date = row['ad_end_date'].strip()
+    ad_click_through_url = row['ad_click_through_url'].strip()
+    placement_name = row['placement_name'].strip()
+    campaign_name = row['campaign_name'].strip()
+    campaign = self.dcm_dao.get_campaign_from_name(campaign_name)
+
+    creative_assignments = []
+    for creative_row in rows:
+      creative_assignments.append(
+          self.dcm_dao.creative_assignment(
+              creative_row['creative_id'].strip(),
+              creative_row['creative_name'].strip(),
+              creative_row['ad_type'].strip().lower(),
+              creative_row['creative_landing_page_url'].strip()))
+
+    self.logger.log('Creating ad "%s" with %d creative assignment(s)' %
+                    (ad_name, len(creative_assignments)))
+
+    return self.dcm_dao.create_ad(campaign, ad_name, creative_assignments,
+                                  ad_start_date, ad_end_date, ad_priority,
+                                  ad_hard_cutoff, ad_type,
+                                  ad_click_through_url,
+                                  ad_landing_page_url_suffix,
+                                  creative_rotation_type, placement_name)
 
   def asset_to_upload(self, asset_filename):
-    asset_key = None
-    for asset in self.project.assets:
-      if asset_filename.lower() == blobstore.BlobInfo(asset).filename.lower():
-        asset_key = asset
-        break
+    asset = self.assets.find(asset_filename)
 
-    if not asset_key:
+    if not asset:
       raise ValueError(
           'Feed contains a reference to "%s" that has not yet been uploaded as an asset to this project!'
           % asset_filename)
 
-    return asset_key
+    return asset
@@ -0,0 +1,69 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.appengine.ext import ndb
+
+FLUSH_SIZE = 100
+
+
+class FailedRow(ndb.Model):
+  # A feed row a run could not create, keyed by its row number under the
+  # run. cause is the row whose failure it depends on, if it did not fail
+  # itself.
+  phase = ndb.StringProperty(indexed=False)
+  error = ndb.TextProperty()
+  cause = ndb.IntegerProperty(indexed=False)
+  created_at = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class DeadLetters(object):
+  # The failed rows of a run, written in batches as they accumulate. A row
+  # is only recorded once, for the first failure that reaches it.
+
+  def __init__(self, run_key=None):
+    self.run_key = run_key
+    self.rows = {}
+    self.pending = []
+
+  def __contains__(self, row_number):
+    return row_number in self.rows
+
+  def __len__(self):
+    return len(self.rows)
+
+  def add(self, row_number, phase, error, cause=None):
+    if row_number in self.rows:
+      return
+
+    self.rows[row_number] = cause
+    self.pending.append(
+        FailedRow(
+            parent=self.run_key,
+            id=row_number,
+            phase=phase,
+            error=error,
+            cause=cause))
+    if len(self.pending) >= FLUSH_SIZE:
+      self.flush()
+
+  def flush(self):
+    if self.pending and self.run_key:
+      ndb.put_multi(self.pending)
+    self.pending = []
+
+
+def failed_row_phases(run_key):
+  # The phase each failed row of a run failed in, by row number.
+  return dict((failed_row.key.id(), failed_row.phase)
+              for failed_row in FailedRow.query(ancestor=run_key))
@@ -0,0 +1,365 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from csv import DictReader
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+import codecs
+import csv
+import datetime
+import itertools
+import json
+import zipfile
+import zlib
+
+READ_SIZE = 1024 * 1024
+
+GZIP_MAGIC = '\x1f\x8b'
+ZIP_MAGIC = 'PK\x03\x04'
+JSON_LINES_EXTENSIONS = ('.jsonl', '.ndjson', '.json')
+
+INDEX_ID = 'feed'
+INDEX_INTERVAL = 1000
+# How long an index task is given before a preview queues another one.
+INDEX_TASK_TIMEOUT = datetime.timedelta(minutes=10)
+TOP_VALUES = 20
+# Fields the index keeps value counts for, and what the preview calls them.
+STATS_FIELDS = {
+    'campaign_name': 'campaigns',
+    'creative_size': 'sizes',
+    'ad_type': 'adTypes'
+}
+
+# Feed fields and the columns they are read from, unless a project maps
+# them to columns of its own.
+COLUMNS = {
+    'ad_end_date': 'Ad End Date',
+    'ad_hard_cutoff': 'Ad Hard Cutoff',
+    'ad_landing_page_url_suffix': 'Ad Landing Page URL Suffix',
+    'ad_name': 'Ad Name',
+    'ad_priority': 'Ad Priority',
+    'ad_start_date': 'Ad Start Date',
+    'ad_type': 'Ad Type',
+    'ad_click_through_url': 'Ad Click-Through URL',
+    'advertiser_id': 'Advertiser ID',
+    'campaign_default_landing_page_name': 'Campaign Default Landing Page Name',
+    'campaign_default_landing_page_url': 'Campaign Default Landing Page URL',
+    'campaign_end_date': 'Campaign End Date',
+    'campaign_name': 'Campaign Name',
+    'campaign_start_date': 'Campaign Start Date',
+    'creative_backup_image_click_through_url':
+        'Creative Backup Image Click-Through URL',
+    'creative_backup_image_filename': 'Creative Backup Image Filename',
+    'creative_filename': 'Creative Filename',
+    'creative_id': 'Creative ID',
+    'creative_landing_page_url': 'Creative Landing Page URL',
+    'creative_name': 'Creative Name',
+    'creative_rotation_type': 'Creative Rotation Type',
+    'creative_size': 'Creative Size',
+    'placement_end_date': 'Placement End Date',
+    'placement_name': 'Placement Name',
+    'placement_start_date': 'Placement Start Date',
+    'site_id': 'Site ID'
+}
+
+
+def column_mappings(overrides=None):
+  mappings = dict(COLUMNS)
+  mappings.update(overrides or {})
+  return mappings
+
+
+def validate_column_mappings(overrides):
+  for field, column in (overrides or {}).iteritems():
+    if field not in COLUMNS:
+      raise ValueError(
+          'Unknown feed field "%s" in the column mappings!' % field)
+    if not isinstance(column, basestring) or not column.strip():
+      raise ValueError('Feed field "%s" must map to a column name!' % field)
+
+
+class FeedIndex(ndb.Model):
+  # Where every INDEX_INTERVAL-th row of a project's feed starts, as offsets
+  # into its decompressed content, and value counts for STATS_FIELDS. Built
+  # for one feed blob and column mapping, a new feed replaces it. The
+  # queued_ properties note which feed and mapping a task was last queued
+  # to index, building the index clears them.
+  feed = ndb.BlobKeyProperty(indexed=False)
+  column_mappings = ndb.JsonProperty()
+  fieldnames = ndb.JsonProperty()
+  offsets = ndb.JsonProperty(compressed=True)
+  row_count = ndb.IntegerProperty(indexed=False)
+  stats = ndb.JsonProperty(compressed=True)
+  error = ndb.TextProperty()
+  queued_feed = ndb.BlobKeyProperty(indexed=False)
+  queued_column_mappings = ndb.JsonProperty()
+  queued_at = ndb.DateTimeProperty(indexed=False)
+  created_at = ndb.DateTimeProperty(auto_now_add=True)
+
+  def is_current(self, feed, column_mappings):
+    return (self.feed == feed and
+            (self.column_mappings or {}) == (column_mappings or {}))
+
+  def is_queued(self, feed, column_mappings):
+    return (self.queued_feed == feed and
+            (self.queued_column_mappings or {}) == (column_mappings or {}) and
+            self.queued_at is not None and
+            datetime.datetime.utcnow() - self.queued_at < INDEX_TASK_TIMEOUT)
+
+
+def index_key(project_key):
+  return ndb.Key(FeedIndex, INDEX_ID, parent=project_key)
+
+
+class CountingLines(object):
+  # Passes lines through, keeping count of the bytes read so far.
+
+  def __init__(self, lines_iterator):
+    self.lines = lines_iterator
+    self.offset = 0
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    line = next(self.lines)
+    self.offset += len(line)
+    return line
+
+
+def value_stats(counts):
+  top = sorted(counts.iteritems(), key=lambda item: item[1], reverse=True)
+  return {
+      'distinct': len(counts),
+      'top': [[value, count] for value, count in top[:TOP_VALUES]]
+  }
+
+
+def skip_bytes(chunks, count):
+  # Compressed feeds can't be seeked, the bytes before an offset are
+  # decompressed and dropped without being split into lines or parsed.
+  for chunk in chunks:
+    if count >= len(chunk):
+      count -= len(chunk)
+      continue
+    yield chunk[count:]
+    count = 0
+
+
+def gzip_chunks(reader):
+  # Decompresses as it reads, including feeds made of several gzip members.
+  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  while True:
+    data = reader.read(READ_SIZE)
+    if not data:
+      break
+    while data:
+      yield decompressor.decompress(data)
+      data = decompressor.unused_data
+      if data:
+        yield decompressor.flush()
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  yield decompressor.flush()
+
+
+def file_chunks(reader):
+  while True:
+    data = reader.read(READ_SIZE)
+    if not data:
+      break
+    yield data
+
+
+def zip_member(archive):
+  for info in archive.infolist():
+    if not info.filename.endswith('/') and not info.filename.startswith(
+        '__MACOSX/'):
+      return info
+  raise ValueError('The feed archive is empty!')
+
+
+def lines(chunks):
+  pending = ''
+  for chunk in chunks:
+    pending += chunk
+    split = pending.split('\n')
+    pending = split.pop()
+    for line in split:
+      yield line + '\n'
+  if pending:
+    yield pending
+
+
+def strip_bom(lines_iterator):
+  first = True
+  for line in lines_iterator:
+    if first:
+      first = False
+      if line.startswith(codecs.BOM_UTF8):
+        line = line[len(codecs.BOM_UTF8):]
+    yield line
+
+
+def as_text(value):
+  if value is None:
+    return ''
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  if isinstance(value, bool):
+    return 'Yes' if value else 'No'
+  return str(value)
+
+
+def json_records(lines_iterator):
+  for number, line in enumerate(lines_iterator, 1):
+    if not line.strip():
+      continue
+    try:
+      record = json.loads(line)
+    except ValueError:
+      raise ValueError('Line %d of the feed is not valid JSON!' % number)
+    if not isinstance(record, dict):
+      raise ValueError('Line %d of the feed is not a JSON object!' % number)
+    yield dict((as_text(k), as_text(v)) for k, v in record.iteritems())
+
+
+def csv_records(lines_iterator):
+  # Like JSON Lines records, a column the feed doesn't have reads as empty.
+  return DictReader(lines_iterator, restval='')
+
+
+class Feed(object):
+  # Reads a feed blob as a stream of rows keyed by feed field. Plain,
+  # gzip or zip compressed CSV and JSON Lines are supported; every call
+  # to rows() reads the blob again from the start, page() starts from the
+  # nearest row in the feed's index.
+
+  def __init__(self, blob_key, column_overrides=None):
+    self.blob_key = blob_key
+    self.overrides = column_overrides or {}
+    self.mappings = column_mappings(column_overrides)
+    info = blobstore.BlobInfo.get(blob_key)
+    self.filename = (info.filename or '').lower() if info else ''
+
+  def chunks(self, offset=0):
+    # Returns the name of the file the rows are in and the chunks of its
+    # content from the given offset.
+    reader = blobstore.BlobReader(self.blob_key, buffer_size=READ_SIZE)
+    magic = reader.read(4)
+    reader.seek(0)
+
+    if magic.startswith(GZIP_MAGIC):
+      filename = self.filename.rsplit('.gz', 1)[0]
+      return filename, skip_bytes(gzip_chunks(reader), offset)
+
+    if magic == ZIP_MAGIC:
+      archive = zipfile.ZipFile(reader)
+      info = zip_member(archive)
+      member_chunks = file_chunks(archive.open(info))
+      return info.filename.lower(), skip_bytes(member_chunks, offset)
+
+    reader.seek(offset)
+    return self.filename, file_chunks(reader)
+
+  def records(self):
+    filename, chunks = self.chunks()
+    feed_lines = strip_bom(lines(chunks))
+    if filename.endswith(JSON_LINES_EXTENSIONS):
+      return json_records(feed_lines)
+    return csv_records(feed_lines)
+
+  def row(self, record):
+    return dict((field, record.get(column) or '')
+                for field, column in self.mappings.iteritems())
+
+  def rows(self):
+    for record in self.records():
+      yield self.row(record)
+
+  def count(self):
+    # Counts lines rather than parsing them, quoted line breaks in CSV
+    # feeds make this an estimate.
+    filename, chunks = self.chunks()
+    count = sum(1 for line in lines(chunks) if line.strip())
+    if filename.endswith(JSON_LINES_EXTENSIONS):
+      return count
+    return max(0, count - 1)
+
+  def index(self, project_key):
+    # Parses the whole feed once, noting where rows start and counting the
+    # values of STATS_FIELDS. A feed that can't be parsed gets an index
+    # with the error instead.
+    feed_index = FeedIndex(
+        key=index_key(project_key),
+        feed=self.blob_key,
+        column_mappings=self.overrides)
+
+    counts = dict((field, {}) for field in STATS_FIELDS)
+    offsets = []
+    row_count = 0
+    try:
+      filename, chunks = self.chunks()
+      counted = CountingLines(lines(chunks))
+      feed_lines = strip_bom(counted)
+      if filename.endswith(JSON_LINES_EXTENSIONS):
+        records = json_records(feed_lines)
+      else:
+        records = csv_records(feed_lines)
+        feed_index.fieldnames = records.fieldnames
+
+      # Records are read a line at a time, so the offset after one record
+      # is where the next one starts.
+      offset = counted.offset
+      for record in records:
+        if row_count % INDEX_INTERVAL == 0:
+          offsets.append(offset)
+        row = self.row(record)
+        for field, values in counts.iteritems():
+          values[row[field]] = values.get(row[field], 0) + 1
+        row_count += 1
+        offset = counted.offset
+    except (ValueError, csv.Error, zipfile.BadZipfile, zlib.error), e:
+      feed_index.error = str(e)
+
+    feed_index.offsets = offsets
+    feed_index.row_count = row_count
+    feed_index.stats = dict((name, value_stats(counts[field]))
+                            for field, name in STATS_FIELDS.iteritems())
+    feed_index.put()
+    return feed_index
+
+  def page(self, feed_index, start, size):
+    # Seeks to the indexed row nearest before start and parses from there.
+    block = start // INDEX_INTERVAL
+    if block >= len(feed_index.offsets):
+      return []
+
+    offset = feed_index.offsets[block]
+    filename, chunks = self.chunks(offset)
+    feed_lines = lines(chunks)
+    # Only the first JSON Lines block starts at the top of the feed, CSV
+    # blocks all start after the header.
+    if offset == 0:
+      feed_lines = strip_bom(feed_lines)
+    if filename.endswith(JSON_LINES_EXTENSIONS):
+      records = json_records(feed_lines)
+    else:
+      records = DictReader(
+          feed_lines, fieldnames=feed_index.fieldnames, restval='')
+
+    skip = start - block * INDEX_INTERVAL
+    return [
+        self.row(record)
+        for record in itertools.islice(records, skip, skip + size)
+    ]
@@ -182,6 +182,13 @@ App.controller("ProjectsController", function(
         }
       }
       $mdToast.hide();
+    }, function(response) {
+      $mdToast.show(
+        $mdToast.simple().textContent(
+          "Project " + project.id + " can't be deleted while it has a run " +
+            "in progress, cancel it first."
+        )
+      );
     });
   };
 });
@@ -285,6 +292,10 @@ App.controller("EditProjectController", function(
       .get("/api/projects/" + $scope.project.id + "/status")
       .then(function(response) {
         $scope.status = response.data.status;
+        $scope.queuePosition = response.data.queuePosition;
+        $scope.eta = response.data.eta;
+        $scope.progress = response.data.progress;
+        $scope.failedRows = response.data.failedRows;
 
         if ($scope.retries < MAX_RETRIES) {
           nextLoad();
@@ -317,20 +328,21 @@ App.controller("EditProjectController", function(
   });
 
   $scope.feedUploader.filters.push({
-    name: "csvFilter",
+    name: "feedFilter",
     fn: function(item, options) {
-      if (item.type == "text/csv") {
-        return true;
-      } else {
-        return false;
-      }
+      return (
+        item.type == "text/csv" ||
+        /\.(csv|gz|zip|jsonl|ndjson|json)$/i.test(item.name)
+      );
     }
   });
 
   $scope.feedUploader.onWhenAddingFileFailed = function(item, filter, options) {
-    if (filter.name == "csvFilter") {
+    if (filter.name == "feedFilter") {
       $mdToast.show(
-        $mdToast.simple().textContent("The feed needs to be a CSV!")
+        $mdToast
+          .simple()
+          .textContent("The feed needs to be a CSV or JSON Lines file!")
       );
     }
   };
@@ -339,6 +351,25 @@ App.controller("EditProjectController", function(
     $route.reload();
   };
 
+  $scope.assets = [];
+
+  $scope.loadAssets = function(cursor) {
+    $http
+      .get("/api/projects/" + $scope.project.id + "/assets", {
+        params: { ac: cursor }
+      })
+      .then(function(response) {
+        $scope.assets = cursor
+          ? $scope.assets.concat(response.data.entities)
+          : response.data.entities;
+        $scope.assetsCursor = response.data.hasNext
+          ? response.data.nextCursor
+          : null;
+      });
+  };
+
+  $scope.loadAssets();
+
   $scope.assetsUploader = new FileUploader({
     autoUpload: true,
     removeAfterUpload: true
@@ -365,12 +396,59 @@ App.controller("EditProjectController", function(
     $route.reload();
   };
 
-  $scope.startRun = function() {
+  $scope.archiveUploader = new FileUploader({
+    autoUpload: true,
+    removeAfterUpload: true,
+    queueLimit: 1
+  });
+
+  $scope.originalArchiveUploadItemFn = $scope.archiveUploader.uploadItem;
+
+  $scope.archiveUploader.uploadItem = function() {
+    var t = this;
+    var args = arguments;
+    $http
+      .get("/api/projects/" + $scope.project.id + "/asset_archive_upload_url")
+      .then(function(response) {
+        $scope.archiveUploader.onBeforeUploadItem = function(item) {
+          item.url = response.data.uploadUrl;
+        };
+      })
+      .then(function() {
+        $scope.originalArchiveUploadItemFn.apply(t, args);
+      });
+  };
+
+  $scope.archiveUploader.onCompleteAll = function() {
+    $mdToast.show(
+      $mdToast
+        .simple()
+        .textContent("Expanding archive, assets will appear shortly...")
+    );
+  };
+
+  $scope.profileRun = false;
+  $scope.isolateFailures = false;
+
+  $http.get("/api/projects/" + $scope.project.id + "/profile").then(
+    function(response) {
+      $scope.profile = response.data;
+    },
+    function() {
+      $scope.profile = null;
+    }
+  );
+
+  $scope.startRun = function(retryFailed) {
     $scope.retries = 0;
     $http
-      .post("/api/projects/" + $scope.project.id + "/run")
+      .post("/api/projects/" + $scope.project.id + "/run", {
+        profile: $scope.profileRun,
+        isolateFailures: $scope.isolateFailures,
+        retryFailed: !!retryFailed
+      })
       .then(function(response) {
-        $scope.status = "RUNNING";
+        $scope.status = "QUEUED";
         checkStatus();
 
         $mdToast
@@ -399,26 +477,115 @@ App.controller("EditProjectController", function(
       });
   };
 
+  var rollbackPromise;
+
+  var checkRollback = function() {
+    $http.get("/api/projects/" + $scope.project.id + "/rollback").then(
+      function(response) {
+        $scope.rollback = response.data;
+        if (!response.data.completed) {
+          rollbackPromise = $timeout(checkRollback, RETRY_TIMEOUT);
+        }
+      },
+      function() {
+        $scope.rollback = null;
+      }
+    );
+  };
+
+  checkRollback();
+
+  $scope.$on("$destroy", function() {
+    $timeout.cancel(rollbackPromise);
+  });
+
+  $scope.rollBack = function($event) {
+    var confirm = $mdDialog
+      .confirm()
+      .title("Roll back the last run?")
+      .textContent(
+        "Its ads will be deactivated and its creatives, placements and campaigns archived."
+      )
+      .targetEvent($event)
+      .ok("Roll back")
+      .cancel("Cancel");
+
+    $mdDialog.show(confirm).then(
+      function() {
+        $http.post("/api/projects/" + $scope.project.id + "/rollback").then(
+          function(response) {
+            $scope.rollback = response.data;
+            $timeout.cancel(rollbackPromise);
+            rollbackPromise = $timeout(checkRollback, RETRY_TIMEOUT);
+
+            $mdToast.show($mdToast.simple().textContent("Rolling back..."));
+          },
+          function(failure) {
+            $mdToast.show(
+              $mdToast
+                .simple()
+                .textContent("The last run has nothing to roll back.")
+            );
+          }
+        );
+      },
+      function() {
+        // Do nothing.
+      }
+    );
+  };
+
+  $scope.downloadProfile = function() {
+    $window.open(
+      "/api/projects/" + $scope.project.id + "/profile/download",
+      "_blank"
+    );
+  };
+
   $scope.downloadFeed = function() {
     if ($scope.clonedProject.feed) {
       $window.open("/api/projects/" + $scope.project.id + "/feed", "_blank");
     }
   };
 
+  $scope.feedPreview = null;
+
+  $scope.previewFeed = function(page) {
+    $http
+      .get("/api/projects/" + $scope.project.id + "/feed/preview", {
+        params: { page: page }
+      })
+      .then(function(response) {
+        if (response.data.indexing) {
+          $scope.feedPreviewIndexing = true;
+          $timeout(function() {
+            $scope.previewFeed(page);
+          }, RETRY_TIMEOUT);
+          return;
+        }
+
+        $scope.feedPreviewIndexing = false;
+        $scope.feedPreview = response.data;
+        $scope.feedPreviewFields = Object.keys(response.data.columns).sort();
+        $scope.feedPreviewPages = Math.ceil(
+          response.data.rowCount / response.data.pageSize
+        );
+      });
+  };
+
   $scope.removeFeed = function() {
     $scope.clonedProject.feed = "";
     $scope.update();
   };
 
   $scope.removeAsset = function(asset) {
-    for (var i = 0; i < $scope.clonedProject.assets.length; i++) {
-      if ($scope.clonedProject.assets[i]["key"] == asset["key"]) {
-        $scope.clonedProject.assets.splice(i, 1);
-        break;
-      }
-    }
-
-    $scope.update();
+    $http
+      .delete("/api/projects/" + $scope.project.id + "/assets", {
+        params: { filename: asset.filename }
+      })
+      .then(function() {
+        $scope.loadAssets();
+      });
   };
 
   $scope.showSheetsDialog = function($event) {
@@ -515,11 +682,22 @@ App.controller("EditProjectController", function(
     $mdToast.show($mdToast.simple().textContent("Updating..."));
     $http
       .put("/api/projects/" + $scope.project.id, $scope.clonedProject)
-      .then(function(response) {
-        $mdToast.hide().then(function() {
-          $route.reload();
-        });
-      });
+      .then(
+        function(response) {
+          $mdToast.hide().then(function() {
+            $route.reload();
+          });
+        },
+        function(failure) {
+          $mdToast.show(
+            $mdToast
+              .simple()
+              .textContent(
+                "Something went wrong! Check the time zone and assets folder."
+              )
+          );
+        }
+      );
   };
 
   $scope.log = function() {
@@ -12,37 +12,40 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asset_archive
 import base64
 import json
 import model
 import os
+import progress
+import rollback
+import schedule
+import scheduler
+import time
+import versions
 import webapp2
-from oauth2client import client
 from google.appengine.api import users
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.ext.webapp import template
 
+UPLOAD_URL_LIFETIME = 10 * 60
 
-def project_logger_as_dict(project_logger):
-  project_logger_id = project_logger.key.id()
 
+def project_logger_as_dict(project_logger, project):
   return {
-      'id': project_logger_id,
-      'projectId': project_logger.project.id(),
-      'projectName': project_logger.project.get().name,
-      'severity': str(project_logger.severity),
-      'message': project_logger.message,
-      'createdAt': project_logger.created_at.isoformat() + 'Z',
-      'updatedAt': project_logger.updated_at.isoformat() + 'Z'
+      'id': project_logger['id'],
+      'projectId': project.key.id(),
+      'projectName': project.name,
+      'runId': project_logger['runId'],
+      'severity': str(project_logger['severity']),
+      'message': project_logger['message'],
+      'createdAt': project_logger['createdAt'] + 'Z',
+      'updatedAt': project_logger['createdAt'] + 'Z'
   }
 
 def as_dict(project):
   project_id = project.key.id()
-  assets = [{
-      'key': str(a),
-      'filename': blobstore.get(a).filename
-  } for a in project.assets]
   if project.feed:
     feed = {
         'key': str(project.feed),
@@ -56,6 +59,10 @@ def as_dict(project):
       'profileId': project.profile_id,
       'sheetsFeedUrl': project.sheets_feed_url,
       'notes': project.notes,
+      'timezone': project.timezone,
+      'advertiserTimezones': project.advertiser_timezones or {},
+      'columnMappings': project.column_mappings or {},
+      'assetsUrl': project.assets_url,
       'feedUploadUrl':
           blobstore.create_upload_url('/api/projects/' + str(project_id) +
                                       '/feed'),
@@ -68,17 +75,80 @@ def as_dict(project):
           project.last_completed_at.isoformat() + 'Z'
           if project.last_completed_at else None,
       'status': str(project.status),
-      'assets': assets,
       'feed': feed
   }
 
 
+def asset_as_dict(asset):
+  return {
+      'id': asset.key.id(),
+      'filename': asset.filename,
+      'size': asset.size
+  }
+
+
+def project_deletion_as_dict(deletion):
+  return {
+      'id': deletion.key.id(),
+      'phase': str(deletion.phase),
+      'entitiesDeleted': deletion.entities_deleted,
+      'blobsDeleted': deletion.blobs_deleted,
+      'blobsKept': deletion.blobs_kept,
+      'blobsRemaining': len(deletion.blobs),
+      'createdAt': deletion.created_at.isoformat() + 'Z',
+      'updatedAt': deletion.updated_at.isoformat() + 'Z',
+      'completedAt':
+          deletion.completed_at.isoformat() + 'Z'
+          if deletion.completed_at else None
+  }
+
+
+def project_status_as_dict(project):
+  status = {'status': str(project.status)}
+
+  run = project.current_run.get() if project.current_run else None
+  if run and run.status == model.ProjectStatus.QUEUED:
+    status['queuePosition'] = run.queue_position
+    status['eta'] = run.eta.isoformat() + 'Z' if run.eta else None
+  elif run:
+    status['progress'] = progress.run_progress(run)
+    status['failedRows'] = run.failed_rows
+
+  return status
+
+
 class ApiHandler(webapp2.RequestHandler):
 
   def as_json(self, data):
     self.response.headers['Content-Type'] = 'application/json'
     self.response.write(json.dumps(data))
 
+  def not_modified(self, markers, *extra):
+    # Sets validators for a response built from data the version markers
+    # stand for, and answers 304 if the client's copy is still current.
+    # Clients always revalidate, the markers change with the data.
+    if markers is None:
+      return False
+
+    etag = versions.etag(markers, *extra)
+    last_modified = versions.last_modified(markers)
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.headers['ETag'] = '"%s"' % etag
+    if last_modified:
+      self.response.last_modified = last_modified
+
+    if self.request.if_none_match:
+      current = etag in self.request.if_none_match
+    elif last_modified and self.request.if_modified_since:
+      current = last_modified <= self.request.if_modified_since.replace(
+          tzinfo=None)
+    else:
+      current = False
+
+    if current:
+      self.response.status_int = 304
+    return current
+
 
 class SettingsHandler(ApiHandler):
 
@@ -112,6 +182,8 @@ class ProjectsHandler(ApiHandler):
 class ProjectHandler(ApiHandler):
 
   def post(self):
+    from oauth2client import client
+
     data = json.loads(self.request.body)
     settings = model.show_settings()
     config = json.loads(settings.config)
@@ -130,28 +202,57 @@ class ProjectHandler(ApiHandler):
 
   def get(self, project_id):
     project_id = int(project_id)
+    # The feed upload URL in the response is only handed out for so long.
+    if self.not_modified(
+        model.project_versions(project_id, versions.PROJECT),
+        str(int(time.time() // UPLOAD_URL_LIFETIME))):
+      return
     project = model.show_project(project_id)
     self.as_json(as_dict(project))
 
   def put(self, project_id):
     project_id = int(project_id)
     data = json.loads(self.request.body)
-    project = model.update_project(project_id, data['name'], data['profileId'],
-                                   data['feed'], data['assets'],
-                                   data['sheetsFeedUrl'], data['notes'])
+    try:
+      project = model.update_project(project_id, data['name'],
+                                     data['profileId'], data['feed'],
+                                     data['sheetsFeedUrl'],
+                                     data['notes'], data.get('timezone'),
+                                     data.get('advertiserTimezones'),
+                                     data.get('assetsUrl'),
+                                     data.get('columnMappings'))
+    except ValueError, e:
+      self.abort(400, detail=str(e))
     self.as_json(as_dict(project))
 
   def delete(self, project_id):
     project_id = int(project_id)
-    model.destroy_project(project_id)
+    try:
+      deletion = model.destroy_project(project_id)
+    except ValueError, e:
+      self.abort(400, detail=str(e))
+    self.as_json(project_deletion_as_dict(deletion))
 
 
 class ProjectStatusHandler(ApiHandler):
 
   def get(self, project_id):
     project_id = int(project_id)
+    if self.not_modified(model.project_versions(project_id, versions.STATUS)):
+      return
     project = model.show_project(project_id)
-    self.as_json({'status': str(project.status)})
+    if project:
+      self.as_json(project_status_as_dict(project))
+      return
+
+    deletion = model.show_project_deletion(project_id)
+    if not deletion:
+      self.abort(404)
+
+    self.as_json({
+        'status': 'DELETING',
+        'deletion': project_deletion_as_dict(deletion)
+    })
 
 
 class ProjectLoggersHandler(ApiHandler):
@@ -159,11 +260,62 @@ class ProjectLoggersHandler(ApiHandler):
   def get(self, project_id):
     cursor = self.request.get('lc')
     project_id = int(project_id)
+    if self.not_modified(
+        model.project_versions(project_id, versions.LOG, versions.PROJECT)):
+      return
     project_loggers = model.project_loggers(project_id, cursor)
-    project_loggers['entities'] = [project_logger_as_dict(project_logger) for project_logger in project_loggers['entities']]
+    project = project_loggers.pop('project')
+    project_loggers['entities'] = [project_logger_as_dict(project_logger, project) for project_logger in project_loggers['entities']]
     self.as_json(project_loggers)
 
 
+class CompactLogsHandler(webapp2.RequestHandler):
+
+  def get(self):
+    if 'X-Appengine-Cron' not in self.request.headers:
+      self.abort(403)
+
+    model.compact_project_runs()
+    model.compact_activity_runs()
+
+
+class MigrateLogsHandler(webapp2.RequestHandler):
+
+  def get(self):
+    if 'X-Appengine-Cron' not in self.request.headers:
+      self.abort(403)
+
+    model.migrate_all_project_logs()
+
+
+class MigrateAssetsHandler(webapp2.RequestHandler):
+
+  def get(self):
+    if 'X-Appengine-Cron' not in self.request.headers:
+      self.abort(403)
+
+    model.migrate_all_project_assets()
+
+
+class ScheduleRunsHandler(webapp2.RequestHandler):
+
+  def get(self):
+    if 'X-Appengine-Cron' not in self.request.headers:
+      self.abort(403)
+
+    scheduler.schedule()
+
+
+class WarmupHandler(webapp2.RequestHandler):
+
+  def get(self):
+    import dcm_dao
+
+    dcm_dao.warm_up()
+    schedule.timezone(schedule.DEFAULT_TIMEZONE)
+    model.show_settings()
+
+
 class ProjectFeedUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
 
   def post(self, project_id):
@@ -187,6 +339,52 @@ class ProjectFeedDownloadHandler(blobstore_handlers.BlobstoreDownloadHandler):
       self.send_blob(project_feed_info, save_as=True)
 
 
+class ProjectFeedPreviewHandler(ApiHandler):
+
+  def get(self, project_id):
+    project_id = int(project_id)
+    try:
+      preview = model.project_feed_preview(
+          project_id, int(self.request.get('page') or 0),
+          int(self.request.get('pageSize') or 0))
+    except ValueError, e:
+      self.abort(400, detail=str(e))
+
+    if preview is None:
+      self.response.set_status(202)
+      preview = {'indexing': True}
+    self.as_json(preview)
+
+
+class ProjectProfileHandler(ApiHandler):
+
+  def get(self, project_id):
+    run_profile = model.latest_project_profile(int(project_id))
+    if not run_profile:
+      self.abort(404)
+
+    summary = dict(run_profile.summary)
+    summary['runId'] = run_profile.key.parent().id()
+    summary['createdAt'] = run_profile.created_at.isoformat() + 'Z'
+    self.as_json(summary)
+
+
+class ProjectProfileDownloadHandler(
+    blobstore_handlers.BlobstoreDownloadHandler):
+
+  def get(self, project_id):
+    run_profile = model.latest_project_profile(int(project_id))
+    if not run_profile:
+      self.abort(404)
+
+    filename = 'project-%s-run-%s-profile.zip' % (project_id,
+                                                  run_profile.key.parent().id())
+    self.send_blob(
+        run_profile.archive_blob,
+        content_type='application/zip',
+        save_as=filename)
+
+
 class ProjectAssetUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
 
   def post(self, project_id):
@@ -197,6 +395,55 @@ class ProjectAssetUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
     self.response.write('{}')
 
 
+class ProjectAssetsHandler(ApiHandler):
+
+  def get(self, project_id):
+    # Adding or removing assets touches the project.
+    if self.not_modified(
+        model.project_versions(int(project_id), versions.PROJECT)):
+      return
+    assets = model.project_assets(
+        int(project_id), self.request.get('ac'),
+        int(self.request.get('pageSize') or 0))
+    assets['entities'] = [asset_as_dict(a) for a in assets['entities']]
+    self.as_json(assets)
+
+  def delete(self, project_id):
+    project = model.remove_project_asset(
+        int(project_id), self.request.get('filename'))
+    if not project:
+      self.abort(404)
+    self.as_json({})
+
+
+class ProjectAssetArchiveUploadHandler(
+    blobstore_handlers.BlobstoreUploadHandler):
+
+  def post(self, project_id):
+    project_id = int(project_id)
+    upload = self.get_uploads()[0]
+    asset_archive.expand_later(project_id, upload.key())
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write('{}')
+
+
+class ProjectAssetArchiveMemberHandler(
+    blobstore_handlers.BlobstoreUploadHandler):
+
+  def post(self, project_id):
+    upload = self.get_uploads()[0]
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps({'key': str(upload.key())}))
+
+
+class ProjectAssetArchiveUploadUrlHandler(ApiHandler):
+
+  def get(self, project_id):
+    upload_url = blobstore.create_upload_url('/api/projects/' + project_id +
+                                             '/asset_archive')
+    self.as_json({'uploadUrl': upload_url})
+
+
 class ProjectAssetUploadUrlHandler(ApiHandler):
 
   def get(self, project_id):
@@ -209,7 +456,14 @@ class ProjectRunHandler(ApiHandler):
 
   def post(self, project_id):
     project_id = int(project_id)
-    model.start_project_run(project_id)
+    data = json.loads(self.request.body or '{}')
+    try:
+      model.start_project_run(
+          project_id, int(data.get('priority', scheduler.DEFAULT_PRIORITY)),
+          bool(data.get('profile')), bool(data.get('isolateFailures')),
+          bool(data.get('retryFailed')))
+    except ValueError, e:
+      self.abort(400, detail=str(e))
     self.as_json({})
 
   def delete(self, project_id):
@@ -218,6 +472,22 @@ class ProjectRunHandler(ApiHandler):
     self.as_json({})
 
 
+class ProjectRollbackHandler(ApiHandler):
+
+  def get(self, project_id):
+    run_rollback = model.show_run_rollback(int(project_id))
+    if not run_rollback:
+      self.abort(404)
+    self.as_json(rollback.rollback_progress(run_rollback))
+
+  def post(self, project_id):
+    try:
+      run_rollback = model.start_run_rollback(int(project_id))
+    except ValueError, e:
+      self.abort(400, detail=str(e))
+    self.as_json(rollback.rollback_progress(run_rollback))
+
+
 def check_auth(auth, stored_username, stored_password):
   encoded_auth = auth[1]
   username_colon_pass = base64.b64decode(encoded_auth)
@@ -287,6 +557,22 @@ app = webapp2.WSGIApplication(
             r'/api/projects/<project_id>/run',
             handler=ProjectRunHandler,
             methods=['DELETE']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/rollback',
+            handler=ProjectRollbackHandler,
+            methods=['GET']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/rollback',
+            handler=ProjectRollbackHandler,
+            methods=['POST']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/profile',
+            handler=ProjectProfileHandler,
+            methods=['GET']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/profile/download',
+            handler=ProjectProfileDownloadHandler,
+            methods=['GET']),
         webapp2.Route(
             r'/api/projects/<project_id>/feed',
             handler=ProjectFeedDownloadHandler,
@@ -295,13 +581,55 @@ app = webapp2.WSGIApplication(
             r'/api/projects/<project_id>/feed',
             handler=ProjectFeedUploadHandler,
             methods=['POST']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/feed/preview',
+            handler=ProjectFeedPreviewHandler,
+            methods=['GET']),
         webapp2.Route(
             r'/api/projects/<project_id>/asset',
             handler=ProjectAssetUploadHandler,
             methods=['POST']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/assets',
+            handler=ProjectAssetsHandler,
+            methods=['GET']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/assets',
+            handler=ProjectAssetsHandler,
+            methods=['DELETE']),
         webapp2.Route(
             r'/api/projects/<project_id>/asset_upload_url',
             handler=ProjectAssetUploadUrlHandler,
-            methods=['GET'])
+            methods=['GET']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/asset_archive',
+            handler=ProjectAssetArchiveUploadHandler,
+            methods=['POST']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/asset_archive/member',
+            handler=ProjectAssetArchiveMemberHandler,
+            methods=['POST']),
+        webapp2.Route(
+            r'/api/projects/<project_id>/asset_archive_upload_url',
+            handler=ProjectAssetArchiveUploadUrlHandler,
+            methods=['GET']),
+        webapp2.Route(
+            r'/api/tasks/compact_logs',
+            handler=CompactLogsHandler,
+            methods=['GET']),
+        webapp2.Route(
+            r'/api/tasks/migrate_logs',
+            handler=MigrateLogsHandler,
+            methods=['GET']),
+        webapp2.Route(
+            r'/api/tasks/migrate_assets',
+            handler=MigrateAssetsHandler,
+            methods=['GET']),
+        webapp2.Route(
+            r'/api/tasks/schedule_runs',
+            handler=ScheduleRunsHandler,
+            methods=['GET']),
+        webapp2.Route(
+            r'/_ah/warmup', handler=WarmupHandler, methods=['GET'])
     ],
     debug=True)
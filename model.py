@@ -12,19 +12,51 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from dcm_dao import DCMDAO
-from dcm_job import DCMJob
+from cancellation import CancellationToken
+from cancellation import RunCancelled
+from cancellation import request_cancellation
+from failures import DeadLetters
+from failures import failed_row_phases
 from google.appengine.ext import blobstore
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 from google.appengine.datastore.datastore_query import Cursor
+from profiling import ProjectRunProfile
+from profiling import RunProfiler
+from progress import RunProgress
+from rollback import Rollback
+from rollback import new_rollback
+from rollback import rollback_key
 from protorpc import messages
+import feeds
+import schedule
+import scheduler
+import storage
 import datetime
 import time
 import traceback
+import versions
+import zipfile
+import zlib
 
 PER_PAGE = 10
+ASSETS_PER_PAGE = 50
+MAX_ASSETS_PER_PAGE = 500
+ASSET_MIGRATION_BATCH_SIZE = 20
+FEED_PREVIEW_PAGE_SIZE = 50
+MAX_FEED_PREVIEW_PAGE_SIZE = 500
+LOG_CHUNK_SIZE = 500
+LOG_ENTRIES_PER_PAGE = 50
+LOG_FLUSH_SIZE = 50
+LOG_FLUSH_INTERVAL = 10
+LOG_RETENTION_DAYS = 30
+ACTIVITY_RUN_ID = 'activity'
+LEGACY_RUN_ID = 'legacy'
+LOG_MIGRATION_CHUNKS_PER_TASK = 10
+COMPACTION_BATCH_SIZE = 20
+DELETION_BATCH_SIZE = 500
+DELETION_BATCHES_PER_TASK = 10
 
 
 class Settings(ndb.Model):
@@ -44,7 +76,65 @@ class ProjectLoggerSeverity(messages.Enum):
   TRACE = 666
 
 
-class ProjectLogger(ndb.Model):
+class ProjectStatus(messages.Enum):
+  INITIALIZED = 111
+  QUEUED = 222
+  RUNNING = 333
+  CANCELLED = 444
+  ERROR = 666
+  COMPLETED = 999
+
+
+class ProjectRun(ndb.Model):
+  status = msgprop.EnumProperty(
+      ProjectStatus, required=True, default=ProjectStatus.INITIALIZED)
+  profile_id = ndb.StringProperty()
+  priority = ndb.IntegerProperty(default=scheduler.DEFAULT_PRIORITY)
+  estimated_rows = ndb.IntegerProperty(indexed=False)
+  queue_position = ndb.IntegerProperty(indexed=False)
+  eta = ndb.DateTimeProperty(indexed=False)
+  chunk_count = ndb.IntegerProperty(default=0, indexed=False)
+  cancel_requested = ndb.BooleanProperty(default=False, indexed=False)
+  profile = ndb.BooleanProperty(default=False, indexed=False)
+  # Runs that isolate failures record failed rows as FailedRow children and
+  # carry on. A retry run only reads the rows that failed in retry_of, and
+  # tags what it creates like tag_run, the run that first tried them.
+  isolate_failures = ndb.BooleanProperty(default=False, indexed=False)
+  failed_rows = ndb.IntegerProperty(default=0, indexed=False)
+  retry_of = ndb.KeyProperty(kind='ProjectRun', indexed=False)
+  tag_run = ndb.KeyProperty(kind='ProjectRun', indexed=False)
+  feed = ndb.BlobKeyProperty(indexed=False)
+  created = ndb.JsonProperty(compressed=True)
+  compacted = ndb.BooleanProperty(default=False)
+  created_at = ndb.DateTimeProperty(auto_now_add=True)
+  updated_at = ndb.DateTimeProperty(auto_now_add=True)
+  admitted_at = ndb.DateTimeProperty(indexed=False)
+  completed_at = ndb.DateTimeProperty()
+
+  def _post_put_hook(self, future):
+    versions.changed(self.key.root(),
+                     {versions.STATUS: versions.fresh_marker()})
+
+
+class ProjectLogChunk(ndb.Model):
+  # Each entry is a [severity number, ISO timestamp, message] triple.
+  entries = ndb.JsonProperty(compressed=True)
+  created_at = ndb.DateTimeProperty(auto_now_add=True)
+  updated_at = ndb.DateTimeProperty(auto_now_add=True)
+
+  def _post_put_hook(self, future):
+    versions.changed(self.key.root(),
+                     {versions.LOG: versions.log_marker(self.key,
+                                                        self.updated_at)})
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    versions.changed(key.root(), {versions.LOG: versions.fresh_marker()})
+
+
+class LegacyProjectLog(ndb.Model):
+  # A log line as stored before logs were kept in chunks, a root entity of
+  # its own that only refers to its project.
   project = ndb.KeyProperty()
   message = ndb.TextProperty()
   severity = msgprop.EnumProperty(
@@ -52,15 +142,70 @@ class ProjectLogger(ndb.Model):
   created_at = ndb.DateTimeProperty(auto_now_add=True)
   updated_at = ndb.DateTimeProperty(auto_now_add=True)
 
+  @classmethod
+  def _get_kind(cls):
+    return 'ProjectLogger'
 
-class ProjectStatus(messages.Enum):
-  INITIALIZED = 111
-  RUNNING = 333
-  CANCELLED = 444
-  ERROR = 666
+
+class ProjectLogger(object):
+
+  def __init__(self, run_key, chunk_count=0):
+    self.run_key = run_key
+    self.chunk = None
+    self.chunk_count = chunk_count
+    self.pending = 0
+    self.flushed_at = time.time()
+
+  def log(self, message, severity=ProjectLoggerSeverity.INFO):
+    if self.chunk is None or len(self.chunk.entries) >= LOG_CHUNK_SIZE:
+      self.flush()
+      self.chunk_count += 1
+      self.chunk = ProjectLogChunk(
+          parent=self.run_key, id=self.chunk_count, entries=[])
+
+    self.chunk.entries.append(log_entry(message, severity))
+    self.pending += 1
+
+    if (self.pending >= LOG_FLUSH_SIZE or
+        time.time() - self.flushed_at >= LOG_FLUSH_INTERVAL):
+      self.flush()
+
+  def flush(self):
+    if self.pending:
+      self.chunk.updated_at = datetime.datetime.utcnow()
+      self.chunk.put()
+      self.pending = 0
+    self.flushed_at = time.time()
+
+
+class ProjectDeletionPhase(messages.Enum):
+  ENTITIES = 111
+  BLOBS = 222
+  LEGACY_LOGS = 333
   COMPLETED = 999
 
 
+class ProjectDeletion(ndb.Model):
+  phase = msgprop.EnumProperty(
+      ProjectDeletionPhase,
+      required=True,
+      default=ProjectDeletionPhase.ENTITIES)
+  cursor = ndb.StringProperty(indexed=False)
+  # The project's own blobs, those of its descendants go with them.
+  blobs = ndb.BlobKeyProperty(repeated=True, indexed=False)
+  entities_deleted = ndb.IntegerProperty(default=0, indexed=False)
+  blobs_deleted = ndb.IntegerProperty(default=0, indexed=False)
+  blobs_kept = ndb.IntegerProperty(default=0, indexed=False)
+  created_at = ndb.DateTimeProperty(auto_now_add=True)
+  updated_at = ndb.DateTimeProperty(auto_now_add=True)
+  completed_at = ndb.DateTimeProperty()
+
+  def _post_put_hook(self, future):
+    versions.changed(
+        ndb.Key('Project', self.key.id()),
+        {versions.STATUS: versions.fresh_marker()})
+
+
 class Project(ndb.Model):
   name = ndb.StringProperty()
   credentials = ndb.JsonProperty()
@@ -70,11 +215,73 @@ class Project(ndb.Model):
       ProjectStatus, required=True, default=ProjectStatus.INITIALIZED)
   feed = ndb.BlobKeyProperty()
   sheets_feed_url = ndb.StringProperty()
-  assets = ndb.BlobKeyProperty(repeated=True)
+  # Assets used to be listed here, they are now ProjectAsset children and
+  # this is emptied by migrate_project_assets.
+  legacy_assets = ndb.BlobKeyProperty('assets', repeated=True)
+  assets_url = ndb.StringProperty()
+  timezone = ndb.StringProperty(default=schedule.DEFAULT_TIMEZONE)
+  advertiser_timezones = ndb.JsonProperty()
+  column_mappings = ndb.JsonProperty()
   created_at = ndb.DateTimeProperty(auto_now_add=True)
   updated_at = ndb.DateTimeProperty(auto_now_add=True)
   last_run_at = ndb.DateTimeProperty()
   last_completed_at = ndb.DateTimeProperty()
+  current_run = ndb.KeyProperty(kind=ProjectRun, indexed=False)
+
+  def _post_put_hook(self, future):
+    versions.changed(self.key, {
+        versions.PROJECT: self.updated_at.isoformat(),
+        versions.STATUS: versions.fresh_marker()
+    })
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    versions.forget(key)
+
+
+class ProjectAsset(ndb.Model):
+  # An uploaded asset, keyed under its project by its lowercased filename,
+  # which is how the feed refers to it. An upload with the same filename
+  # replaces it.
+  blob = ndb.BlobKeyProperty()
+  filename = ndb.StringProperty()
+  size = ndb.IntegerProperty()
+  content_type = ndb.StringProperty(indexed=False)
+  md5_hash = ndb.StringProperty(indexed=False)
+  created_at = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+def asset_key(project_key, filename):
+  return ndb.Key(ProjectAsset, filename.lower(), parent=project_key)
+
+
+def log_entry(message, severity=ProjectLoggerSeverity.INFO):
+  return [severity.number, datetime.datetime.utcnow().isoformat(), message]
+
+
+@ndb.transactional
+def log_project_activity(project_key,
+                         message,
+                         severity=ProjectLoggerSeverity.INFO):
+  # Messages that happen outside of a run (creation, edits, uploads) are
+  # appended to the tail chunk of a long-lived "activity" run.
+  run_key = ndb.Key(ProjectRun, ACTIVITY_RUN_ID, parent=project_key)
+  run = run_key.get()
+  if not run:
+    run = ProjectRun(key=run_key, status=ProjectStatus.INITIALIZED)
+
+  chunk = None
+  if run.chunk_count:
+    chunk = ProjectLogChunk.get_by_id(run.chunk_count, parent=run_key)
+
+  if chunk is None or len(chunk.entries) >= LOG_CHUNK_SIZE:
+    run.chunk_count += 1
+    chunk = ProjectLogChunk(parent=run_key, id=run.chunk_count, entries=[])
+
+  chunk.entries.append(log_entry(message, severity))
+  chunk.updated_at = datetime.datetime.utcnow()
+  run.updated_at = chunk.updated_at
+  ndb.put_multi([run, chunk])
 
 
 def show_settings():
@@ -138,15 +345,30 @@ def show_project(project_id):
   return Project.get_by_id(project_id, use_cache=False, use_memcache=False)
 
 
+def project_versions(project_id, *resources):
+  # The version markers of what the API serves about a project, or None if
+  # there is no such project.
+  key = ndb.Key(Project, project_id)
+
+  def derive(resource):
+    if resource == versions.PROJECT:
+      project = key.get(use_cache=False, use_memcache=False)
+      return project and project.updated_at.isoformat()
+    if resource == versions.LOG:
+      chunk = ProjectLogChunk.query(ancestor=key).order(
+          -ProjectLogChunk.updated_at).get(
+              projection=[ProjectLogChunk.updated_at])
+      return versions.log_marker(chunk.key, chunk.updated_at) if chunk else ''
+    return versions.fresh_marker()
+
+  return versions.current(key, resources, derive)
+
+
 def create_project(name, profile_id, credentials):
   project = Project(name=name, profile_id=profile_id, credentials=credentials)
   project.put()
 
-  logger = ProjectLogger(
-      message='Created.',
-      project=project.key,
-      severity=ProjectLoggerSeverity.INFO)
-  logger.put()
+  log_project_activity(project.key, 'Created.')
 
   return project
 
@@ -155,23 +377,36 @@ def update_project(project_id,
                    name,
                    profile_id,
                    feed,
-                   assets,
                    sheets_feed_url='',
-                   notes=''):
+                   notes='',
+                   timezone=None,
+                   advertiser_timezones=None,
+                   assets_url=None,
+                   column_mappings=None):
+  schedule.validate_timezones(timezone, advertiser_timezones)
+  feeds.validate_column_mappings(column_mappings)
+  if assets_url:
+    storage.backend_for_url(assets_url)
+
   key = ndb.Key(Project, project_id)
   project = key.get()
   project.name = name
   project.profile_id = profile_id
   project.sheets_feed_url = sheets_feed_url
   project.notes = notes
+  project.timezone = timezone or schedule.DEFAULT_TIMEZONE
+  project.advertiser_timezones = advertiser_timezones or {}
+  project.assets_url = assets_url or None
+  previous_feed = (project.feed, project.column_mappings or {})
+  project.column_mappings = column_mappings or {}
   project.feed = blobstore.BlobKey(feed['key']) if feed else None
-  project.assets = [blobstore.BlobKey(a['key']) for a in assets]
   project.updated_at = datetime.datetime.utcnow()
   project.put()
 
-  logger = ProjectLogger(
-      message='Updated.', project=key, severity=ProjectLoggerSeverity.INFO)
-  logger.put()
+  if project.feed and previous_feed != (project.feed, project.column_mappings):
+    queue_feed_index(project)
+
+  log_project_activity(key, 'Updated.')
 
   return project
 
@@ -183,78 +418,476 @@ def update_project_with_feed(project_id, feed):
   project.updated_at = datetime.datetime.utcnow()
   project.put()
 
-  logger = ProjectLogger(
-      message='Feed added.', project=key, severity=ProjectLoggerSeverity.INFO)
-  logger.put()
+  queue_feed_index(project)
+
+  log_project_activity(key, 'Feed added.')
 
   return project
 
 
+@ndb.transactional
+def queue_feed_index(project):
+  # The index notes what it was last queued for, so previews polled before
+  # the task is done don't queue it again. A task that got lost is queued
+  # again once it has had its time.
+  key = feeds.index_key(project.key)
+  feed_index = key.get() or feeds.FeedIndex(key=key)
+  if feed_index.is_queued(project.feed, project.column_mappings):
+    return
+
+  feed_index.queued_feed = project.feed
+  feed_index.queued_column_mappings = project.column_mappings or {}
+  feed_index.queued_at = datetime.datetime.utcnow()
+  feed_index.put()
+  deferred.defer(index_project_feed, project.key.id(), _transactional=True)
+
+
+def index_project_feed(project_id):
+  project = show_project(project_id)
+  if not project or not project.feed:
+    return
+
+  feed_index = feeds.index_key(project.key).get()
+  if feed_index and feed_index.is_current(project.feed,
+                                          project.column_mappings):
+    return
+
+  feeds.Feed(project.feed, project.column_mappings).index(project.key)
+
+
+def project_feed_preview(project_id, page=0, page_size=None):
+  # Returns None while the project's current feed is still being indexed.
+  page_size = min(page_size or FEED_PREVIEW_PAGE_SIZE,
+                  MAX_FEED_PREVIEW_PAGE_SIZE)
+  if page < 0 or page_size < 1:
+    raise ValueError('The page must be a positive number!')
+
+  project = show_project(project_id)
+  if not project.feed:
+    raise ValueError('The project has no feed!')
+
+  feed_index = feeds.index_key(project.key).get()
+  if not feed_index or not feed_index.is_current(project.feed,
+                                                 project.column_mappings):
+    queue_feed_index(project)
+    return None
+
+  feed = feeds.Feed(project.feed, project.column_mappings)
+  rows = []
+  if not feed_index.error:
+    rows = feed.page(feed_index, page * page_size, page_size)
+
+  return {
+      'columns': feed.mappings,
+      'rows': rows,
+      'rowCount': feed_index.row_count,
+      'page': page,
+      'pageSize': page_size,
+      'stats': feed_index.stats,
+      'error': feed_index.error
+  }
+
+
 def update_project_with_asset(project_id, asset):
-  key = ndb.Key(Project, project_id)
+  project, replaced = add_project_assets(project_id, [asset])
+
+  if replaced:
+    deferred.defer(delete_unreferenced_blobs, replaced)
+
+  log_project_activity(project.key,
+                       'Asset replaced.' if replaced else 'Asset added.')
+
+  return project
+
+
+@ndb.transactional
+def touch_project(key):
   project = key.get()
-  project.assets.append(asset)  # TODO: Overwrite if filename already exists.
   project.updated_at = datetime.datetime.utcnow()
   project.put()
+  return project
+
+
+def put_project_assets(project_key, blob_keys):
+  # Returns the blobs of the assets they replaced.
+  assets = [
+      ProjectAsset(
+          key=asset_key(project_key, info.filename),
+          blob=blob_key,
+          filename=info.filename,
+          size=info.size,
+          content_type=info.content_type,
+          md5_hash=info.md5_hash)
+      for blob_key, info in zip(blob_keys, blobstore.BlobInfo.get(blob_keys))
+      if info
+  ]
+  existing = ndb.get_multi([asset.key for asset in assets])
+  ndb.put_multi(assets)
+  return [
+      asset.blob
+      for asset in existing
+      if asset and asset.blob not in blob_keys
+  ]
+
+
+def migrate_project_assets(project):
+  # Moves assets still listed on the project into ProjectAsset entities.
+  if not project or not project.legacy_assets:
+    return project
+
+  put_project_assets(project.key, project.legacy_assets)
+
+  @ndb.transactional
+  def clear_legacy_assets():
+    migrated = project.key.get()
+    migrated.legacy_assets = []
+    migrated.put()
+    return migrated
+
+  return clear_legacy_assets()
+
+
+def migrate_all_project_assets(bookmark_cursor=None):
+  cursor = Cursor(urlsafe=bookmark_cursor) if bookmark_cursor else None
+  projects, next_cursor, has_more = Project.query(
+      Project.legacy_assets > blobstore.BlobKey('')).fetch_page(
+          ASSET_MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+  for project in projects:
+    migrate_project_assets(project)
+
+  if has_more and next_cursor:
+    deferred.defer(migrate_all_project_assets, next_cursor.urlsafe())
+
+
+def add_project_assets(project_id, assets):
+  # Assets replace any existing asset with the same filename, matching the
+  # case-insensitive lookup the job does when it reads the feed. Each is
+  # its own entity, so concurrent uploads don't overwrite each other.
+  key = ndb.Key(Project, project_id)
+  migrate_project_assets(key.get())
+  replaced = put_project_assets(key, assets)
+  return touch_project(key), replaced
+
+
+def remove_project_asset(project_id, filename):
+  key = ndb.Key(Project, project_id)
+  asset = asset_key(key, filename).get()
+  if not asset:
+    return None
 
-  logger = ProjectLogger(
-      message='Asset added.', project=key, severity=ProjectLoggerSeverity.INFO)
-  logger.put()
+  asset.key.delete()
+  project = touch_project(key)
+  deferred.defer(delete_unreferenced_blobs, [asset.blob])
+
+  log_project_activity(key, 'Asset removed.')
 
   return project
 
 
-def start_project_run(project_id):
+def project_assets(project_id, bookmark_cursor=None, page_size=None):
+  # A page of the project's assets by filename, read from the index alone.
+  page_size = min(page_size or ASSETS_PER_PAGE, MAX_ASSETS_PER_PAGE)
   key = ndb.Key(Project, project_id)
-  deferred.defer(project_run, key)
+  migrate_project_assets(key.get())
 
-  logger = ProjectLogger(
-      message='Added to deferred queue.',
-      project=key,
-      severity=ProjectLoggerSeverity.INFO)
-  logger.put()
+  cursor = Cursor(urlsafe=bookmark_cursor) if bookmark_cursor else None
+  query = ProjectAsset.query(ancestor=key).order(ProjectAsset.filename)
+  assets, next_cursor, has_next = query.fetch_page(
+      page_size,
+      start_cursor=cursor,
+      projection=[ProjectAsset.filename, ProjectAsset.size])
+
+  return {
+      'entities': assets,
+      'nextCursor': next_cursor.urlsafe() if next_cursor else None,
+      'hasNext': has_next
+  }
+
+
+def indexed_row_count(project_key, feed):
+  # The row count of the feed's index, or None until it's been indexed.
+  if not feed:
+    return 0
+  feed_index = feeds.index_key(project_key).get()
+  if feed_index and feed_index.feed == feed and not feed_index.error:
+    return feed_index.row_count
+  return None
 
-  return
 
+def estimate_run_rows(run_key):
+  # Counts the rows of a run's feed in a task of its own, the scheduler
+  # doesn't admit the run until it knows how many there are.
+  run = run_key.get()
+  if run.estimated_rows is not None:
+    return
 
-def project_run(key):
+  try:
+    estimated_rows = feeds.Feed(run.feed).count()
+  except (IOError, ValueError, zipfile.BadZipfile, zlib.error):
+    # Not worth holding the run up for, it fails on the feed itself.
+    estimated_rows = 0
+
+  set_estimated_rows(run_key, estimated_rows)
+  scheduler.schedule()
+
+
+@ndb.transactional
+def set_estimated_rows(run_key, estimated_rows):
+  run = run_key.get()
+  run.estimated_rows = estimated_rows
+  run.put()
+
+
+def start_project_run(project_id,
+                      priority=scheduler.DEFAULT_PRIORITY,
+                      profile=False,
+                      isolate_failures=False,
+                      retry_failed=False):
+  key = ndb.Key(Project, project_id)
   project = key.get()
 
+  run = ProjectRun(
+      parent=key,
+      status=ProjectStatus.QUEUED,
+      profile_id=project.profile_id,
+      priority=priority,
+      profile=profile,
+      isolate_failures=isolate_failures or retry_failed,
+      feed=project.feed)
+
+  if retry_failed:
+    previous = project.current_run.get() if project.current_run else None
+    if not previous or not previous.failed_rows:
+      raise ValueError('The last run has no failed rows to retry!')
+    # A run that stopped early never got to the rest of the feed, retrying
+    # only its failed rows would leave those out.
+    if previous.status != ProjectStatus.COMPLETED:
+      raise ValueError('Only the failed rows of a completed run can be '
+                       'retried, re-run the feed instead!')
+    if previous.feed != project.feed:
+      raise ValueError('The feed has changed since the last run, its failed '
+                       'rows can no longer be retried!')
+    run.retry_of = previous.key
+    run.tag_run = previous.tag_run or previous.key
+    run.estimated_rows = previous.failed_rows
+  else:
+    run.estimated_rows = indexed_row_count(key, project.feed)
+  run.put()
+
+  if run.estimated_rows is None:
+    deferred.defer(estimate_run_rows, run.key)
+
+  options = []
+  if profile:
+    options.append('profiling enabled')
+  if retry_failed:
+    options.append('retrying %d failed row(s)' % run.estimated_rows)
+  elif isolate_failures:
+    options.append('skipping failing rows')
+
+  logger = ProjectLogger(run.key)
+  logger.log('Added to run queue with priority %d%s.' %
+             (priority, ''.join(', ' + option for option in options)))
+  logger.flush()
+
+  run.chunk_count = logger.chunk_count
+  run.put()
+
+  project.status = ProjectStatus.QUEUED
+  project.current_run = run.key
+  project.updated_at = datetime.datetime.utcnow()
+  project.put()
+
+  scheduler.schedule()
+
+  return run
+
+
+def created_summary(created):
+  return ', '.join('%d %s' % (len(ids), kind)
+                   for kind, ids in sorted(created.iteritems())) or 'nothing'
+
+
+def finish_project_run(run, logger, status, dcm_dao=None):
+  if dcm_dao:
+    run.created = dcm_dao.created
+    logger.log('Created %s.' % created_summary(dcm_dao.created))
+
+  logger.flush()
+
+  if dcm_dao and dcm_dao.request_count:
+    scheduler.record_usage(run.profile_id, dcm_dao.request_count)
+
+  run.status = status
+  run.completed_at = datetime.datetime.utcnow()
+  run.updated_at = run.completed_at
+  run.chunk_count = logger.chunk_count
+  run.put()
+
+  scheduler.schedule()
+
+
+def finish_project(project, status):
+  project.status = status
+  project.last_completed_at = datetime.datetime.utcnow()
+  project.updated_at = datetime.datetime.utcnow()
+  project.put()
+
+
+def latest_project_profile(project_id):
+  return ProjectRunProfile.query(ancestor=ndb.Key(Project, project_id)).order(
+      -ProjectRunProfile.created_at).get()
+
+
+def save_run_profile(run_key, profiler, logger):
+  # A profile that cannot be saved must not change the outcome of the run.
+  try:
+    if profiler.save(run_key):
+      logger.log('Profile saved.')
+  except Exception, e:
+    logger.log('Saving the profile failed: %s' % e,
+               ProjectLoggerSeverity.WARNING)
+
+
+def project_run(key, run_key):
+  # The DCM stack pulls in googleapiclient, oauth2client and httplib2, so it
+  # is only imported by the task that actually runs the project.
+  from dcm_dao import DCMDAO
+  from dcm_job import DCMJob
+
+  project = migrate_project_assets(key.get())
+  run = run_key.get()
+  logger = ProjectLogger(run_key, run.chunk_count)
+  cancellation = CancellationToken(run_key)
+  progress = RunProgress(run_key)
+  profiler = RunProfiler(run.profile)
+  failures = DeadLetters(run_key) if run.isolate_failures else None
+
+  if run.cancel_requested:
+    logger.log('Cancelled before starting.', ProjectLoggerSeverity.WARNING)
+    finish_project_run(run, logger, ProjectStatus.CANCELLED)
+    return
+
   project.status = ProjectStatus.RUNNING
   project.last_run_at = datetime.datetime.utcnow()
   project.updated_at = datetime.datetime.utcnow()
   project.put()
 
-  run_logger = ProjectLogger(
-      message='Running.', project=key, severity=ProjectLoggerSeverity.INFO)
-  run_logger.put()
+  run.status = ProjectStatus.RUNNING
+  run.updated_at = datetime.datetime.utcnow()
+  run.put()
+
+  logger.log('Running.')
 
+  dcm_dao = None
   try:
-    dcm_dao = DCMDAO(project)
-    dcm_job = DCMJob(project, dcm_dao)
-    dcm_job.start()
+    with profiler.phase('setup'):
+      dcm_dao = DCMDAO(
+          project,
+          run_key,
+          cancellation=cancellation,
+          progress=progress,
+          tag_run_key=run.tag_run)
+    try:
+      with profiler.phase('feed'):
+        only_rows = None
+        if run.retry_of:
+          only_rows = failed_row_phases(run.retry_of)
+        dcm_job = DCMJob(project, dcm_dao, logger, cancellation, progress,
+                         profiler, failures, only_rows)
+      dcm_job.start()
+    finally:
+      dcm_dao.clear_caches()
+      if failures is not None:
+        run.failed_rows = len(failures)
+      save_run_profile(run_key, profiler, logger)
+  except RunCancelled:
+    finish_project(project, ProjectStatus.CANCELLED)
+
+    logger.log('Cancelled.', ProjectLoggerSeverity.WARNING)
+    finish_project_run(run, logger, ProjectStatus.CANCELLED, dcm_dao)
+
+    return
   except Exception, e:
     print(traceback.format_exc())
 
-    project.status = ProjectStatus.ERROR
-    project.last_completed_at = datetime.datetime.utcnow()
-    project.updated_at = datetime.datetime.utcnow()
-    project.put()
+    finish_project(project, ProjectStatus.ERROR)
 
-    error_logger = ProjectLogger(
-        message=str(e), project=key, severity=ProjectLoggerSeverity.ERROR)
-    error_logger.put()
+    logger.log(str(e), ProjectLoggerSeverity.ERROR)
+    finish_project_run(run, logger, ProjectStatus.ERROR, dcm_dao)
 
     raise deferred.PermanentTaskFailure, e
 
-  project.status = ProjectStatus.COMPLETED
-  project.last_completed_at = datetime.datetime.utcnow()
-  project.updated_at = datetime.datetime.utcnow()
-  project.put()
+  finish_project(project, ProjectStatus.COMPLETED)
+
+  if run.failed_rows:
+    logger.log(
+        'Completed, %d row(s) failed and can be retried.' % run.failed_rows,
+        ProjectLoggerSeverity.WARNING)
+  else:
+    logger.log('Completed.')
+  finish_project_run(run, logger, ProjectStatus.COMPLETED, dcm_dao)
+
 
-  completed_logger = ProjectLogger(
-      message='Completed.', project=key, severity=ProjectLoggerSeverity.INFO)
-  completed_logger.put()
+def start_run_rollback(project_id):
+  # Rolls back what the project's last run created, in the background. A
+  # rollback that is still going is returned as is.
+  project = show_project(project_id)
+  run = project.current_run.get() if project.current_run else None
+  if not run or run.status in [ProjectStatus.QUEUED, ProjectStatus.RUNNING]:
+    raise ValueError('Only a finished run can be rolled back!')
+  if not run.created:
+    raise ValueError('The last run did not create anything to roll back!')
+
+  rollback = rollback_key(run.key).get()
+  if rollback and not rollback.completed_at:
+    return rollback
+
+  rollback = new_rollback(run.key, run.created)
+  rollback.put()
+
+  log_project_activity(project.key, 'Rolling back run %s.' % run.key.id(),
+                       ProjectLoggerSeverity.WARNING)
+  deferred.defer(continue_run_rollback, run.key, _queue=scheduler.RUNS_QUEUE)
+
+  return rollback
+
+
+def show_run_rollback(project_id):
+  project = show_project(project_id)
+  if not project or not project.current_run:
+    return None
+  return rollback_key(project.current_run).get()
+
+
+def continue_run_rollback(run_key):
+  from dcm_dao import DCMDAO
+
+  rollback = rollback_key(run_key).get()
+  if not rollback or rollback.completed_at:
+    return
+
+  project = run_key.parent().get()
+  run = run_key.get()
+  dcm_dao = DCMDAO(project)
+  try:
+    done = Rollback(dcm_dao, rollback, run.created).run()
+  finally:
+    if dcm_dao.request_count:
+      scheduler.record_usage(run.profile_id, dcm_dao.request_count)
+
+  if not done:
+    deferred.defer(continue_run_rollback, run_key, _queue=scheduler.RUNS_QUEUE)
+    return
+
+  failed = sum(c['failed'] for c in rollback.counts.itervalues())
+  summary = ', '.join('%d of %d %s' % (c['done'], c['total'], kind)
+                      for kind, c in sorted(rollback.counts.iteritems())
+                      if c['total'])
+  log_project_activity(
+      project.key, 'Rolled back run %s: %s.' % (run_key.id(), summary),
+      ProjectLoggerSeverity.WARNING if failed else ProjectLoggerSeverity.INFO)
 
 
 def cancel_project_run(project_id):
@@ -264,52 +897,454 @@ def cancel_project_run(project_id):
   project.updated_at = datetime.datetime.utcnow()
   project.put()
 
-  logger = ProjectLogger(
-      message='Cancelled.', project=key, severity=ProjectLoggerSeverity.WARNING)
-  logger.put()
+  if project.current_run:
+    if dequeue_project_run(project.current_run):
+      scheduler.schedule()
+    elif request_run_cancellation(project.current_run):
+      request_cancellation(project.current_run)
+
+  log_project_activity(key, 'Cancelled.', ProjectLoggerSeverity.WARNING)
 
   return
 
 
+@ndb.transactional
+def request_run_cancellation(run_key):
+  run = run_key.get()
+  if not run or run.status != ProjectStatus.RUNNING:
+    return False
+
+  run.cancel_requested = True
+  run.updated_at = datetime.datetime.utcnow()
+  run.put()
+  return True
+
+
+@ndb.transactional
+def dequeue_project_run(run_key):
+  run = run_key.get()
+  if not run or run.status != ProjectStatus.QUEUED:
+    return False
+
+  run.status = ProjectStatus.CANCELLED
+  run.completed_at = datetime.datetime.utcnow()
+  run.updated_at = run.completed_at
+  run.queue_position = None
+  run.eta = None
+  run.put()
+  return True
+
+
+@ndb.transactional(xg=True)
 def destroy_project(project_id):
+  deletion = ProjectDeletion.get_by_id(project_id)
+  if deletion:
+    return deletion
+
   key = ndb.Key(Project, project_id)
-  key.delete()
+  project = key.get()
 
-  ndb.delete_multi(
-      ProjectLogger.query(ProjectLogger.project == key).fetch(keys_only=True))
+  # A run would put the project back when it finishes.
+  run = project.current_run.get() if project and project.current_run else None
+  if run and run.status in (ProjectStatus.QUEUED, ProjectStatus.RUNNING):
+    raise ValueError('The project can\'t be deleted while it has a run in '
+                     'progress, cancel it first!')
 
+  deletion = ProjectDeletion(id=project_id)
+  if project:
+    if project.feed:
+      deletion.blobs.append(project.feed)
+    deletion.blobs.extend(project.legacy_assets)
+    key.delete()
+  deletion.put()
+
+  deferred.defer(delete_project_batch, project_id, _transactional=True)
+
+  return deletion
 
-def project_loggers(project_id, bookmark_cursor):
-  key = ndb.Key(Project, project_id)
+
+def show_project_deletion(project_id):
+  return ProjectDeletion.get_by_id(project_id)
+
+
+def delete_project_batch(project_id):
+  deletion = ProjectDeletion.get_by_id(project_id)
+  if not deletion or deletion.phase == ProjectDeletionPhase.COMPLETED:
+    return
+
+  if deletion.phase == ProjectDeletionPhase.ENTITIES:
+    delete_project_entities(deletion)
+  elif deletion.phase == ProjectDeletionPhase.LEGACY_LOGS:
+    delete_legacy_project_logs(deletion)
+  elif deletion.phase == ProjectDeletionPhase.BLOBS:
+    delete_project_blobs(deletion)
+
+  deletion.updated_at = datetime.datetime.utcnow()
+  if deletion.phase == ProjectDeletionPhase.COMPLETED:
+    deletion.completed_at = deletion.updated_at
+  deletion.put()
+
+  if deletion.phase != ProjectDeletionPhase.COMPLETED:
+    deferred.defer(delete_project_batch, project_id)
+
+
+def delete_project_entities(deletion):
+  # Runs, log chunks and anything else owned by the project are descendants
+  # of its key, which outlives the project entity itself.
+  query = ndb.Query(ancestor=ndb.Key(Project, deletion.key.id()))
+
+  cursor = None
+  if deletion.cursor:
+    cursor = Cursor(urlsafe=deletion.cursor)
+
+  has_more = False
+  for _ in xrange(DELETION_BATCHES_PER_TASK):
+    keys, next_cursor, has_more = query.fetch_page(
+        DELETION_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    # Asset and profile blobs are deleted along with their entities, so
+    # there is never a list of them all to keep.
+    blob_keys = [
+        k for k in keys if k.kind() in (ProjectAsset._get_kind(),
+                                        ProjectRunProfile._get_kind())
+    ]
+    blobs = []
+    for entity in ndb.get_multi(blob_keys):
+      if isinstance(entity, ProjectAsset):
+        blobs.append(entity.blob)
+      elif entity and entity.archive_blob:
+        blobs.append(entity.archive_blob)
+    ndb.delete_multi(keys)
+    deletion.entities_deleted += len(keys)
+    if blobs:
+      deleted, kept = delete_unreferenced_blobs(blobs)
+      deletion.blobs_deleted += len(deleted)
+      deletion.blobs_kept += len(kept)
+    cursor = next_cursor or cursor
+    if not has_more:
+      break
+
+  if has_more:
+    deletion.cursor = cursor.urlsafe()
+  else:
+    deletion.cursor = None
+    deletion.phase = ProjectDeletionPhase.LEGACY_LOGS
+
+
+def delete_legacy_project_logs(deletion):
+  # Log lines from before logs were chunked are root entities that only
+  # refer to the project.
+  query = LegacyProjectLog.query(
+      LegacyProjectLog.project == ndb.Key(Project, deletion.key.id()))
+
+  cursor = None
+  if deletion.cursor:
+    cursor = Cursor(urlsafe=deletion.cursor)
+
+  has_more = False
+  for _ in xrange(DELETION_BATCHES_PER_TASK):
+    keys, next_cursor, has_more = query.fetch_page(
+        DELETION_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    ndb.delete_multi(keys)
+    deletion.entities_deleted += len(keys)
+    cursor = next_cursor or cursor
+    if not has_more:
+      break
+
+  if has_more:
+    deletion.cursor = cursor.urlsafe()
+  else:
+    deletion.cursor = None
+    deletion.phase = ProjectDeletionPhase.BLOBS
+
+
+def delete_project_blobs(deletion):
+  batch = deletion.blobs[:DELETION_BATCH_SIZE]
+
+  deleted, kept = delete_unreferenced_blobs(batch)
+
+  deletion.blobs = deletion.blobs[len(batch):]
+  deletion.blobs_deleted += len(deleted)
+  deletion.blobs_kept += len(kept)
+
+  if not deletion.blobs:
+    deletion.phase = ProjectDeletionPhase.COMPLETED
+
+
+def delete_unreferenced_blobs(blob_keys):
+  feed_futures = [
+      Project.query(Project.feed == b).get_async(keys_only=True)
+      for b in blob_keys
+  ]
+  asset_futures = [
+      ProjectAsset.query(ProjectAsset.blob == b).get_async(keys_only=True)
+      for b in blob_keys
+  ]
+  legacy_asset_futures = [
+      Project.query(Project.legacy_assets == b).get_async(keys_only=True)
+      for b in blob_keys
+  ]
+
+  deleted = []
+  kept = []
+  for blob_key, feed_future, asset_future, legacy_future in zip(
+      blob_keys, feed_futures, asset_futures, legacy_asset_futures):
+    if (feed_future.get_result() or asset_future.get_result() or
+        legacy_future.get_result()):
+      kept.append(blob_key)
+    else:
+      deleted.append(blob_key)
+
+  if deleted:
+    blobstore.delete_async(deleted).get_result()
+
+  return deleted, kept
+
+
+def migrate_all_project_logs():
+  # Migrates the legacy log lines of one project at a time, until none are
+  # left or the query only finds lines that are already gone.
+  keys = LegacyProjectLog.query().fetch(1, keys_only=True)
+  line = keys[0].get() if keys else None
+  if line and migrate_project_logs(line.project):
+    deferred.defer(migrate_all_project_logs)
+
+
+def migrate_project_logs(project_key):
+  # Moves log lines from before logs were chunked into the chunks of a
+  # completed "legacy" run, whose retention starts with the migration.
+  # Returns whether there were any lines left to move.
+  query = LegacyProjectLog.query(
+      LegacyProjectLog.project == project_key).order(
+          LegacyProjectLog.updated_at)
+  has_project = project_key is not None and project_key.get() is not None
+
+  moved = False
+  for _ in xrange(LOG_MIGRATION_CHUNKS_PER_TASK):
+    lines = [
+        line for line in ndb.get_multi(
+            query.fetch(LOG_CHUNK_SIZE, keys_only=True)) if line
+    ]
+    if not lines:
+      break
+    if has_project:
+      append_legacy_log_chunk(project_key, lines)
+    ndb.delete_multi([line.key for line in lines])
+    moved = True
+  return moved
+
+
+@ndb.transactional
+def append_legacy_log_chunk(project_key, lines):
+  run_key = ndb.Key(ProjectRun, LEGACY_RUN_ID, parent=project_key)
+  run = run_key.get()
+  if not run:
+    run = ProjectRun(
+        key=run_key,
+        status=ProjectStatus.COMPLETED,
+        created_at=lines[0].created_at,
+        completed_at=datetime.datetime.utcnow())
+
+  run.chunk_count += 1
+  chunk = ProjectLogChunk(
+      parent=run_key,
+      id=run.chunk_count,
+      entries=[[line.severity.number,
+                line.created_at.isoformat(), line.message] for line in lines],
+      created_at=lines[0].created_at,
+      updated_at=lines[-1].updated_at)
+  run.updated_at = chunk.updated_at
+  ndb.put_multi([run, chunk])
+
+
+def compact_project_runs(bookmark_cursor=None):
+  cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+      days=LOG_RETENTION_DAYS)
 
   cursor = None
 
   if bookmark_cursor:
     cursor = Cursor(urlsafe=bookmark_cursor)
 
-  query = ProjectLogger.query(ProjectLogger.project == key)
+  query = ProjectRun.query(ProjectRun.compacted == False,
+                           ProjectRun.completed_at < cutoff)
 
-  next_query = query.order(-ProjectLogger.updated_at)
-  previous_query = query.order(ProjectLogger.updated_at)
+  runs, next_cursor, has_next = query.fetch_page(
+      COMPACTION_BATCH_SIZE, start_cursor=cursor)
 
-  entities, next_cursor, has_next = next_query.fetch_page(
-      PER_PAGE, start_cursor=cursor)
+  for run in runs:
+    compact_project_run(run)
 
-  if next_cursor:
-    next_cursor = next_cursor.urlsafe()
+  if has_next:
+    deferred.defer(compact_project_runs, next_cursor.urlsafe())
+
+
+def compact_project_run(run):
+  # Only warnings and errors survive compaction, folded into a single chunk.
+  chunks = ProjectLogChunk.query(ancestor=run.key).fetch()
+  compacted_chunk = fold_log_chunks(run.key, 1, chunks)
+
+  run.chunk_count = 1
+  run.compacted = True
+
+  ndb.delete_multi([c.key for c in chunks if c.key.id() != 1])
+  ndb.put_multi([run, compacted_chunk])
+
+
+def compact_activity_runs(bookmark_cursor=None):
+  # Activity runs never complete, so their chunks are compacted by age
+  # instead, every day, the same way a completed run is.
+  cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+      days=LOG_RETENTION_DAYS)
+
+  cursor = None
+
+  if bookmark_cursor:
+    cursor = Cursor(urlsafe=bookmark_cursor)
+
+  query = ProjectRun.query(ProjectRun.status == ProjectStatus.INITIALIZED)
 
+  runs, next_cursor, has_next = query.fetch_page(
+      COMPACTION_BATCH_SIZE, start_cursor=cursor)
+
+  for run in runs:
+    if run.key.id() == ACTIVITY_RUN_ID:
+      compact_activity_run(run, cutoff)
+
+  if has_next:
+    deferred.defer(compact_activity_runs, next_cursor.urlsafe())
+
+
+def compact_activity_run(run, cutoff):
+  # Folds the chunks last written before cutoff into the oldest of them.
+  # The tail chunk is left alone, as log_project_activity appends to it.
+  chunks = [
+      c for c in ProjectLogChunk.query(
+          ProjectLogChunk.updated_at < cutoff, ancestor=run.key).fetch()
+      if c.key.id() != run.chunk_count
+  ]
+  if not chunks:
+    return
+
+  compacted_chunk = fold_log_chunks(run.key,
+                                    min(c.key.id() for c in chunks), chunks)
+  if len(chunks) == 1 and compacted_chunk.entries == chunks[0].entries:
+    return
+
+  ndb.delete_multi(
+      [c.key for c in chunks if c.key.id() != compacted_chunk.key.id()])
+  compacted_chunk.put()
+
+
+def fold_log_chunks(run_key, chunk_id, chunks):
+  entries = []
+  for chunk in sorted(chunks, key=lambda c: c.key.id()):
+    entries.extend(e for e in chunk.entries
+                   if e[0] <= ProjectLoggerSeverity.WARNING.number)
+
+  compacted_chunk = ProjectLogChunk(
+      parent=run_key, id=chunk_id, entries=entries[-LOG_CHUNK_SIZE:])
+  if chunks:
+    compacted_chunk.created_at = min(c.created_at for c in chunks)
+    compacted_chunk.updated_at = max(c.updated_at for c in chunks)
+  return compacted_chunk
+
+
+def log_bookmark(cursor, index):
+  # Where a log page starts: the chunk a cursor points at, and the index
+  # past the newest of its entries on the page, or none for all of them.
+  # Entries are only ever appended, so the index stays put as a run logs.
+  return '%s.%s' % ('' if index is None else index,
+                    cursor.urlsafe() if cursor else '')
+
+
+def parse_log_bookmark(bookmark):
+  if not bookmark:
+    return None, None
+  index, _, cursor = bookmark.partition('.')
+  return (Cursor(urlsafe=cursor) if cursor else None,
+          int(index) if index else None)
+
+
+def project_loggers(project_id, bookmark_cursor):
+  # Pages through log entries newest first, LOG_ENTRIES_PER_PAGE at a time,
+  # reading as few chunks as it takes.
+  key = ndb.Key(Project, project_id)
+  cursor, index = parse_log_bookmark(bookmark_cursor)
+
+  query = ProjectLogChunk.query(ancestor=key)
+
+  # Chunks are paged by when they were created, which unlike updated_at
+  # does not change while a run is still logging to them.
+  next_query = query.order(-ProjectLogChunk.created_at, -ProjectLogChunk.key)
+  previous_query = query.order(ProjectLogChunk.created_at, ProjectLogChunk.key)
+
+  # One entry more than fits tells whether there is a next page.
+  page = []
+  first_chunk = None
+  chunk_cursor, end = cursor, index
+  while len(page) <= LOG_ENTRIES_PER_PAGE:
+    chunks, after_cursor, more = next_query.fetch_page(
+        1, start_cursor=chunk_cursor)
+    if not chunks:
+      break
+    chunk = chunks[0]
+    first_chunk = first_chunk or chunk
+    stop = len(chunk.entries) if end is None else min(end, len(chunk.entries))
+    while stop > 0 and len(page) <= LOG_ENTRIES_PER_PAGE:
+      stop -= 1
+      page.append((chunk, stop, chunk_cursor))
+    if not more:
+      break
+    chunk_cursor, end = after_cursor, None
+
+  next_cursor = None
+  has_next = len(page) > LOG_ENTRIES_PER_PAGE
+  if has_next:
+    _, stop, chunk_cursor = page.pop()
+    next_cursor = log_bookmark(chunk_cursor, stop + 1)
+
+  # The previous page ends with the entry just newer than this one starts
+  # with, those left in the first chunk and then in the chunks before it.
   has_previous = False
   previous_cursor = None
-  if cursor:
-    previous_cursor = cursor.reversed()
-    previous_entities, previous_cursor, has_previous = previous_query.fetch_page(
-        PER_PAGE, start_cursor=previous_cursor)
-
-  if previous_cursor:
-    has_previous = True
-    previous_cursor = previous_cursor.urlsafe()
+  if bookmark_cursor:
+    newer = 0
+    if first_chunk and index is not None:
+      newer = max(0, len(first_chunk.entries) - index)
+    if newer >= LOG_ENTRIES_PER_PAGE:
+      previous_cursor = log_bookmark(cursor, index + LOG_ENTRIES_PER_PAGE)
+    elif cursor:
+      chunk_cursor = cursor.reversed()
+      while True:
+        chunks, after_cursor, more = previous_query.fetch_page(
+            1, start_cursor=chunk_cursor)
+        if not chunks:
+          break
+        if newer + len(chunks[0].entries) >= LOG_ENTRIES_PER_PAGE:
+          previous_cursor = log_bookmark(after_cursor.reversed(),
+                                         LOG_ENTRIES_PER_PAGE - newer)
+          break
+        newer += len(chunks[0].entries)
+        if not more:
+          break
+        chunk_cursor = after_cursor
+    has_previous = bool(newer or previous_cursor)
+
+  entities = []
+  for chunk, entry_index, _ in page:
+    entry = chunk.entries[entry_index]
+    entities.append({
+        'id': '%s-%s-%d' % (chunk.key.parent().id(), chunk.key.id(),
+                            entry_index),
+        'runId': chunk.key.parent().id(),
+        'severity': ProjectLoggerSeverity(entry[0]),
+        'createdAt': entry[1],
+        'message': entry[2]
+    })
+  entities.sort(key=lambda e: e['createdAt'], reverse=True)
 
   return {
+      'project': key.get(),
       'entities': entities,
       'nextCursor': next_cursor,
       'hasNext': has_next,
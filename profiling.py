@@ -0,0 +1,166 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from contextlib import contextmanager
+from google.appengine.api import app_identity
+from google.appengine.api.runtime import runtime
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+import cProfile
+import marshal
+import pstats
+import StringIO
+import time
+import zipfile
+
+PROFILE_ID = 'profile'
+SAMPLE_INTERVAL = 5
+TOP_FUNCTIONS = 20
+
+
+class ProjectRunProfile(ndb.Model):
+  # The archive of a large run outgrows what an entity can hold, it is
+  # written to Cloud Storage and served through Blobstore.
+  summary = ndb.JsonProperty(compressed=True)
+  archive_blob = ndb.BlobKeyProperty(indexed=False)
+  created_at = ndb.DateTimeProperty(auto_now_add=True)
+
+
+def profile_key(run_key):
+  return ndb.Key(ProjectRunProfile, PROFILE_ID, parent=run_key)
+
+
+def write_archive(run_key, archive):
+  import cloudstorage
+
+  path = '/%s/profiles/%s/%s.zip' % (app_identity.get_default_gcs_bucket_name(),
+                                     run_key.parent().id(), run_key.id())
+  archive_file = cloudstorage.open(path, 'w', content_type='application/zip')
+  try:
+    archive_file.write(archive)
+  finally:
+    archive_file.close()
+  return blobstore.BlobKey(blobstore.create_gs_key('/gs' + path))
+
+
+def memory_usage():
+  return runtime.memory_usage().current()
+
+
+def top_functions(stats, count=TOP_FUNCTIONS):
+  # stats.stats maps (file, line, function) to
+  # (primitive calls, calls, own time, cumulative time, callers).
+  rows = sorted(
+      stats.stats.iteritems(), key=lambda item: item[1][3], reverse=True)
+  return [{
+      'function': '%s:%d(%s)' % function,
+      'calls': calls,
+      'ownTime': round(own_time, 4),
+      'cumulativeTime': round(cumulative_time, 4)
+  } for function, (_, calls, own_time, cumulative_time, _) in rows[:count]]
+
+
+class RunProfiler(object):
+  # Profiles each phase of a run separately when enabled and samples the
+  # instance's memory use while it goes. Does nothing when disabled.
+
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.phases = []
+    self.current = None
+    self.sampled_at = 0
+
+  @contextmanager
+  def phase(self, name):
+    if not self.enabled:
+      yield
+      return
+
+    profile = cProfile.Profile()
+    self.current = {
+        'name': name,
+        'memory': [],
+        'started_at': time.time(),
+        'profile': profile
+    }
+    self.sample(force=True)
+    profile.enable()
+    try:
+      yield
+    finally:
+      profile.disable()
+      self.sample(force=True)
+      self.current['seconds'] = time.time() - self.current['started_at']
+      self.phases.append(self.current)
+      self.current = None
+
+  def sample(self, force=False):
+    if not self.current:
+      return
+
+    now = time.time()
+    if force or now - self.sampled_at >= SAMPLE_INTERVAL:
+      self.sampled_at = now
+      self.current['memory'].append(
+          [round(now - self.current['started_at'], 1), memory_usage()])
+
+  def summary(self):
+    phases = []
+    for phase in self.phases:
+      stats = pstats.Stats(phase['profile'])
+      memory = [mb for _, mb in phase['memory']]
+      phases.append({
+          'name': phase['name'],
+          'seconds': round(phase['seconds'], 2),
+          'memoryStartMb': memory[0] if memory else None,
+          'memoryEndMb': memory[-1] if memory else None,
+          'memoryPeakMb': max(memory) if memory else None,
+          'memorySamples': phase['memory'],
+          'topFunctions': top_functions(stats)
+      })
+    return {'phases': phases}
+
+  def archive(self, summary):
+    # One file per phase in the format written by pstats.Stats.dump_stats,
+    # so they load straight into pstats or snakeviz.
+    output = StringIO.StringIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+      for index, phase in enumerate(self.phases):
+        stats = pstats.Stats(phase['profile'])
+        archive.writestr('%02d-%s.prof' % (index + 1, phase['name']),
+                         marshal.dumps(stats.stats))
+      report = StringIO.StringIO()
+      for phase in summary['phases']:
+        report.write('%s: %.2fs, memory %s MB -> %s MB (peak %s MB)\n' %
+                     (phase['name'], phase['seconds'], phase['memoryStartMb'],
+                      phase['memoryEndMb'], phase['memoryPeakMb']))
+        for function in phase['topFunctions']:
+          report.write('  %10.4f %10.4f %8d  %s\n' %
+                       (function['cumulativeTime'], function['ownTime'],
+                        function['calls'], function['function']))
+        report.write('\n')
+      archive.writestr('summary.txt', report.getvalue())
+    return output.getvalue()
+
+  def save(self, run_key):
+    if not self.enabled or not self.phases:
+      return None
+
+    summary = self.summary()
+    run_profile = ProjectRunProfile(
+        key=profile_key(run_key),
+        summary=summary,
+        archive_blob=write_archive(run_key, self.archive(summary)))
+    run_profile.put()
+    return run_profile
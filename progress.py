@@ -0,0 +1,120 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.appengine.ext import ndb
+import datetime
+import random
+import time
+import versions
+
+PHASES = ('campaigns', 'creatives', 'placements', 'ads')
+NUM_SHARDS = 4
+FLUSH_INTERVAL = 5
+BYTES_UPLOADED = 'bytesUploaded'
+
+
+class ProjectRunCounter(ndb.Model):
+  counts = ndb.JsonProperty()
+  updated_at = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+  def _post_put_hook(self, future):
+    versions.changed(self.key.root(),
+                     {versions.STATUS: versions.fresh_marker()})
+
+
+def shard_key(run_key, shard):
+  return ndb.Key(ProjectRunCounter, 'shard-%d' % shard, parent=run_key)
+
+
+@ndb.transactional
+def add_to_shard(key, deltas):
+  counter = key.get() or ProjectRunCounter(key=key, counts={})
+  for name, delta in deltas.iteritems():
+    counter.counts[name] = counter.counts.get(name, 0) + delta
+  counter.put()
+
+
+class RunProgress(object):
+  # Counts are kept in memory and added to one of a few counter shards every
+  # few seconds, so progress never contends with the Project entity.
+
+  def __init__(self, run_key=None):
+    self.run_key = run_key
+    self.pending = {}
+    self.flushed_at = time.time()
+
+  def add(self, name, count=1):
+    self.pending[name] = self.pending.get(name, 0) + count
+
+  def total(self, phase, count):
+    self.add('%s.total' % phase, count)
+
+  def completed(self, phase, count=1):
+    self.add('%s.completed' % phase, count)
+
+  def failed(self, phase, count=1):
+    self.add('%s.failed' % phase, count)
+
+  def uploaded(self, byte_count):
+    self.add(BYTES_UPLOADED, byte_count or 0)
+
+  def maybe_flush(self):
+    if time.time() - self.flushed_at >= FLUSH_INTERVAL:
+      self.flush()
+
+  def flush(self):
+    if self.pending and self.run_key:
+      add_to_shard(
+          shard_key(self.run_key, random.randrange(NUM_SHARDS)), self.pending)
+    self.pending = {}
+    self.flushed_at = time.time()
+
+
+def run_progress(run):
+  counts = {}
+  for counter in ndb.get_multi(
+      [shard_key(run.key, s) for s in xrange(NUM_SHARDS)]):
+    if counter:
+      for name, count in counter.counts.iteritems():
+        counts[name] = counts.get(name, 0) + count
+
+  phases = {}
+  total = 0
+  done = 0
+  for phase in PHASES:
+    phases[phase] = {
+        'total': counts.get('%s.total' % phase, 0),
+        'completed': counts.get('%s.completed' % phase, 0),
+        'failed': counts.get('%s.failed' % phase, 0)
+    }
+    total += phases[phase]['total']
+    done += phases[phase]['completed'] + phases[phase]['failed']
+
+  started_at = run.admitted_at or run.created_at
+  finished_at = run.completed_at or datetime.datetime.utcnow()
+  elapsed = max(1, (finished_at - started_at).total_seconds())
+  throughput = done / elapsed
+
+  eta = None
+  if not run.completed_at and throughput and total > done:
+    eta = datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=(total - done) / throughput)
+
+  return {
+      'phases': phases,
+      'bytesUploaded': counts.get(BYTES_UPLOADED, 0),
+      'percent': 100 * done / total if total else 0,
+      'itemsPerSecond': round(throughput, 2),
+      'eta': eta.isoformat() + 'Z' if eta else None
+  }
@@ -0,0 +1,156 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.appengine.ext import ndb
+import datetime
+import time
+
+ROLLBACK_ID = 'rollback'
+# Ads go first so nothing serves while the rest is archived. Campaign
+# creative associations can't be deleted through the API, archiving the
+# campaign retires them.
+STEPS = [
+    ('ads', {'active': False}),
+    ('creatives', {'active': False, 'archived': True}),
+    ('placements', {'archived': True}),
+    ('campaigns', {'archived': True}),
+]
+REQUESTS_IN_FLIGHT = 10
+REQUESTS_PER_SECOND = 10
+SAVE_INTERVAL = 100
+TASK_SECONDS = 5 * 60
+MAX_ERRORS = 50
+
+
+class RunRollback(ndb.Model):
+  # Where a rollback of a run's created entities is up to: the step and the
+  # position in that step's IDs. Patches are idempotent, so a task that dies
+  # between saves just repeats a few.
+  step = ndb.IntegerProperty(default=0, indexed=False)
+  position = ndb.IntegerProperty(default=0, indexed=False)
+  counts = ndb.JsonProperty()
+  errors = ndb.JsonProperty()
+  created_at = ndb.DateTimeProperty(auto_now_add=True)
+  updated_at = ndb.DateTimeProperty(auto_now_add=True)
+  completed_at = ndb.DateTimeProperty()
+
+
+def rollback_key(run_key):
+  return ndb.Key(RunRollback, ROLLBACK_ID, parent=run_key)
+
+
+def new_rollback(run_key, created):
+  return RunRollback(
+      key=rollback_key(run_key),
+      counts=dict((kind, {
+          'total': len(created.get(kind, [])),
+          'done': 0,
+          'failed': 0
+      }) for kind, _ in STEPS),
+      errors=[])
+
+
+def rollback_progress(rollback):
+  counts = rollback.counts.values()
+  total = sum(c['total'] for c in counts)
+  finished = sum(c['done'] + c['failed'] for c in counts)
+  return {
+      'counts': rollback.counts,
+      'errors': rollback.errors,
+      'percent': round(100.0 * finished / total, 1) if total else 100.0,
+      'completed': rollback.completed_at is not None,
+      'createdAt': rollback.created_at.isoformat() + 'Z',
+      'updatedAt': rollback.updated_at.isoformat() + 'Z',
+      'completedAt':
+          rollback.completed_at.isoformat() + 'Z'
+          if rollback.completed_at else None
+  }
+
+
+class RateLimiter(object):
+  # Spaces out calls to wait() to at most per_second a second.
+
+  def __init__(self, per_second, sleep=time.sleep):
+    self.interval = 1.0 / per_second
+    self.sleep = sleep
+    self.next_at = 0
+
+  def wait(self):
+    now = time.time()
+    if self.next_at > now:
+      self.sleep(self.next_at - now)
+    self.next_at = max(now, self.next_at) + self.interval
+
+
+class Rollback(object):
+  # Patches a run's created entities step by step, a few requests in flight
+  # at a time under a rate limit, until it is done or out of time.
+
+  def __init__(self, dcm_dao, rollback, created):
+    self.dcm_dao = dcm_dao
+    self.rollback = rollback
+    self.created = created
+    self.limiter = RateLimiter(REQUESTS_PER_SECOND,
+                               dcm_dao.cancellation.sleep)
+
+  def save(self):
+    self.rollback.updated_at = datetime.datetime.utcnow()
+    self.rollback.put()
+
+  def start(self, collection, body):
+    from transport import Outcome
+
+    def start_patch(entity_id):
+      self.limiter.wait()
+      return Outcome(
+          lambda: self.dcm_dao.start_patch(collection, entity_id, body))
+
+    return start_patch
+
+  def run(self, seconds=TASK_SECONDS):
+    # Returns whether the rollback is complete. The transport pulls in the
+    # API client, so it is only imported by the task doing the work.
+    from transport import in_flight
+
+    deadline = time.time() + seconds
+    rollback = self.rollback
+
+    while rollback.step < len(STEPS):
+      collection, body = STEPS[rollback.step]
+      counts = rollback.counts[collection]
+      ids = self.created.get(collection, [])[rollback.position:]
+
+      for entity_id, result in in_flight(ids, self.start(collection, body),
+                                         REQUESTS_IN_FLIGHT):
+        rollback.position += 1
+        if isinstance(result, Exception):
+          counts['failed'] += 1
+          if len(rollback.errors) < MAX_ERRORS:
+            rollback.errors.append('%s %s: %s' % (collection, entity_id,
+                                                  result))
+        else:
+          counts['done'] += 1
+
+        if rollback.position % SAVE_INTERVAL == 0:
+          self.save()
+        if time.time() > deadline:
+          self.save()
+          return False
+
+      rollback.step += 1
+      rollback.position = 0
+
+    rollback.completed_at = datetime.datetime.utcnow()
+    self.save()
+    return True
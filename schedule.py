@@ -0,0 +1,89 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+
+DEFAULT_TIMEZONE = 'America/New_York'
+DATE_FORMAT = '%Y-%m-%d'
+DATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_timezones = {}
+
+
+def timezone(name):
+  # dateutil is only imported once a time zone is needed, keeping it out of
+  # the cold start of instances that never convert one.
+  from dateutil import tz
+
+  if name not in _timezones:
+    resolved = tz.gettz(name)
+    if resolved is None:
+      raise ValueError('Unknown time zone "%s"!' % name)
+    _timezones[name] = resolved
+  return _timezones[name]
+
+
+class ScheduleConverter(object):
+
+  def __init__(self, timezone_name=DEFAULT_TIMEZONE):
+    from dateutil import tz
+
+    self.timezone = timezone(timezone_name)
+    self.utc = tz.tzutc()
+    self.dates = {}
+    self.times = {}
+
+  def date(self, value):
+    if value not in self.dates:
+      self.dates[value] = datetime.strptime(value,
+                                            DATE_FORMAT).strftime(DATE_FORMAT)
+    return self.dates[value]
+
+  def start_time(self, date):
+    return self.utc_time(date, '23:59:59')
+
+  def end_time(self, date):
+    return self.utc_time(date, '00:00:00')
+
+  def utc_time(self, date, time):
+    key = (date, time)
+    if key not in self.times:
+      local_time = datetime.strptime('%s %s' % key, DATE_TIME_FORMAT).replace(
+          tzinfo=self.timezone)
+      self.times[key] = local_time.astimezone(self.utc).isoformat()
+    return self.times[key]
+
+
+class Schedules(object):
+  # Hands out one converter per time zone, picking the advertiser's own time
+  # zone when one is configured and the project's otherwise.
+
+  def __init__(self, default_timezone=None, advertiser_timezones=None):
+    self.default_timezone = default_timezone or DEFAULT_TIMEZONE
+    self.advertiser_timezones = dict(
+        (str(k), v) for k, v in (advertiser_timezones or {}).iteritems())
+    self.converters = {}
+
+  def for_advertiser(self, advertiser_id):
+    timezone_name = self.advertiser_timezones.get(
+        str(advertiser_id), self.default_timezone)
+    if timezone_name not in self.converters:
+      self.converters[timezone_name] = ScheduleConverter(timezone_name)
+    return self.converters[timezone_name]
+
+
+def validate_timezones(default_timezone, advertiser_timezones):
+  for name in [default_timezone] + (advertiser_timezones or {}).values():
+    if name:
+      timezone(name)
@@ -0,0 +1,183 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+import datetime
+
+RUNS_QUEUE = 'runs'
+SCHEDULER_QUEUE = 'scheduler'
+DEFAULT_PRIORITY = 0
+MAX_RUNS_PER_PROFILE = 2
+DAILY_REQUESTS_PER_PROFILE = 50000
+REQUESTS_PER_ROW = 4
+SECONDS_PER_ROW = 2
+
+
+class ProfileQuota(ndb.Model):
+  day = ndb.StringProperty(indexed=False)
+  requests = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def today():
+  return datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+
+def requests_used(quota):
+  if quota and quota.day == today():
+    return quota.requests
+  return 0
+
+
+@ndb.transactional
+def record_usage(profile_id, requests):
+  quota = ProfileQuota.get_by_id(profile_id) or ProfileQuota(id=profile_id)
+  if quota.day != today():
+    quota.day = today()
+    quota.requests = 0
+  quota.requests += requests
+  quota.put()
+
+
+def schedule():
+  # All admission decisions are made by a single task at a time, the
+  # scheduler queue only allows one concurrent request.
+  deferred.defer(admit_runs, _queue=SCHEDULER_QUEUE)
+
+
+def estimated_requests(run):
+  return (run.estimated_rows or 0) * REQUESTS_PER_ROW
+
+
+def estimated_seconds(run):
+  return (run.estimated_rows or 0) * SECONDS_PER_ROW
+
+
+def fair_order(queued_runs, running_runs):
+  # Priority first, then round-robin between projects: a project's second
+  # queued run only goes after every other project's first one.
+  last_admitted_at = {}
+  for run in running_runs:
+    project_key = run.key.parent()
+    last_admitted_at[project_key] = max(
+        last_admitted_at.get(project_key, datetime.datetime.min),
+        run.admitted_at or datetime.datetime.min)
+
+  rounds = {}
+  ordered = []
+  for run in sorted(queued_runs, key=lambda r: r.created_at):
+    project_key = run.key.parent()
+    ordered.append((-(run.priority or DEFAULT_PRIORITY),
+                    rounds.get(project_key, 0),
+                    last_admitted_at.get(project_key, datetime.datetime.min),
+                    run.created_at, run))
+    rounds[project_key] = rounds.get(project_key, 0) + 1
+
+  ordered.sort(key=lambda o: o[:4])
+  return [o[-1] for o in ordered]
+
+
+def admit_runs():
+  # model is imported where it's used, it reads DEFAULT_PRIORITY while
+  # being imported and either module may be imported first.
+  import model
+
+  # Runs whose rows are still being counted wait for the next pass.
+  queued_runs = [
+      r for r in model.ProjectRun.query(
+          model.ProjectRun.status == model.ProjectStatus.QUEUED).fetch()
+      if r.estimated_rows is not None
+  ]
+  running_runs = model.ProjectRun.query(
+      model.ProjectRun.status == model.ProjectStatus.RUNNING).fetch()
+
+  profile_ids = set(r.profile_id for r in queued_runs + running_runs)
+  quotas = dict(
+      zip(profile_ids,
+          ndb.get_multi([ndb.Key(ProfileQuota, p) for p in profile_ids])))
+
+  running = {}
+  reserved = {}
+  for run in running_runs:
+    running[run.profile_id] = running.get(run.profile_id, 0) + 1
+    reserved[run.profile_id] = (
+        reserved.get(run.profile_id, 0) + estimated_requests(run))
+
+  now = datetime.datetime.utcnow()
+  waiting_seconds = {}
+  for run in running_runs:
+    elapsed = (now - (run.admitted_at or now)).total_seconds()
+    waiting_seconds[run.profile_id] = (
+        waiting_seconds.get(run.profile_id, 0) +
+        max(0, estimated_seconds(run) - elapsed))
+
+  position = 0
+  for run in fair_order(queued_runs, running_runs):
+    profile_id = run.profile_id
+    used = requests_used(quotas.get(profile_id))
+    profile_running = running.get(profile_id, 0)
+    has_headroom = (
+        used + reserved.get(profile_id, 0) + estimated_requests(run) <=
+        DAILY_REQUESTS_PER_PROFILE or
+        (not profile_running and used < DAILY_REQUESTS_PER_PROFILE))
+
+    if profile_running < MAX_RUNS_PER_PROFILE and has_headroom:
+      running[profile_id] = profile_running + 1
+      reserved[profile_id] = (
+          reserved.get(profile_id, 0) + estimated_requests(run))
+      admit_run(run)
+      continue
+
+    position += 1
+    update_queue_position(
+        run.key, position,
+        now + datetime.timedelta(
+            seconds=waiting_seconds.get(profile_id, 0) / MAX_RUNS_PER_PROFILE))
+    waiting_seconds[profile_id] = (
+        waiting_seconds.get(profile_id, 0) + estimated_seconds(run))
+
+
+@ndb.transactional
+def update_queue_position(run_key, position, eta):
+  import model
+
+  run = run_key.get()
+  if run.status != model.ProjectStatus.QUEUED:
+    return
+
+  run.queue_position = position
+  run.eta = eta
+  run.put()
+
+
+@ndb.transactional
+def admit_run(run):
+  import model
+
+  run = run.key.get()
+  if run.status != model.ProjectStatus.QUEUED:
+    return
+
+  run.status = model.ProjectStatus.RUNNING
+  run.admitted_at = datetime.datetime.utcnow()
+  run.queue_position = None
+  run.eta = None
+  run.put()
+
+  deferred.defer(
+      model.project_run,
+      run.key.parent(),
+      run.key,
+      _queue=RUNS_QUEUE,
+      _transactional=True)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures the API handlers against seeded Datastore and Blobstore stubs.
+
+main.app is driven in-process through the App Engine testbed, after seeding
+it with projects, assets, runs and log chunks. Each route is requested the
+given number of times and requests/sec, p50/p99 latency and the API calls
+made per request are reported. The in-context cache is cleared between
+requests, memcache is left alone, as on a warm instance.
+
+  python scripts/benchmark_api.py --sdk /path/to/google_appengine
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+ROUTES = [
+    ('projects', '/api/projects'),
+    ('project', '/api/projects/%(id)d'),
+    ('status', '/api/projects/%(id)d/status'),
+    ('log', '/api/projects/%(id)d/log'),
+]
+
+
+class CallCounter(object):
+  # Counts the API calls made through the stubs, by service.
+
+  def __init__(self):
+    self.calls = {}
+
+  def __call__(self, service, call, request, response):
+    self.calls[service] = self.calls.get(service, 0) + 1
+
+  def reset(self):
+    calls = self.calls
+    self.calls = {}
+    return calls
+
+
+def setup_path(sdk):
+  sys.path[0:0] = [sdk, ROOT]
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  import appengine_config  # pylint: disable=unused-variable
+
+
+def create_blob(filename, size):
+  from google.appengine.api import datastore
+  from google.appengine.ext import blobstore
+
+  blob_key = 'blob-%s' % random.getrandbits(64)
+  info = datastore.Entity(blobstore.BLOB_INFO_KIND, name=blob_key, namespace='')
+  info['filename'] = filename
+  info['content_type'] = 'application/octet-stream'
+  info['creation'] = datetime.datetime.utcnow()
+  info['size'] = size
+  info['md5_hash'] = ''
+  datastore.Put(info)
+  return blobstore.BlobKey(blob_key)
+
+
+def seed(args):
+  from google.appengine.ext import ndb
+  import model
+  import progress
+
+  now = datetime.datetime.utcnow()
+  ids = []
+  for start in range(0, args.projects, 100):
+    batch = []
+    for number in range(start, min(start + 100, args.projects)):
+      batch.append(
+          model.Project(
+              name='Project %d' % number,
+              profile_id=str(1000 + number),
+              credentials='{}',
+              status=random.choice(list(model.ProjectStatus)),
+              feed=create_blob('feed-%d.csv' % number, 2000000),
+              created_at=now - datetime.timedelta(days=number),
+              updated_at=now - datetime.timedelta(minutes=number)))
+    keys = ndb.put_multi(batch)
+    ids.extend(key.id() for key in keys)
+
+    assets = []
+    for number, key in zip(range(start, args.projects), keys):
+      for a in range(args.assets):
+        filename = 'creative-%d-%d.jpg' % (number, a)
+        assets.append(
+            model.ProjectAsset(
+                key=model.asset_key(key, filename),
+                blob=create_blob(filename, 50000),
+                filename=filename,
+                size=50000,
+                content_type='image/jpeg'))
+    ndb.put_multi(assets)
+
+  # Only a sample of the projects get runs and logs, the handlers read them
+  # for one project at a time.
+  sampled = ids[:args.sample]
+  for project_id in sampled:
+    project_key = ndb.Key(model.Project, project_id)
+    entities = []
+    for run_number in range(args.runs):
+      run_key = ndb.Key(model.ProjectRun, run_number + 1, parent=project_key)
+      entities.append(
+          model.ProjectRun(
+              key=run_key,
+              status=model.ProjectStatus.RUNNING,
+              chunk_count=args.chunks))
+      for chunk_number in range(args.chunks):
+        entities.append(
+            model.ProjectLogChunk(
+                parent=run_key,
+                id=chunk_number + 1,
+                entries=[
+                    model.log_entry('Created ad %d in the campaign.' % entry)
+                    for entry in range(model.LOG_CHUNK_SIZE)
+                ]))
+      for shard in range(progress.NUM_SHARDS):
+        entities.append(
+            progress.ProjectRunCounter(
+                key=progress.shard_key(run_key, shard),
+                counts={
+                    'campaigns.total': 10,
+                    'campaigns.completed': 10,
+                    'ads.total': 1000,
+                    'ads.completed': 250
+                }))
+    project = project_key.get()
+    project.status = model.ProjectStatus.RUNNING
+    project.current_run = entities[-1 - progress.NUM_SHARDS - args.chunks].key
+    entities.append(project)
+    ndb.put_multi(entities)
+
+  return sampled
+
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--sdk',
+      default=os.environ.get('APPENGINE_SDK', ''),
+      help='App Engine Python SDK directory (or set APPENGINE_SDK).')
+  parser.add_argument('--projects', type=int, default=2000)
+  parser.add_argument('--assets', type=int, default=20,
+                      help='Assets per project.')
+  parser.add_argument('--sample', type=int, default=20,
+                      help='Projects given runs and logs and requested.')
+  parser.add_argument('--runs', type=int, default=3,
+                      help='Runs per sampled project.')
+  parser.add_argument('--chunks', type=int, default=4,
+                      help='Log chunks per run.')
+  parser.add_argument('--requests', type=int, default=200,
+                      help='Requests per route.')
+  parser.add_argument('routes', nargs='*', default=[n for n, _ in ROUTES])
+  args = parser.parse_args()
+
+  if not args.sdk:
+    parser.error('--sdk is required')
+
+  setup_path(args.sdk)
+  from google.appengine.api import apiproxy_stub_map
+  from google.appengine.ext import ndb
+  from google.appengine.ext import testbed
+  import webapp2
+
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  bed.init_blobstore_stub()
+  bed.init_app_identity_stub()
+  bed.init_taskqueue_stub(root_path=ROOT)
+  bed.init_urlfetch_stub()
+  bed.init_user_stub()
+
+  started = time.time()
+  project_ids = seed(args)
+  print('Seeded %d projects in %.1fs' % (args.projects, time.time() - started))
+
+  import main as frontend
+
+  counter = CallCounter()
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark', counter)
+
+  print('%-10s %10s %10s %10s  %s' % ('route', 'req/s', 'p50 ms', 'p99 ms',
+                                      'API calls per request'))
+  for name, path in ROUTES:
+    if name not in args.routes:
+      continue
+
+    latencies = []
+    calls = {}
+    for number in range(args.requests):
+      ndb.get_context().clear_cache()
+      counter.reset()
+      request = webapp2.Request.blank(
+          path % {'id': project_ids[number % len(project_ids)]})
+      started = time.time()
+      response = request.get_response(frontend.app)
+      latencies.append(time.time() - started)
+      if response.status_int != 200:
+        raise SystemExit('%s returned %s' % (request.path, response.status))
+      for service, count in counter.reset().iteritems():
+        calls[service] = calls.get(service, 0) + count
+
+    per_request = ', '.join(
+        '%s %.1f' % (service, float(count) / args.requests)
+        for service, count in sorted(calls.iteritems()))
+    print('%-10s %10.1f %10.1f %10.1f  %s' %
+          (name, args.requests / sum(latencies),
+           percentile(latencies, 0.5) * 1000,
+           percentile(latencies, 0.99) * 1000, per_request or '-'))
+
+  bed.deactivate()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures how long each module takes to import from a cold interpreter.
+
+Every module is imported in a fresh Python 2.7 process, the median of a few
+repetitions is reported along with the heavy third party packages the import
+pulled in. Frontend entry points (main, model) should not pull in any.
+
+  python scripts/benchmark_imports.py --sdk /path/to/google_appengine
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+MODULES = [
+    'main',
+    'model',
+    'scheduler',
+    'asset_archive',
+    'storage',
+    'schedule',
+    'dcm_job',
+    'dcm_dao',
+    'httplib2',
+    'oauth2client.client',
+    'googleapiclient.discovery',
+    'dateutil.tz',
+    'cloudstorage',
+]
+
+HEAVY_PACKAGES = [
+    'googleapiclient', 'oauth2client', 'httplib2', 'dateutil', 'cloudstorage'
+]
+
+CHILD = """
+import json, sys, time
+sys.path[0:0] = %(paths)r
+import dev_appserver
+dev_appserver.fix_sys_path()
+import appengine_config
+before = set(sys.modules)
+started = time.time()
+__import__(%(module)r)
+elapsed = time.time() - started
+loaded = set(m.split('.')[0] for m in set(sys.modules) - before)
+print(json.dumps({'seconds': elapsed, 'loaded': sorted(loaded)}))
+"""
+
+
+def measure(python, sdk, module):
+  output = subprocess.check_output(
+      [python, '-c', CHILD % {
+          'paths': [sdk, ROOT],
+          'module': module
+      }],
+      cwd=ROOT)
+  return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--sdk',
+      default=os.environ.get('APPENGINE_SDK', ''),
+      help='App Engine Python SDK directory (or set APPENGINE_SDK).')
+  parser.add_argument(
+      '--python', default=sys.executable, help='Python 2.7 interpreter.')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('modules', nargs='*', default=MODULES)
+  args = parser.parse_args()
+
+  if not args.sdk:
+    parser.error('--sdk is required')
+
+  print('%-28s %10s  %s' % ('module', 'ms', 'heavy packages loaded'))
+  for module in args.modules:
+    results = [
+        measure(args.python, args.sdk, module) for _ in range(args.repeat)
+    ]
+    seconds = sorted(r['seconds'] for r in results)[len(results) // 2]
+    heavy = [p for p in HEAVY_PACKAGES if p in results[0]['loaded']]
+    print('%-28s %10.1f  %s' %
+          (module, seconds * 1000, ', '.join(heavy) or '-'))
+
+
+if __name__ == '__main__':
+  main()
@@ -24,7 +24,7 @@ echo "Done."
 echo ""
 
 echo "Deploying to App Engine..."
-gcloud app deploy --project=$1
+gcloud app deploy app.yaml cron.yaml queue.yaml --project=$1
 echo "Done."
 echo ""
 
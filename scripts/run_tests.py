@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs the tests in tests/ against the App Engine testbed stubs.
+
+  python scripts/run_tests.py --sdk /path/to/google_appengine [pattern]
+"""
+
+import argparse
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--sdk',
+      default=os.environ.get('APPENGINE_SDK', ''),
+      help='App Engine Python SDK directory (or set APPENGINE_SDK).')
+  parser.add_argument('pattern', nargs='?', default='*_test.py')
+  args = parser.parse_args()
+
+  if not args.sdk:
+    parser.error('--sdk is required')
+
+  sys.path[0:0] = [args.sdk, ROOT, os.path.join(ROOT, 'tests')]
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  import appengine_config  # pylint: disable=unused-variable
+
+  suite = unittest.TestLoader().discover(
+      os.path.join(ROOT, 'tests'), pattern=args.pattern)
+  result = unittest.TextTestRunner(verbosity=2).run(suite)
+  sys.exit(0 if result.wasSuccessful() else 1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,161 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+import mimetypes
+import os
+
+# Resumable uploads need chunks in multiples of 256 KB.
+CHUNK_SIZE = 4 * 256 * 1024
+PREFETCH_BATCH_SIZE = 500
+
+GCS_SCHEME = 'gs://'
+LOCAL_SCHEME = 'file://'
+# Tests set this to read assets from local directories outside the dev
+# server.
+ALLOW_LOCAL_ASSETS = False
+
+
+class Asset(object):
+  __slots__ = ('backend', 'locator', 'filename', 'content_type', 'size')
+
+  def __init__(self, backend, locator, filename, content_type, size):
+    self.backend = backend
+    self.locator = locator
+    self.filename = filename
+    self.content_type = content_type
+    self.size = size
+
+  def open(self):
+    return self.backend.open(self)
+
+
+class BlobstoreBackend(object):
+  # Looks uploaded assets up by key, so a project with many assets never
+  # lists them all. Filenames known up front are fetched in batches.
+
+  def __init__(self, project_key):
+    self.project_key = project_key
+    self.assets = {}
+
+  def prefetch(self, filenames):
+    from model import asset_key
+
+    filenames = sorted(
+        set(f.lower() for f in filenames) - set(self.assets.iterkeys()))
+    for start in range(0, len(filenames), PREFETCH_BATCH_SIZE):
+      batch = filenames[start:start + PREFETCH_BATCH_SIZE]
+      found = ndb.get_multi([asset_key(self.project_key, f) for f in batch])
+      for filename, asset in zip(batch, found):
+        self.assets[filename] = asset and Asset(
+            self, asset.blob, asset.filename, asset.content_type, asset.size)
+
+  def find(self, filename):
+    filename = filename.lower()
+    if filename not in self.assets:
+      self.prefetch([filename])
+    return self.assets[filename]
+
+  def open(self, asset):
+    return blobstore.BlobReader(asset.locator, buffer_size=CHUNK_SIZE)
+
+
+class GcsBackend(object):
+
+  def __init__(self, url):
+    self.prefix = '/' + url[len(GCS_SCHEME):].rstrip('/') + '/'
+    self.assets = None
+
+  def find(self, filename):
+    import cloudstorage
+
+    if self.assets is None:
+      self.assets = {}
+      bucket, _, path = self.prefix[1:].partition('/')
+      for stat in cloudstorage.listbucket(
+          '/' + bucket, prefix=path, delimiter='/'):
+        if stat.is_dir:
+          continue
+        name = stat.filename[len(self.prefix):]
+        self.assets.setdefault(
+            name.lower(),
+            Asset(self, stat.filename, name, stat.content_type, stat.st_size))
+    return self.assets.get(filename.lower())
+
+  def open(self, asset):
+    import cloudstorage
+
+    return cloudstorage.open(asset.locator, 'r', read_buffer_size=CHUNK_SIZE)
+
+
+class LocalBackend(object):
+  # Reads assets from a directory, standing in for Cloud Storage in tests
+  # and local development. Anywhere else it would hand the instance's
+  # files to whoever sets the assets URL, see local_assets_allowed.
+
+  def __init__(self, url):
+    self.directory = url[len(LOCAL_SCHEME):]
+    self.assets = None
+
+  def find(self, filename):
+    if self.assets is None:
+      self.assets = {}
+      for name in sorted(os.listdir(self.directory)):
+        path = os.path.join(self.directory, name)
+        if os.path.isfile(path):
+          self.assets.setdefault(
+              name.lower(),
+              Asset(self, path, name,
+                    mimetypes.guess_type(name)[0] or
+                    'application/octet-stream', os.path.getsize(path)))
+    return self.assets.get(filename.lower())
+
+  def open(self, asset):
+    return open(asset.locator, 'rb')
+
+
+def local_assets_allowed():
+  return (ALLOW_LOCAL_ASSETS or
+          os.environ.get('SERVER_SOFTWARE', '').startswith('Development'))
+
+
+def backend_for_url(url):
+  if url.startswith(GCS_SCHEME):
+    return GcsBackend(url)
+  if url.startswith(LOCAL_SCHEME) and local_assets_allowed():
+    return LocalBackend(url)
+  raise ValueError('Assets URL "%s" must start with "%s"!' % (url, GCS_SCHEME))
+
+
+class AssetResolver(object):
+  # Looks assets up by filename, uploaded assets first and then the
+  # project's assets URL, if it has one.
+
+  def __init__(self, project):
+    self.uploaded = BlobstoreBackend(project.key)
+    self.backends = [self.uploaded]
+    if project.assets_url:
+      self.backends.append(backend_for_url(project.assets_url))
+
+  def prefetch(self, filenames):
+    # The other backends list all of their assets on the first find.
+    self.uploaded.prefetch(filenames)
+
+  def find(self, filename):
+    for backend in self.backends:
+      asset = backend.find(filename)
+      if asset:
+        return asset
+    return None
@@ -0,0 +1,76 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from dcm_cache import Creative
+from dcm_cache import DCMCacheEntry
+from dcm_cache import EntityCache
+from google.appengine.ext import ndb
+import testing
+
+
+def creative(n):
+  return Creative({'id': n, 'name': 'Creative %d' % n})
+
+
+class EntityCacheTest(testing.TestCase):
+
+  def setUp(self):
+    super(EntityCacheTest, self).setUp()
+    self.run_key = ndb.Key('Project', 1, 'ProjectRun', 2)
+    self.cache = EntityCache(Creative, 2, self.run_key)
+
+  def spilled_names(self):
+    return sorted(
+        key.id() for key in DCMCacheEntry.query(
+            ancestor=self.run_key).fetch(keys_only=True))
+
+  def test_least_recently_used_records_spill(self):
+    for n in range(3):
+      self.cache['Creative %d' % n] = creative(n)
+    self.cache.get('Creative 1')
+    self.cache['Creative 3'] = creative(3)
+
+    self.assertEqual(['Creative 1', 'Creative 3'], list(self.cache.entries))
+    self.assertEqual(['Creative:Creative 0', 'Creative:Creative 2'],
+                     self.spilled_names())
+    self.assertEqual(4, len(self.cache))
+    self.assertIn('Creative 0', self.cache)
+
+  def test_spilled_records_are_read_back(self):
+    for n in range(4):
+      self.cache['Creative %d' % n] = creative(n)
+
+    record = self.cache['Creative 0']
+    self.assertIsInstance(record, Creative)
+    self.assertEqual((0, 'Creative 0'), (record.id, record.name))
+    self.assertEqual(['Creative 3', 'Creative 0'], list(self.cache.entries))
+    self.assertEqual(
+        range(4), sorted(record.id for record in self.cache.values()))
+    self.assertIsNone(self.cache.get('Creative 4'))
+
+  def test_clear_deletes_spilled_records(self):
+    for n in range(4):
+      self.cache['Creative %d' % n] = creative(n)
+    self.cache.clear()
+
+    self.assertEqual([], self.spilled_names())
+    self.assertEqual(0, len(self.cache))
+
+  def test_unbounded_cache_never_spills(self):
+    cache = EntityCache(Creative, None, self.run_key)
+    for n in range(4):
+      cache['Creative %d' % n] = creative(n)
+
+    self.assertEqual([], self.spilled_names())
+    self.assertEqual(4, len(cache.entries))
@@ -0,0 +1,114 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from StringIO import StringIO
+from google.appengine.ext import ndb
+import codecs
+import feeds
+import gzip
+import json
+import testing
+
+ROW_COUNT = 11
+COLUMNS = sorted(feeds.COLUMNS.values())
+
+
+def records():
+  # Every third ad name spans two lines, quoted in CSV feeds.
+  return [{
+      'Campaign Name': 'Campaign %d' % (n % 3),
+      'Creative Size': '300x250',
+      'Ad Type': 'standard',
+      'Ad Name': 'Ad %d\nsecond line' % n if n % 3 == 0 else 'Ad %d' % n
+  } for n in range(ROW_COUNT)]
+
+
+def csv_content():
+  lines = [','.join(COLUMNS)]
+  for record in records():
+    lines.append(','.join(
+        '"%s"' % record.get(column, '') for column in COLUMNS))
+  return codecs.BOM_UTF8 + '\r\n'.join(lines) + '\r\n'
+
+
+def json_lines_content():
+  return codecs.BOM_UTF8 + ''.join(
+      json.dumps(record) + '\n' for record in records())
+
+
+def gzipped(content):
+  compressed = StringIO()
+  with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+    gzip_file.write(content)
+  return compressed.getvalue()
+
+
+class FeedPageTest(testing.TestCase):
+
+  def setUp(self):
+    super(FeedPageTest, self).setUp()
+    # Small blocks, so pages start in the middle of the feed and cross
+    # from one indexed block to the next.
+    self.interval = feeds.INDEX_INTERVAL
+    feeds.INDEX_INTERVAL = 4
+    self.project_key = ndb.Key('Project', 1)
+
+  def tearDown(self):
+    feeds.INDEX_INTERVAL = self.interval
+    super(FeedPageTest, self).tearDown()
+
+  def check_pages(self, filename, content):
+    feed = feeds.Feed(self.create_blob(filename, content))
+    feed_index = feed.index(self.project_key)
+    self.assertIsNone(feed_index.error)
+    self.assertEqual(ROW_COUNT, feed_index.row_count)
+    self.assertEqual(3, len(feed_index.offsets))
+
+    rows = list(feed.rows())
+    self.assertEqual('Campaign 0', rows[0]['campaign_name'])
+    self.assertEqual('Ad 3\nsecond line', rows[3]['ad_name'])
+    for start in range(ROW_COUNT + 1):
+      for size in [1, 3, 5]:
+        self.assertEqual(rows[start:start + size],
+                         feed.page(feed_index, start, size))
+
+  def test_csv_with_bom_and_quoted_line_breaks(self):
+    self.check_pages('feed.csv', csv_content())
+
+  def test_json_lines_with_bom(self):
+    self.check_pages('feed.jsonl', json_lines_content())
+
+  def test_gzip_csv(self):
+    self.check_pages('feed.csv.gz', gzipped(csv_content()))
+
+  def test_gzip_json_lines(self):
+    self.check_pages('feed.jsonl.gz', gzipped(json_lines_content()))
+
+  def test_unparseable_feed_is_recorded(self):
+    content = ','.join(COLUMNS) + '\n"Campaign\0"\n'
+    feed = feeds.Feed(self.create_blob('feed.csv', content))
+    feed_index = feed.index(self.project_key)
+    self.assertTrue(feed_index.error)
+    self.assertEqual(
+        feed_index.error,
+        feeds.index_key(self.project_key).get().error)
+
+  def test_missing_csv_columns_read_as_empty(self):
+    content = 'Campaign Name,Ad Name\n"Campaign 0","Ad 0"\n'
+    feed = feeds.Feed(self.create_blob('feed.csv', content))
+    rows = list(feed.rows())
+    self.assertEqual(1, len(rows))
+    self.assertEqual('Campaign 0', rows[0]['campaign_name'])
+    self.assertEqual('', rows[0]['creative_size'])
+    self.assertIsNone(feed.index(self.project_key).error)
@@ -0,0 +1,39 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import unittest
+
+
+class ImportOrderTest(unittest.TestCase):
+  # Deferred tasks unpickle scheduler functions on instances that haven't
+  # imported model yet, so each module must import cleanly on its own.
+
+  def check_imports(self, *modules):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen(
+        [sys.executable, '-c', '; '.join('import ' + m for m in modules)],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    self.assertEqual(0, process.returncode, output)
+
+  def test_scheduler_before_model(self):
+    self.check_imports('scheduler', 'model')
+
+  def test_model_before_scheduler(self):
+    self.check_imports('model', 'scheduler')
@@ -0,0 +1,53 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from StringIO import StringIO
+from google.appengine.api import datastore
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+import datetime
+import unittest
+
+
+class TestCase(unittest.TestCase):
+  # Runs each test against fresh Datastore, memcache and Blobstore stubs.
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_blobstore_stub()
+    self.blob_count = 0
+    ndb.get_context().set_cache_policy(False)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def create_blob(self, filename, content):
+    self.blob_count += 1
+    blob_key = 'blob-%d' % self.blob_count
+    self.testbed.get_stub('blobstore').storage.StoreBlob(
+        blob_key, StringIO(content))
+
+    info = datastore.Entity(
+        blobstore.BLOB_INFO_KIND, name=blob_key, namespace='')
+    info['filename'] = filename
+    info['content_type'] = 'application/octet-stream'
+    info['creation'] = datetime.datetime.utcnow()
+    info['size'] = len(content)
+    info['md5_hash'] = ''
+    datastore.Put(info)
+    return blobstore.BlobKey(blob_key)
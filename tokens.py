@@ -0,0 +1,101 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+import calendar
+import time
+
+TOKEN_ID = 'access-token'
+REFRESH_MARGIN = 5 * 60
+LOCK_TIME = 30
+LOCK_WAIT = 10
+LOCK_POLL = 0.5
+TOKEN_LIFETIME = 60 * 60
+
+
+class ProjectToken(ndb.Model):
+  access_token = ndb.StringProperty(indexed=False)
+  expires_at = ndb.FloatProperty(indexed=False)
+  updated_at = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class TokenStore(object):
+  # Hands out a project's access token from memcache or Datastore, shared by
+  # every run and worker. A token is refreshed once, a few minutes before
+  # it expires, by whichever worker takes the lock; the others keep using
+  # the current one or wait briefly for the new one.
+
+  def __init__(self, project_key, credentials):
+    self.key = ndb.Key(ProjectToken, TOKEN_ID, parent=project_key)
+    self.cache_key = 'token-%s' % project_key.urlsafe()
+    self.lock_key = 'token-lock-%s' % project_key.urlsafe()
+    self.credentials = credentials
+    self.token = None
+
+  def cached(self):
+    if self.token is None:
+      self.token = memcache.get(self.cache_key)
+    if self.token is None:
+      stored = self.key.get()
+      if stored:
+        self.token = (stored.access_token, stored.expires_at)
+    return self.token
+
+  def store(self, token):
+    self.token = token
+    ProjectToken(key=self.key, access_token=token[0], expires_at=token[1]).put()
+    memcache.set(
+        self.cache_key, token, time=max(1, int(token[1] - time.time())))
+
+  def usable(self, token, margin, rejected):
+    return (token is not None and token[0] != rejected and
+            token[1] - time.time() > margin)
+
+  def access_token(self, refresh, rejected=None):
+    token = self.cached()
+    if self.usable(token, REFRESH_MARGIN, rejected):
+      return token[0]
+
+    deadline = time.time() + LOCK_WAIT
+    locked = memcache.add(self.lock_key, 1, time=LOCK_TIME)
+    while not locked:
+      # Another worker is refreshing: the current token is fine until it
+      # actually expires, otherwise wait for the new one.
+      if self.usable(token, 0, rejected):
+        return token[0]
+      if time.time() > deadline:
+        break
+      time.sleep(LOCK_POLL)
+      self.token = None
+      token = self.cached()
+      if self.usable(token, REFRESH_MARGIN, rejected):
+        return token[0]
+      locked = memcache.add(self.lock_key, 1, time=LOCK_TIME)
+
+    try:
+      self.token = None
+      token = self.cached()
+      if self.usable(token, REFRESH_MARGIN, rejected):
+        return token[0]
+
+      refresh()
+      expiry = self.credentials.token_expiry
+      expires_at = (calendar.timegm(expiry.utctimetuple())
+                    if expiry else time.time() + TOKEN_LIFETIME)
+      self.store((self.credentials.access_token, expires_at))
+      return self.token[0]
+    finally:
+      if locked:
+        memcache.delete(self.lock_key)
@@ -0,0 +1,257 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from cancellation import RunCancelled
+from collections import deque
+from google.appengine.api import urlfetch
+from googleapiclient.errors import HttpError
+import httplib2
+import threading
+import time
+import zlib
+
+POOL_SIZE = 10
+MAX_IDLE_SECONDS = 60
+REQUEST_TIMEOUT = 300
+GZIP_MAGIC = '\x1f\x8b'
+# Google APIs only compress responses for clients that say so in their
+# user agent.
+COMPRESSED_HEADERS = {
+    'accept-encoding': 'gzip',
+    'user-agent': 'bulk-uploader (gzip)'
+}
+
+
+class HttpPool(object):
+  # Idle Http objects shared by every client on the instance, so their
+  # kept-alive connections are reused across runs. At most size of them are
+  # kept; one that failed or sat idle too long is dropped instead of reused.
+
+  def __init__(self, size=POOL_SIZE):
+    self.size = size
+    self.idle = []
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    now = time.time()
+    with self.lock:
+      while self.idle:
+        http, released_at = self.idle.pop()
+        if now - released_at < MAX_IDLE_SECONDS:
+          return http
+    return httplib2.Http(timeout=REQUEST_TIMEOUT)
+
+  def release(self, http):
+    with self.lock:
+      if len(self.idle) < self.size:
+        self.idle.append((http, time.time()))
+
+
+POOL = HttpPool()
+
+
+class AuthorizedHttp(object):
+  # Adds a project's credentials to requests sent over pooled Http objects,
+  # refreshing the access token when it expires or is rejected. Given a
+  # token store, tokens are shared with other workers through it.
+
+  def __init__(self, credentials, pool=POOL, tokens=None):
+    self.credentials = credentials
+    self.pool = pool
+    self.tokens = tokens
+
+  def with_http(self, send):
+    # An Http whose request raised is not returned to the pool, its
+    # connection may be broken.
+    http = self.pool.acquire()
+    result = send(http)
+    self.pool.release(http)
+    return result
+
+  def refresh(self):
+    self.with_http(self.credentials.refresh)
+
+  def access_token(self, rejected=None):
+    if self.tokens:
+      return self.tokens.access_token(self.refresh, rejected)
+
+    if (rejected or not self.credentials.access_token or
+        self.credentials.access_token_expired):
+      self.refresh()
+    return self.credentials.access_token
+
+  def authorization_headers(self, rejected=None):
+    return {'Authorization': 'Bearer %s' % self.access_token(rejected)}
+
+  def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+    headers = dict(headers or {})
+    token = self.access_token()
+    headers['Authorization'] = 'Bearer %s' % token
+
+    def send(http):
+      return http.request(
+          uri, method=method, body=body, headers=headers, **kwargs)
+
+    resp, content = self.with_http(send)
+    if resp.status == 401:
+      headers['Authorization'] = 'Bearer %s' % self.access_token(token)
+      resp, content = self.with_http(send)
+    return resp, content
+
+
+class Resolved(object):
+  # A future for a value that is already known.
+
+  def __init__(self, value):
+    self.value = value
+
+  def get_result(self):
+    return self.value
+
+
+class Then(object):
+  # A future for callback applied to the result of another future. Its
+  # result, or the exception raised instead, is kept for later callers.
+
+  def __init__(self, future, callback):
+    self.future = future
+    self.callback = callback
+    self.done = False
+    self.result = None
+    self.error = None
+
+  def get_result(self):
+    if not self.done:
+      try:
+        self.result = self.callback(self.future.get_result())
+      except Exception, e:
+        self.error = e
+        raise
+      finally:
+        self.done = True
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+
+class Outcome(object):
+  # A future for whatever start returns that hands back the exception it,
+  # or its own future, raised instead of raising it.
+
+  def __init__(self, start):
+    self.future = None
+    self.error = None
+    try:
+      self.future = start()
+    except RunCancelled:
+      raise
+    except Exception, e:
+      self.error = e
+
+  def get_result(self):
+    if self.future is not None:
+      try:
+        return self.future.get_result()
+      except RunCancelled:
+        raise
+      except Exception, e:
+        self.future = None
+        self.error = e
+    return self.error
+
+
+class ApiFuture(object):
+  # The result of an API request sent as an asynchronous urlfetch RPC.
+  # get_result() waits for it, parses it like HttpRequest.execute() would
+  # and applies transform. A failed request is handed to fallback, which
+  # either returns a result of its own or raises. Either way it only runs
+  # once, however many callers wait for the future.
+
+  def __init__(self, rpc, request, transform=None, fallback=None):
+    self.rpc = rpc
+    self.request = request
+    self.transform = transform
+    self.fallback = fallback
+    self.done = False
+    self.result = None
+    self.error = None
+
+  def get_result(self):
+    if not self.done:
+      try:
+        try:
+          self.result = self.parse(self.rpc.get_result())
+        except HttpError, e:
+          if not self.fallback:
+            raise
+          self.result = self.fallback(e)
+      except Exception, e:
+        self.error = e
+        raise
+      finally:
+        self.done = True
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+  def parse(self, response):
+    info = dict((k.lower(), v) for k, v in response.headers.items())
+    info['status'] = str(response.status_code)
+    resp = httplib2.Response(info)
+
+    if resp.status >= 300:
+      raise HttpError(resp, decoded_content(response), uri=self.request.uri)
+
+    result = self.request.postproc(resp, decoded_content(response))
+    return self.transform(result) if self.transform else result
+
+
+def decoded_content(response):
+  # Responses are requested compressed and urlfetch may hand gzip bodies
+  # over as they came.
+  if response.content.startswith(GZIP_MAGIC):
+    return zlib.decompress(response.content, 16 + zlib.MAX_WBITS)
+  return response.content
+
+
+def start(request, headers, transform=None, fallback=None):
+  # Sends a googleapiclient HttpRequest without waiting for the response,
+  # with extra headers such as Authorization.
+  request_headers = dict(request.headers)
+  request_headers.update(headers)
+
+  rpc = urlfetch.create_rpc()
+  urlfetch.make_fetch_call(
+      rpc,
+      request.uri,
+      payload=request.body,
+      method=request.method,
+      headers=request_headers,
+      follow_redirects=False)
+  return ApiFuture(rpc, request, transform, fallback)
+
+
+def in_flight(items, start, size):
+  # Yields (item, result) pairs in order, starting a future per item with
+  # at most size of them outstanding at once.
+  pending = deque()
+  for item in items:
+    if len(pending) >= size:
+      done, future = pending.popleft()
+      yield done, future.get_result()
+    pending.append((item, start(item)))
+
+  while pending:
+    done, future = pending.popleft()
+    yield done, future.get_result()
@@ -0,0 +1,100 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+import datetime
+import hashlib
+
+# Version markers of what the API serves about a project, kept in memcache
+# so a client polling for something it already has is answered without
+# reading Datastore. A marker starts with the time of the change it stands
+# for; one lost from memcache is derived again or replaced by a new one.
+
+PROJECT = 'project'
+STATUS = 'status'
+LOG = 'log'
+RESOURCES = (PROJECT, STATUS, LOG)
+
+
+def cache_key(project_key, resource):
+  return 'version-%s-%s' % (resource, project_key.urlsafe())
+
+
+def fresh_marker():
+  return datetime.datetime.utcnow().isoformat()
+
+
+def log_marker(chunk_key, updated_at):
+  # Compaction replaces a run's chunks with chunk 1 but keeps the latest
+  # timestamp, so the chunk is part of the marker.
+  return '%s-%s-%s' % (updated_at.isoformat(), chunk_key.parent().id(),
+                       chunk_key.id())
+
+
+def changed(project_key, markers):
+  # Stores new markers once the change they stand for is committed, so a
+  # reader never tags data from before the change with them.
+
+  def store():
+    # A marker that couldn't be replaced must not outlive the change, the
+    # next reader derives it again instead.
+    failed = memcache.set_multi(
+        dict((cache_key(project_key, resource), marker)
+             for resource, marker in markers.iteritems()))
+    if failed:
+      memcache.delete_multi(failed)
+
+  ndb.get_context().call_on_commit(store)
+
+
+def forget(project_key):
+  ndb.get_context().call_on_commit(lambda: memcache.delete_multi(
+      [cache_key(project_key, resource) for resource in RESOURCES]))
+
+
+def current(project_key, resources, derive):
+  # Returns the markers of resources in order, calling derive(resource) for
+  # those memcache lost, or None if derive has nothing to go on. Markers
+  # must be read before the data they describe.
+  keys = [cache_key(project_key, resource) for resource in resources]
+  cached = memcache.get_multi(keys)
+
+  markers = []
+  derived = {}
+  for key, resource in zip(keys, resources):
+    marker = cached.get(key)
+    if marker is None:
+      marker = derive(resource)
+      if marker is None:
+        return None
+      derived[key] = marker
+    markers.append(marker)
+
+  if derived:
+    memcache.add_multi(derived)
+  return markers
+
+
+def etag(markers, *extra):
+  return hashlib.md5('|'.join(list(markers) + list(extra))).hexdigest()
+
+
+def last_modified(markers):
+  times = [
+      datetime.datetime.strptime(marker[:19], '%Y-%m-%dT%H:%M:%S')
+      for marker in markers
+      if marker
+  ]
+  return max(times) if times else None